@@ -7,13 +7,46 @@ from shapely.geometry import Point
 import pandas as pd
 from shapely.geometry import Point, LineString
 import os
-from SunGlareDetectionFunctions import check_if_any_sun_glare_at_panoramic_with_datetime
+import time
+from concurrent.futures import ProcessPoolExecutor
+from SunGlareDetectionFunctions import check_if_any_sun_glare_at_panoramic_with_datetime, calculate_sun_glare_batch
 import ast
 from datetime import datetime, timedelta, timezone
 import folium
 from sklearn.cluster import DBSCAN
+from scipy.spatial import cKDTree
+import pickle
+from SegmentGraph import has_segment_graph, load_segment_graph, get_segment_graph_directory, get_segment_indices
+from VisualizationFunctions import get_closest_segment_headings
 import matplotlib.pyplot as plt
 from shapely.geometry import MultiPoint
+import shapely
+import geopandas as gpd
+
+# crashes evaluated together (all headings of their panoramas), chunks end on panorama boundaries
+CRASH_CHUNK_SIZE = 50000
+
+# crash to panorama matching
+EARTH_RADIUS_METERS = 6371008.8
+MAX_MATCH_DISTANCE_METERS = 30
+# nearest panoramas looked at when a road heading is given, and how far (degrees) a segment heading may be from it
+HEADING_MATCH_CANDIDATES = 8
+MAX_HEADING_DIFFERENCE = 30
+MATCH_CHUNK_SIZE = 500000
+PANORAMA_TREE_FILE = "panorama_tree.pickle"
+
+# glare crash hotspots: crashes within HOTSPOT_RADIUS_METERS of each other (DBSCAN eps) and at least HOTSPOT_MIN_CRASHES
+# crashes per hotspot core
+HOTSPOT_RADIUS_METERS = 50
+HOTSPOT_MIN_CRASHES = 3
+HOTSPOT_COORDINATE_PRECISION = 6
+
+# glare baseline: random timestamps per crash location, evaluated in tasks of about BASELINE_TASK_SIZE crashes
+BASELINE_SAMPLES_PER_CRASH = 20
+BASELINE_DISTRIBUTIONS = ["uniform", "time_of_day", "shuffle"]
+BASELINE_TASK_SIZE = 500
+BASELINE_CONFIDENCE_Z = 1.96
+SECONDS_PER_DAY = 86400
 
 
 def convert_military_integer_to_time(military_int):
@@ -24,6 +57,171 @@ def convert_military_integer_to_time(military_int):
 
     return hours,minutes
 
+# epoch seconds (UTC) of every crash, same date and time as convert_military_integer_to_time gives
+def get_crash_timestamps(crash_data):
+    month_day_year = crash_data['Crash Date'].astype(str).str.split("/", expand=True).astype(int)
+    military_times = crash_data['Crash Military Time'].astype(int)
+    date_times = pd.to_datetime(pd.DataFrame({'year': month_day_year[2], 'month': month_day_year[0], 'day': month_day_year[1],
+                                              'hour': military_times // 100, 'minute': military_times % 100}), utc=True)
+    return ((date_times - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(seconds=1)).to_numpy(dtype=float)
+
+# True where any segment heading of the panorama has sun glare at the timestamp (same as
+# check_if_any_sun_glare_at_panoramic_with_datetime), one entry per (panorama position, timestamp)
+# panoramic_data['segment_headings'] has to be parsed already, segmentation_maps: optional cache of loaded maps
+def calculate_sun_glare_at_panoramas(base_directory, panoramic_data, pano_positions, timestamps, segmentation_maps=None):
+    heading_counts = panoramic_data['segment_headings'].map(len).to_numpy()
+    heading_offsets = np.concatenate(([0], np.cumsum(heading_counts)))
+    headings = np.array([heading for segment_headings in panoramic_data['segment_headings'] for heading in segment_headings], dtype=float)
+
+    # one evaluation per (entry, segment heading)
+    counts = heading_counts[pano_positions]
+    entries = np.repeat(np.arange(len(pano_positions)), counts)
+    entry_headings = headings[np.repeat(heading_offsets[pano_positions] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+    glare, _, _ = calculate_sun_glare_batch(base_directory, panoramic_data.iloc[np.repeat(pano_positions, counts)], entry_headings,
+                                            np.asarray(timestamps, dtype=float)[entries], segmentation_maps)
+
+    has_sun_glare = np.zeros(len(pano_positions), dtype=bool)
+    has_sun_glare[entries[glare]] = True
+    return has_sun_glare
+
+# (start, end) positions (into order) of chunks of about chunk_size items, order has to be sorted by panorama
+# a panorama is never split across chunks: each chunk takes chunk_size items and then the rest of the panorama it ended
+# in, so a chunk can hold up to chunk_size + (items of one panorama) - 1 items
+def get_panorama_chunk_bounds(sorted_pano_positions, chunk_size):
+    pano_starts = np.flatnonzero(np.concatenate(([True], np.diff(sorted_pano_positions) != 0)))
+    bounds = [0]
+    while bounds[-1] < len(sorted_pano_positions):
+        start = bounds[-1]
+        bounds.append(pano_starts[np.searchsorted(pano_starts, start + chunk_size)] if start + chunk_size < pano_starts[-1] else len(sorted_pano_positions))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+# first row of each pano_id (like panoramic_data[matched_pano_id == panoramic_data['pano_id']].iloc[0]) and the
+# position of every crash's panorama (-1 when it is not in panoramic_data)
+def get_crash_panorama_positions(crash_data, panoramic_data):
+    panoramic_data = panoramic_data.drop_duplicates('pano_id').reset_index(drop=True)
+    pano_positions = pd.Index(panoramic_data['pano_id']).get_indexer(crash_data['matched_pano_id'])
+    unknown = np.count_nonzero(pano_positions < 0)
+    if unknown:
+        print(f"\t{unknown} crashes have a matched_pano_id that is not in panoramic_data")
+    return panoramic_data, pano_positions
+
+# same result as check_if_any_sun_glare_at_panoramic_with_datetime for every crash (sun glare at any segment heading of
+# the matched panorama), panoramic_data['segment_headings'] has to be parsed already
+# crashes are sorted by panorama so each segmentation map is read once, returns a bool array (False for unknown panoramas)
+def calculate_sun_glare_for_crashes_batch(base_directory, crash_data, panoramic_data, chunk_size=CRASH_CHUNK_SIZE):
+    panoramic_data, pano_positions = get_crash_panorama_positions(crash_data, panoramic_data)
+    timestamps = get_crash_timestamps(crash_data)
+
+    has_sun_glare = np.zeros(len(crash_data), dtype=bool)
+    order = np.flatnonzero(pano_positions >= 0)
+    order = order[np.argsort(pano_positions[order], kind="stable")]
+    for start, end in get_panorama_chunk_bounds(pano_positions[order], chunk_size):
+        crashes = order[start:end]
+        has_sun_glare[crashes] = calculate_sun_glare_at_panoramas(base_directory, panoramic_data, pano_positions[crashes], timestamps[crashes])
+        print(f"\tEvaluated {end} of {len(order)} crashes")
+    return has_sun_glare
+
+# points on the unit sphere, straight line (chord) distances between them order the same as great circle distances
+def convert_lat_longs_to_unit_vectors(lats, longs):
+    lats = np.radians(np.asarray(lats, dtype=float))
+    longs = np.radians(np.asarray(longs, dtype=float))
+    return np.column_stack((np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)))
+
+def convert_chord_lengths_to_meters(chord_lengths):
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.minimum(chord_lengths / 2, 1))
+
+def convert_meters_to_chord_lengths(meters):
+    return 2 * np.sin(meters / (2 * EARTH_RADIUS_METERS))
+
+# KD tree over the panoramas of an environment (unit sphere, so distances are exact great circle distances), saved next
+# to panoramic_data.csv and rebuilt when it changes
+def get_panorama_tree(base_directory):
+    panoramic_data_path = f"{base_directory}/panoramic_data.csv"
+    tree_path = f"{base_directory}/{PANORAMA_TREE_FILE}"
+    source = {"size": os.path.getsize(panoramic_data_path), "modified": os.path.getmtime(panoramic_data_path)}
+    if os.path.exists(tree_path):
+        with open(tree_path, "rb") as file:
+            panorama_tree = pickle.load(file)
+        if panorama_tree["source"] == source:
+            return panorama_tree
+
+    panoramic_data = pd.read_csv(panoramic_data_path)
+    panorama_tree = {
+        "source": source,
+        "tree": cKDTree(convert_lat_longs_to_unit_vectors(panoramic_data['lat'], panoramic_data['long'])),
+        "pano_ids": panoramic_data['pano_id'].astype(str).to_numpy(),
+        "segment_ids": panoramic_data['segment_id'].astype(str).to_numpy() if 'segment_id' in panoramic_data else None,
+    }
+    # write to a temp file first so an interrupted run never leaves half a tree
+    with open(tree_path + ".tmp", "wb") as file:
+        pickle.dump(panorama_tree, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tree_path + ".tmp", tree_path)
+    print(f"\tPanorama tree saved to: {tree_path}")
+    return panorama_tree
+
+# (panorama position, distance in meters) of the closest panorama within max_distance of every crash (-1, NaN if none)
+# road_headings: optional crash road headings (clockwise from north), only panoramas on a segment with a heading within
+# MAX_HEADING_DIFFERENCE of it can match (needs the segment graph)
+def match_crashes_to_panoramas(panorama_tree, lats, longs, road_headings=None, segment_graph=None, max_distance=MAX_MATCH_DISTANCE_METERS):
+    points = convert_lat_longs_to_unit_vectors(lats, longs)
+    if len(points) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0)
+    pano_count = len(panorama_tree["pano_ids"])
+    candidate_count = 1 if road_headings is None else min(HEADING_MATCH_CANDIDATES, pano_count)
+    # missing candidates (none within max_distance) come back as an infinite distance and index pano_count
+    chord_lengths, candidates = panorama_tree["tree"].query(points, k=candidate_count, distance_upper_bound=convert_meters_to_chord_lengths(max_distance))
+    chord_lengths = chord_lengths.reshape(len(points), candidate_count)
+    candidates = candidates.reshape(len(points), candidate_count)
+    distances = convert_chord_lengths_to_meters(chord_lengths)
+    valid = distances <= max_distance
+
+    if road_headings is not None:
+        road_headings = np.asarray(road_headings, dtype=float)
+        segment_indices = get_segment_indices(segment_graph, panorama_tree["segment_ids"][np.minimum(candidates, pano_count - 1).ravel()])
+        closest_headings = get_closest_segment_headings(segment_graph, segment_indices, np.repeat(road_headings, candidate_count))
+        heading_differences = np.abs((closest_headings - np.repeat(road_headings, candidate_count) + 180) % 360 - 180).reshape(candidates.shape)
+        # crashes without a heading keep the distance only match
+        valid &= (heading_differences <= MAX_HEADING_DIFFERENCE) | np.isnan(road_headings)[:, None]
+
+    # candidates are sorted by distance, take the first valid one
+    has_match = valid.any(axis=1)
+    first = valid.argmax(axis=1)
+    rows = np.arange(len(points))
+    return np.where(has_match, candidates[rows, first], -1), np.where(has_match, distances[rows, first], np.nan)
+
+# writes car_crashes_with_panoramics_<city>.csv (crash rows with matched_pano_id and match_distance_meters, empty when no
+# panorama is close enough) from a crash csv with LAT and LON columns, read in chunks so any number of crashes fits
+# heading_column: optional crash column with the road heading (clockwise from north)
+def create_car_crashes_with_panoramics(location, base_directory, crash_csv_path, heading_column=None, max_distance=MAX_MATCH_DISTANCE_METERS, chunk_size=MATCH_CHUNK_SIZE):
+    simple_name = location.split(",")[0]
+    output_path = f"{base_directory}/car_crashes_with_panoramics_{simple_name}.csv"
+    panorama_tree = get_panorama_tree(base_directory)
+    segment_graph = None
+    if heading_column is not None:
+        if not has_segment_graph(base_directory) or panorama_tree["segment_ids"] is None:
+            raise ValueError("Matching by road heading needs the segment graph and segment_id in panoramic_data.csv")
+        segment_graph = load_segment_graph(get_segment_graph_directory(base_directory))
+
+    crash_count = 0
+    matched_count = 0
+    for chunk_number, crash_data in enumerate(pd.read_csv(crash_csv_path, chunksize=chunk_size)):
+        valid = crash_data['LAT'].notna().to_numpy() & crash_data['LON'].notna().to_numpy()
+        pano_positions = np.full(len(crash_data), -1)
+        distances = np.full(len(crash_data), np.nan)
+        road_headings = crash_data[heading_column].to_numpy(dtype=float)[valid] if heading_column is not None else None
+        pano_positions[valid], distances[valid] = match_crashes_to_panoramas(panorama_tree, crash_data['LAT'].to_numpy()[valid], crash_data['LON'].to_numpy()[valid],
+                                                                             road_headings, segment_graph, max_distance)
+
+        crash_data['matched_pano_id'] = np.where(pano_positions >= 0, panorama_tree["pano_ids"][np.maximum(pano_positions, 0)], None)
+        crash_data['match_distance_meters'] = distances
+        crash_data.to_csv(output_path, mode="w" if chunk_number == 0 else "a", header=chunk_number == 0, index=False)
+        crash_count += len(crash_data)
+        matched_count += int(np.count_nonzero(pano_positions >= 0))
+        print(f"\tMatched {matched_count} of {crash_count} crashes")
+
+    print(f"Crashes with panoramics saved to {output_path}")
+    return output_path
+
 def calculate_sun_glare_for_crashes(location, base_directory):
     simple_name = location.split(",")[0]
     output_crash_path = f"{base_directory}/car_crashes_with_sun_glare.csv"
@@ -33,34 +231,16 @@ def calculate_sun_glare_for_crashes(location, base_directory):
     panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv")
     panoramic_data['segment_headings'] = panoramic_data['segment_headings'].apply(ast.literal_eval)
 
-    car_crashes_with_sun_glare = []
-
-    # iterate to find the sun glare for each crash
-    for index, row in crash_data.iterrows():
-        # get the crash coordinates
-        lat, long = row['LAT'], row['LON']
-        car_crash_date = row['Crash Date']
-        month, day, year = car_crash_date.split("/")
-        hour, minutes = convert_military_integer_to_time(row['Crash Military Time'])
-        print(f"    {int(month)}/{day}/{year} {hour}:{minutes}")
-        date_time = datetime(int(year), int(month), int(day), int(hour), int(minutes), 0, tzinfo=timezone.utc)
-     
-        matched_pano_id = row['matched_pano_id']
-        panoramic_img_path = f"{base_directory}/panoramic_imgs/{matched_pano_id}.jpg"
-        print(f"    panoramic_img_path: {panoramic_img_path}")
-        panoramic_row = panoramic_data[matched_pano_id == panoramic_data['pano_id']].iloc[0]
-        has_sun_glare = check_if_any_sun_glare_at_panoramic_with_datetime(base_directory, panoramic_row, date_time)
-        print(f"    has_sun_glare: {has_sun_glare}")
-
-        car_crashes_with_sun_glare.append({
-            'date_time': date_time,
-            'lat': lat,
-            'long': long,
-            'has_sun_glare': has_sun_glare
-        })
+    # all crashes at once, grouped by panorama
+    has_sun_glare = calculate_sun_glare_for_crashes_batch(base_directory, crash_data, panoramic_data)
+    car_crashes_with_sun_glare_df = pd.DataFrame({
+        'date_time': pd.to_datetime(get_crash_timestamps(crash_data), unit="s", utc=True),
+        'lat': crash_data['LAT'],
+        'long': crash_data['LON'],
+        'has_sun_glare': has_sun_glare
+    })
 
     # save as csv
-    car_crashes_with_sun_glare_df = pd.DataFrame(car_crashes_with_sun_glare)
     car_crashes_with_sun_glare_df.to_csv(output_crash_path, index=False)
 
     sun_glare_data = car_crashes_with_sun_glare_df[car_crashes_with_sun_glare_df['has_sun_glare'] == True]
@@ -85,12 +265,184 @@ def calculate_sun_glare_for_crashes(location, base_directory):
 
 
 
+# random timestamps (crashes x samples, rounded to the minute like the crash data) for every crash location
+#   uniform:     any time between start and end (defaults to the first and last crash)
+#   time_of_day: the crash's time of day on a random day between start and end (keeps the traffic pattern of the day)
+#   shuffle:     timestamps of other crashes (permutation baseline)
+def sample_baseline_timestamps(rng, crash_timestamps, samples_per_crash=BASELINE_SAMPLES_PER_CRASH, distribution="uniform", start=None, end=None):
+    start = crash_timestamps.min() if start is None else start
+    end = crash_timestamps.max() if end is None else end
+    shape = (len(crash_timestamps), samples_per_crash)
+    if distribution == "uniform":
+        timestamps = rng.uniform(start, end, shape)
+    elif distribution == "time_of_day":
+        days = rng.integers(start // SECONDS_PER_DAY, end // SECONDS_PER_DAY + 1, shape)
+        timestamps = days * SECONDS_PER_DAY + (crash_timestamps % SECONDS_PER_DAY)[:, None]
+    elif distribution == "shuffle":
+        timestamps = crash_timestamps[rng.integers(0, len(crash_timestamps), shape)]
+    else:
+        raise ValueError(f"Unknown baseline distribution {distribution}, expected one of {BASELINE_DISTRIBUTIONS}")
+    return np.floor(timestamps / 60) * 60
+
+# process pool task: glare for the crashes of a few panoramas at every (crash, column) timestamp
+def evaluate_baseline_task(task):
+    base_directory, panoramic_data, pano_positions, timestamps = task
+    columns = timestamps.shape[1]
+    # the task's segmentation maps stay loaded for all of its timestamps, sun positions are numpy math over all of them at once
+    has_sun_glare = calculate_sun_glare_at_panoramas(base_directory, panoramic_data, np.repeat(pano_positions, columns), timestamps.ravel(), {})
+    return has_sun_glare.reshape(timestamps.shape)
+
+# observed glare rate of the crashes vs the expected (background) rate at the same locations at random times
+# observed: crashes (0/1), baseline_rates: fraction of random times with glare per crash
+def summarize_glare_baseline(observed, baseline_rates, z=BASELINE_CONFIDENCE_Z):
+    crash_count = len(observed)
+    observed_rate = observed.mean()
+    expected_rate = baseline_rates.mean()
+
+    # paired per crash differences, and the rate ratio with the delta method on its log
+    differences = observed - baseline_rates
+    difference_error = differences.std(ddof=1) / np.sqrt(crash_count)
+    # the log ratio only exists when both rates are above 0
+    has_ratio = observed_rate > 0 and expected_rate > 0
+    if has_ratio:
+        log_ratio_error = np.sqrt(observed.var(ddof=1) / observed_rate ** 2 + baseline_rates.var(ddof=1) / expected_rate ** 2
+                                  - 2 * np.cov(observed, baseline_rates)[0, 1] / (observed_rate * expected_rate)) / np.sqrt(crash_count)
+    z_score = differences.mean() / difference_error if difference_error > 0 else np.nan
+    observed_error = z * observed.std(ddof=1) / np.sqrt(crash_count)
+    expected_error = z * baseline_rates.std(ddof=1) / np.sqrt(crash_count)
+    # rates are fractions, so the intervals are cut to [0, 1]
+    return {
+        'crashes': int(crash_count),
+        'observed_rate': float(observed_rate),
+        'observed_rate_ci': (float(max(observed_rate - observed_error, 0)), float(min(observed_rate + observed_error, 1))),
+        'expected_rate': float(expected_rate),
+        'expected_rate_ci': (float(max(expected_rate - expected_error, 0)), float(min(expected_rate + expected_error, 1))),
+        'rate_ratio': float(observed_rate / expected_rate) if expected_rate > 0 else np.nan,
+        'rate_ratio_ci': tuple(np.exp(np.log(observed_rate / expected_rate) + np.array([-z, z]) * log_ratio_error).tolist()) if has_ratio else (np.nan, np.nan),
+        'z_score': float(z_score),
+        'p_value': math.erfc(abs(z_score) / math.sqrt(2)) if not np.isnan(z_score) else np.nan,
+    }
+
+# Monte Carlo glare baseline for the crashes of car_crashes_with_panoramics_<city>.csv: every crash location is also
+# evaluated at samples_per_crash random times (sample_baseline_timestamps), crashes are split into tasks by panorama and
+# run on a process pool. Timestamps come from one generator seeded with seed, so results do not depend on workers
+# writes car_crash_glare_baseline.csv (per crash) and returns the summary (summarize_glare_baseline)
+def calculate_glare_baseline_for_crashes(location, base_directory, samples_per_crash=BASELINE_SAMPLES_PER_CRASH, distribution="uniform", seed=0, workers=None, start=None, end=None):
+    start_time = time.perf_counter()
+    simple_name = location.split(",")[0]
+    crash_data = pd.read_csv(f"{base_directory}/car_crashes_with_panoramics_{simple_name}.csv")
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv")
+    panoramic_data['segment_headings'] = panoramic_data['segment_headings'].apply(ast.literal_eval)
+    panoramic_data, pano_positions = get_crash_panorama_positions(crash_data, panoramic_data)
+
+    crashes = np.flatnonzero(pano_positions >= 0)
+    crash_timestamps = get_crash_timestamps(crash_data)[crashes]
+    rng = np.random.default_rng(seed)
+    # column 0 is the actual crash time, the rest are the baseline samples
+    timestamps = np.column_stack((crash_timestamps, sample_baseline_timestamps(rng, crash_timestamps, samples_per_crash, distribution, start, end)))
+
+    order = np.argsort(pano_positions[crashes], kind="stable")
+    tasks = []
+    task_rows = []
+    for task_start, task_end in get_panorama_chunk_bounds(pano_positions[crashes][order], BASELINE_TASK_SIZE):
+        rows = order[task_start:task_end]
+        task_panos, task_positions = np.unique(pano_positions[crashes][rows], return_inverse=True)
+        tasks.append((base_directory, panoramic_data.iloc[task_panos].reset_index(drop=True), task_positions, timestamps[rows]))
+        task_rows.append(rows)
+
+    has_sun_glare = np.zeros(timestamps.shape, dtype=bool)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count, (rows, task_glare) in enumerate(zip(task_rows, executor.map(evaluate_baseline_task, tasks)), start=1):
+            has_sun_glare[rows] = task_glare
+            print(f"\tBaseline task {count}/{len(tasks)} done")
+
+    observed = has_sun_glare[:, 0].astype(float)
+    baseline_rates = has_sun_glare[:, 1:].mean(axis=1)
+    pd.DataFrame({
+        'lat': crash_data['LAT'].to_numpy()[crashes],
+        'long': crash_data['LON'].to_numpy()[crashes],
+        'matched_pano_id': crash_data['matched_pano_id'].to_numpy()[crashes],
+        'date_time': pd.to_datetime(crash_timestamps, unit="s", utc=True),
+        'has_sun_glare': observed.astype(bool),
+        'baseline_glare_rate': baseline_rates,
+    }).to_csv(f"{base_directory}/car_crash_glare_baseline.csv", index=False)
+
+    summary = summarize_glare_baseline(observed, baseline_rates)
+    summary.update({'samples_per_crash': samples_per_crash, 'distribution': distribution, 'seed': seed})
+    print(f"\tObserved glare rate {summary['observed_rate']:.4f} ({summary['observed_rate_ci'][0]:.4f}, {summary['observed_rate_ci'][1]:.4f})"
+          f", expected {summary['expected_rate']:.4f} ({summary['expected_rate_ci'][0]:.4f}, {summary['expected_rate_ci'][1]:.4f})")
+    print(f"\tRate ratio {summary['rate_ratio']:.3f} ({summary['rate_ratio_ci'][0]:.3f}, {summary['rate_ratio_ci'][1]:.3f}), z {summary['z_score']:.2f}, p {summary['p_value']:.3g}")
+    print(f"\tBaseline of {len(crashes)} crashes x {samples_per_crash} samples in {time.perf_counter() - start_time:.2f} seconds")
+    return summary
+
+
+# DBSCAN cluster label (-1 for noise) of every point, with a haversine ball tree
+# identical coordinates are clustered once with their count as weight (same labels as clustering every point), so
+# repeated crash locations cost nothing
+def cluster_crash_locations(lats, longs, radius_meters=HOTSPOT_RADIUS_METERS, min_crashes=HOTSPOT_MIN_CRASHES):
+    coordinates = np.column_stack((lats, longs)).astype(float)
+    if len(coordinates) == 0:
+        return np.zeros(0, dtype=int)
+    unique_coordinates, inverse, counts = np.unique(coordinates, axis=0, return_inverse=True, return_counts=True)
+    dbscan = DBSCAN(eps=radius_meters / EARTH_RADIUS_METERS, min_samples=min_crashes, metric="haversine", algorithm="ball_tree")
+    labels = dbscan.fit_predict(np.radians(unique_coordinates), sample_weight=counts)
+    return labels[inverse.ravel()]
+
+# one row per hotspot: crash count, center, first and last crash, convex hull (points or lines for tiny hotspots)
+def get_hotspot_hulls(lats, longs, labels, date_times=None):
+    clustered = labels >= 0
+    if not clustered.any():
+        return gpd.GeoDataFrame(columns=['hotspot_id', 'crash_count', 'lat', 'long', 'geometry'], geometry='geometry', crs="EPSG:4326")
+    hotspot_ids, hotspot_positions, crash_counts = np.unique(labels[clustered], return_inverse=True, return_counts=True)
+
+    # all hulls at once (one multipoint per hotspot, points sorted by hotspot)
+    order = np.argsort(hotspot_positions, kind="stable")
+    points = np.column_stack((longs[clustered], lats[clustered]))[order]
+    hulls = shapely.convex_hull(shapely.multipoints(points, indices=hotspot_positions[order]))
+    hulls = shapely.set_precision(hulls, 10 ** -HOTSPOT_COORDINATE_PRECISION)
+
+    hotspots = gpd.GeoDataFrame({
+        'hotspot_id': hotspot_ids,
+        'crash_count': crash_counts,
+        'lat': np.bincount(hotspot_positions, weights=lats[clustered]) / crash_counts,
+        'long': np.bincount(hotspot_positions, weights=longs[clustered]) / crash_counts,
+    }, geometry=hulls, crs="EPSG:4326")
+    if date_times is not None:
+        grouped = pd.Series(pd.to_datetime(date_times[clustered], utc=True)).groupby(hotspot_positions)
+        hotspots['first_crash'] = grouped.min().astype(str).to_numpy()
+        hotspots['last_crash'] = grouped.max().astype(str).to_numpy()
+    hotspots[['lat', 'long']] = hotspots[['lat', 'long']].round(HOTSPOT_COORDINATE_PRECISION)
+    return hotspots.sort_values('crash_count', ascending=False).reset_index(drop=True)
+
+# clusters the glare crashes of car_crashes_with_sun_glare.csv into hotspots, writes their hulls (GeoJSON) and a csv
+# with one row per hotspot (and a hotspot_id per glare crash)
+def create_glare_crash_hotspots(base_directory, radius_meters=HOTSPOT_RADIUS_METERS, min_crashes=HOTSPOT_MIN_CRASHES):
+    start_time = time.perf_counter()
+    crashes = pd.read_csv(f"{base_directory}/car_crashes_with_sun_glare.csv")
+    glare_crashes = crashes[crashes['has_sun_glare'].astype(bool) & crashes['lat'].notna() & crashes['long'].notna()].copy()
+
+    lats = glare_crashes['lat'].to_numpy(dtype=float)
+    longs = glare_crashes['long'].to_numpy(dtype=float)
+    glare_crashes['hotspot_id'] = cluster_crash_locations(lats, longs, radius_meters, min_crashes)
+    hotspots = get_hotspot_hulls(lats, longs, glare_crashes['hotspot_id'].to_numpy(), glare_crashes['date_time'].to_numpy())
+
+    with open(f"{base_directory}/car_crash_glare_hotspots.geojson", "w") as file:
+        file.write(hotspots.to_json(drop_id=True))
+    hotspots.drop(columns='geometry').to_csv(f"{base_directory}/car_crash_glare_hotspots.csv", index=False)
+    glare_crashes.to_csv(f"{base_directory}/car_crashes_with_glare_hotspots.csv", index=False)
+    print(f"\t{len(hotspots)} hotspots from {len(glare_crashes)} glare crashes in {time.perf_counter() - start_time:.2f} seconds")
+    print(f"Hotspots saved to {base_directory}/car_crash_glare_hotspots.geojson")
+    return hotspots
+
+
 def main():
     location = "fredericksburg, VA, USA"
 
     script_dir = os.path.dirname(os.path.abspath(__file__))
     base_directory = os.path.join(script_dir, "../data", "fredericksburg")
     calculate_sun_glare_for_crashes(location, base_directory)
+    create_glare_crash_hotspots(base_directory)
 
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,427 @@
+# Description:
+# Glare-aware routing on an osmnx drive graph
+# Glare rows are snapped to nodes in one vectorized nearest_nodes call, counted per edge, and the penalty is written
+# once into its own edge attribute (GLARE_WEIGHT), so the graph's lengths are never modified
+
+import time
+import math
+import heapq
+import bisect
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import networkx as nx
+import osmnx as ox
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+# an edge with sun glare costs GLARE_PENALTY times its length
+GLARE_PENALTY = 3
+GLARE_WEIGHT = "glare_weight"
+GLARE_COUNT = "glare_count"
+
+
+# nearest node of every (lat, long), in one call
+def snap_points_to_nodes(graph, lats, longs):
+    return np.asarray(ox.distance.nearest_nodes(graph, np.asarray(longs, dtype=float), np.asarray(lats, dtype=float)))
+
+# number of glare rows (with has_sun_glare) snapped to each edge's start node, edges leaving a node are the ones
+# driven past its panoramas
+def get_glare_counts_per_edge(graph, glare_nodes):
+    node_glare_counts = pd.Series(glare_nodes).value_counts()
+    edge_keys = list(graph.edges(keys=True))
+    start_nodes = [u for u, _, _ in edge_keys]
+    counts = node_glare_counts.reindex(start_nodes, fill_value=0).to_numpy()
+    return edge_keys, counts
+
+
+# sets GLARE_COUNT and GLARE_WEIGHT (length, times penalty if the edge has any glare) on every edge
+# returns the graph and the time (seconds) each step took
+def add_glare_weights(graph, glare_df, penalty=GLARE_PENALTY):
+    timings = {}
+
+    start_time = time.perf_counter()
+    glare_rows = glare_df[glare_df["has_sun_glare"] == True]
+    glare_nodes = snap_points_to_nodes(graph, glare_rows["lat"], glare_rows["long"]) if len(glare_rows) else np.array([])
+    timings["snap"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    edge_keys, glare_counts = get_glare_counts_per_edge(graph, glare_nodes)
+    lengths = np.array([data["length"] for _, _, data in graph.edges(data=True)], dtype=float)
+    glare_weights = np.where(glare_counts > 0, lengths * penalty, lengths)
+    timings["aggregate"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    nx.set_edge_attributes(graph, dict(zip(edge_keys, glare_counts.tolist())), GLARE_COUNT)
+    nx.set_edge_attributes(graph, dict(zip(edge_keys, glare_weights.tolist())), GLARE_WEIGHT)
+    timings["assign"] = time.perf_counter() - start_time
+
+    print(f"\tGlare weights: {len(glare_rows)} glare rows snapped in {timings['snap']:.2f}s, "
+          f"{int((glare_counts > 0).sum())}/{len(edge_keys)} edges penalized (aggregate {timings['aggregate']:.2f}s, assign {timings['assign']:.2f}s)")
+    return graph, timings
+
+
+# (fastest route, glare avoiding route) as node lists, the graph needs add_glare_weights first
+def route_fastest_and_glare_avoiding(graph, origin_point, destination_point):
+    origin_node, destination_node = snap_points_to_nodes(graph, [origin_point[0], destination_point[0]], [origin_point[1], destination_point[1]]).tolist()
+    fastest_route = nx.shortest_path(graph, source=origin_node, target=destination_node, weight="length")
+    glare_avoidance_route = nx.shortest_path(graph, source=origin_node, target=destination_node, weight=GLARE_WEIGHT)
+    return fastest_route, glare_avoidance_route
+
+
+# compares add_glare_weights with snapping one glare row at a time (Routing.py's old add_glare_penalty), the per row
+# time is measured on a sample and extrapolated to every row
+def benchmark_glare_weights(graph, glare_df, sample_size=200):
+    sample = glare_df.head(sample_size)
+    start_time = time.perf_counter()
+    for _, row in sample.iterrows():
+        ox.distance.nearest_nodes(graph, row["long"], row["lat"])
+    per_row_seconds = (time.perf_counter() - start_time) / max(len(sample), 1) * len(glare_df)
+
+    start_time = time.perf_counter()
+    add_glare_weights(graph, glare_df)
+    bulk_seconds = time.perf_counter() - start_time
+
+    print(f"\tGraph: {len(graph.nodes)} nodes, {len(graph.edges)} edges, {len(glare_df)} glare rows")
+    print(f"\tPer row snapping: ~{per_row_seconds:.1f} seconds (extrapolated), add_glare_weights: {bulk_seconds:.2f} seconds")
+    return per_row_seconds, bulk_seconds
+
+
+# Time-dependent glare routing
+# glare changes while driving, so an edge's cost depends on the time the route enters it. The glare datasets of a day
+# become a time-indexed glare table (timestamps x edges), the glare at time t is the latest dataset at or before t.
+# An edge entered while it has glare takes GLARE_PENALTY times its travel time (drivers slow down / it is avoided)
+# Arrival times are kept FIFO (entering an edge later never arrives earlier) by taking, for every time bin, the
+# minimum of driving now and waiting for a later bin, so time-dependent Dijkstra stays exact
+
+GLARE_DATE_FORMAT = "%Y-%m-%d_%H-%M-%S"
+# speed used for roads with no maxspeed when no road of the same type has one (km/h)
+DEFAULT_SPEED_KPH = 40
+
+
+# adds travel_time (seconds) to the edges if the graph does not have it yet
+def add_travel_times(graph):
+    if all("travel_time" in data for _, _, data in graph.edges(data=True)):
+        return graph
+    graph = ox.add_edge_speeds(graph, fallback=DEFAULT_SPEED_KPH)
+    return ox.add_edge_travel_times(graph)
+
+
+# glare datasets are named and computed in UTC, so naive datetimes are taken as UTC (not as the machine's local time)
+def get_utc_date_time(date_time):
+    if date_time.tzinfo is None:
+        return date_time.replace(tzinfo=timezone.utc)
+    return date_time.astimezone(timezone.utc)
+
+
+# reads sun_glare_data_<date>.csv for every date_time and snaps all of them in one call
+# returns (timestamps as epoch seconds, (timestamps x edges) glare counts), edges in graph.edges(keys=True) order
+def build_glare_time_table(graph, base_directory, date_times):
+    date_times = sorted(get_utc_date_time(date_time) for date_time in date_times)
+    glare_rows = []
+    for timestamp_index, date_time in enumerate(date_times):
+        glare_df = pd.read_csv(f"{base_directory}/sun_glare_data_{date_time.strftime(GLARE_DATE_FORMAT)}.csv")
+        glare_df = glare_df.loc[glare_df["has_sun_glare"] == True, ["lat", "long"]]
+        glare_df["timestamp_index"] = timestamp_index
+        glare_rows.append(glare_df)
+    glare_rows = pd.concat(glare_rows, ignore_index=True)
+
+    node_positions = {node: position for position, node in enumerate(graph.nodes)}
+    glare_nodes = snap_points_to_nodes(graph, glare_rows["lat"], glare_rows["long"]) if len(glare_rows) else np.array([], dtype=int)
+    node_glare_counts = np.zeros((len(date_times), len(node_positions)), dtype=np.int32)
+    np.add.at(node_glare_counts, (glare_rows["timestamp_index"].to_numpy(), np.array([node_positions[node] for node in glare_nodes.tolist()], dtype=int)), 1)
+
+    start_positions = np.array([node_positions[u] for u, _, _ in graph.edges(keys=True)], dtype=int)
+    timestamps = np.array([date_time.timestamp() for date_time in date_times])
+    return timestamps, node_glare_counts[:, start_positions]
+
+
+# array form of the graph for time-dependent queries
+# glare_counts: (timestamps x edges) from build_glare_time_table
+# the search keeps two values per node: the real time it is reached (edge travel times, it picks the glare bins) and
+# the cost it minimizes (travel times with glare edges penalized, plus any time spent waiting for the glare to pass)
+def build_time_dependent_graph(graph, timestamps, glare_counts, penalty=GLARE_PENALTY):
+    graph = add_travel_times(graph)
+    nodes = list(graph.nodes)
+    node_positions = {node: position for position, node in enumerate(nodes)}
+    edge_keys = list(graph.edges(keys=True))
+    edge_starts = np.array([node_positions[u] for u, _, _ in edge_keys], dtype=int)
+    edge_ends = np.array([node_positions[v] for _, v, _ in edge_keys], dtype=int)
+    travel_times = np.array([data["travel_time"] for _, _, data in graph.edges(data=True)], dtype=float)
+
+    # edges leaving each node (CSR)
+    order = np.argsort(edge_starts, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(edge_starts, minlength=len(nodes)))))
+
+    # cost of every edge in every time bin, and when the next bin without glare on it starts (to wait for it instead)
+    has_glare = glare_counts > 0
+    bin_costs = np.where(has_glare, travel_times * penalty, travel_times)
+    next_clear_times = np.full(bin_costs.shape, np.inf)
+    for timestamp_index in range(len(timestamps) - 2, -1, -1):
+        next_clear_times[timestamp_index] = np.where(has_glare[timestamp_index + 1], next_clear_times[timestamp_index + 1], timestamps[timestamp_index + 1])
+
+    return {
+        "nodes": nodes,
+        "node_positions": node_positions,
+        "edge_keys": edge_keys,
+        "offsets": offsets.tolist(),
+        # python lists, the search reads them one value at a time
+        "edges": order.tolist(),
+        "edge_ends": edge_ends.tolist(),
+        "timestamps": timestamps.tolist(),
+        "travel_times": travel_times.tolist(),
+        "bin_costs": bin_costs.tolist(),
+        "next_clear_times": next_clear_times.tolist(),
+    }
+
+
+# (cost, arrival time in epoch seconds) of entering the edge at time t, driving through the glare or waiting for the
+# next bin without glare on it, whichever costs less
+def get_edge_step(td_graph, edge, t):
+    # latest glare dataset at or before t (the first one before the day starts)
+    timestamp_index = max(bisect.bisect_right(td_graph["timestamps"], t) - 1, 0)
+    travel_time = td_graph["travel_times"][edge]
+    cost = td_graph["bin_costs"][timestamp_index][edge]
+    arrival = t + travel_time
+    clear_time = td_graph["next_clear_times"][timestamp_index][edge]
+    if cost > travel_time and clear_time - t + travel_time < cost:
+        return clear_time - t + travel_time, clear_time + travel_time
+    return cost, arrival
+
+
+# least glare cost route from origin_node leaving at departure_time (datetime, naive is UTC)
+# returns (route nodes, arrival datetime, time each node is reached as datetimes), None if there is no route
+def time_dependent_shortest_path(td_graph, origin_node, destination_node, departure_time):
+    node_positions = td_graph["node_positions"]
+    offsets = td_graph["offsets"]
+    edges = td_graph["edges"]
+    edge_ends = td_graph["edge_ends"]
+    origin = node_positions[origin_node]
+    destination = node_positions[destination_node]
+
+    start = get_utc_date_time(departure_time).timestamp()
+    costs = {origin: 0.0}
+    arrival_times = {origin: start}
+    previous = {}
+    settled = set()
+    queue = [(0.0, origin)]
+    while queue:
+        cost, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled.add(node)
+        if node == destination:
+            break
+        t = arrival_times[node]
+        for edge in edges[offsets[node]:offsets[node + 1]]:
+            end = edge_ends[edge]
+            if end in settled:
+                continue
+            edge_cost, arrival = get_edge_step(td_graph, edge, t)
+            if cost + edge_cost < costs.get(end, math.inf):
+                costs[end] = cost + edge_cost
+                arrival_times[end] = arrival
+                previous[end] = node
+                heapq.heappush(queue, (cost + edge_cost, end))
+
+    if destination not in settled:
+        return None
+
+    route = [destination]
+    while route[-1] != origin:
+        route.append(previous[route[-1]])
+    route.reverse()
+
+    # node times in the departure's time zone (UTC when it is naive)
+    time_zone = departure_time.tzinfo or timezone.utc
+    node_times = [datetime.fromtimestamp(arrival_times[node], time_zone) for node in route]
+    return [td_graph["nodes"][node] for node in route], node_times[-1], node_times
+
+
+def create_time_dependent_glare_router(graph, base_directory, date_times, penalty=GLARE_PENALTY):
+    start_time = time.perf_counter()
+    timestamps, glare_counts = build_glare_time_table(graph, base_directory, date_times)
+    td_graph = build_time_dependent_graph(graph, timestamps, glare_counts, penalty)
+    print(f"\tTime-dependent glare router built for {len(date_times)} timestamps in {time.perf_counter() - start_time:.2f} seconds")
+    return td_graph
+
+
+# Batch many-to-many glare routing
+# the graph (with glare weights) is converted once to one sparse matrix per weight, and pairs are answered either by
+# one-to-many scipy Dijkstra searches (one per origin) or by A* with landmark (ALT) lower bounds, which only needs
+# the landmark distances precomputed once and then touches a small part of the graph per query
+
+# small weight used for zero length edges (zeros are not edges in a sparse matrix)
+MIN_EDGE_WEIGHT = 1e-6
+# origins searched at once by the one-to-many method (memory grows with origins x nodes)
+ORIGIN_CHUNK_SIZE = 256
+
+
+# one csr matrix per weight, parallel edges keep the one with the lowest weight (and its length/glare)
+def build_routing_arrays(graph, weights=("length", GLARE_WEIGHT)):
+    nodes = list(graph.nodes)
+    node_positions = {node: position for position, node in enumerate(nodes)}
+    edges = pd.DataFrame([(node_positions[u], node_positions[v], data["length"], data.get(GLARE_COUNT, 0) > 0, *[data[weight] for weight in weights])
+                          for u, v, data in graph.edges(data=True)], columns=["u", "v", "edge_length", "has_glare", *weights])
+    edges["glare_length"] = np.where(edges["has_glare"], edges["edge_length"], 0.0)
+
+    arrays = {"nodes": nodes, "node_positions": node_positions, "matrices": {}, "edge_values": {}}
+    for weight in weights:
+        best_edges = edges.loc[edges.groupby(["u", "v"])[weight].idxmin()]
+        matrix = csr_matrix((np.maximum(best_edges[weight].to_numpy(dtype=float), MIN_EDGE_WEIGHT), (best_edges["u"].to_numpy(), best_edges["v"].to_numpy())), shape=(len(nodes), len(nodes)))
+        arrays["matrices"][weight] = matrix
+        # (u, v) -> (length, glare_length) of the edge the route uses
+        arrays["edge_values"][weight] = dict(zip(zip(best_edges["u"].tolist(), best_edges["v"].tolist()), zip(best_edges["edge_length"].tolist(), best_edges["glare_length"].tolist())))
+    return arrays
+
+
+# (length, glare length) of a route given as node positions
+def get_route_values(arrays, weight, route):
+    edge_values = arrays["edge_values"][weight]
+    length = 0.0
+    glare_length = 0.0
+    for u, v in zip(route[:-1], route[1:]):
+        edge_length, edge_glare_length = edge_values[(u, v)]
+        length += edge_length
+        glare_length += edge_glare_length
+    return length, glare_length
+
+def get_route_from_predecessors(predecessors, origin, destination):
+    route = [destination]
+    while route[-1] != origin:
+        previous = predecessors[route[-1]]
+        if previous < 0:
+            return None
+        route.append(int(previous))
+    route.reverse()
+    return route
+
+
+# routes (node positions) for every pair, grouped by origin so each origin is searched once
+def route_pairs_one_to_many(arrays, weight, pairs):
+    routes = {}
+    origins = sorted({origin for origin, _ in pairs})
+    destinations_per_origin = {}
+    for origin, destination in pairs:
+        destinations_per_origin.setdefault(origin, []).append(destination)
+
+    for chunk_start in range(0, len(origins), ORIGIN_CHUNK_SIZE):
+        chunk = origins[chunk_start:chunk_start + ORIGIN_CHUNK_SIZE]
+        _, predecessors = dijkstra(arrays["matrices"][weight], directed=True, indices=chunk, return_predecessors=True)
+        for row, origin in enumerate(chunk):
+            for destination in destinations_per_origin[origin]:
+                routes[(origin, destination)] = get_route_from_predecessors(predecessors[row], origin, destination)
+    return routes
+
+
+# landmarks spread over the graph (each one is the node farthest from the ones already picked)
+# returns (nodes x landmarks) distances from every landmark and to every landmark
+def build_landmarks(arrays, weight, landmark_count=8, seed=0):
+    matrix = arrays["matrices"][weight]
+    node_count = matrix.shape[0]
+    landmarks = [int(np.random.default_rng(seed).integers(node_count))]
+    closest_landmark_distances = np.full(node_count, np.inf)
+    from_landmarks = []
+    to_landmarks = []
+    while len(landmarks) <= landmark_count:
+        landmark = landmarks[-1]
+        from_distances = dijkstra(matrix, directed=True, indices=landmark)
+        to_distances = dijkstra(matrix.T.tocsr(), directed=True, indices=landmark)
+        from_landmarks.append(from_distances)
+        to_landmarks.append(to_distances)
+        # farthest (reachable) node from every landmark so far
+        closest_landmark_distances = np.minimum(closest_landmark_distances, np.where(np.isfinite(from_distances), from_distances, -1))
+        landmarks.append(int(np.argmax(closest_landmark_distances)))
+    # the last pick was never searched
+    landmarks = landmarks[:-1]
+
+    # unreachable distances do not give a bound
+    from_landmarks = np.column_stack(from_landmarks)
+    to_landmarks = np.column_stack(to_landmarks)
+    return {"landmarks": landmarks, "from_landmarks": from_landmarks, "to_landmarks": to_landmarks}
+
+# A* with the landmark lower bound (triangle inequality), returns the route as node positions (None if unreachable)
+def alt_shortest_path(arrays, weight, landmark_data, origin, destination):
+    matrix = arrays["matrices"][weight]
+    indptr = matrix.indptr
+    indices = matrix.indices
+    data = matrix.data
+    from_landmarks = landmark_data["from_landmarks"]
+    to_landmarks = landmark_data["to_landmarks"]
+    from_destination = from_landmarks[destination]
+    to_destination = to_landmarks[destination]
+
+    def lower_bound(node):
+        with np.errstate(invalid="ignore"):
+            bounds = np.concatenate((from_destination - from_landmarks[node], to_landmarks[node] - to_destination))
+        bounds = bounds[np.isfinite(bounds)]
+        return max(float(bounds.max()), 0.0) if len(bounds) else 0.0
+
+    distances = {origin: 0.0}
+    previous = {}
+    settled = set()
+    queue = [(lower_bound(origin), origin)]
+    while queue:
+        _, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        if node == destination:
+            route = [destination]
+            while route[-1] != origin:
+                route.append(previous[route[-1]])
+            route.reverse()
+            return route
+        settled.add(node)
+        distance = distances[node]
+        for position in range(indptr[node], indptr[node + 1]):
+            neighbor = int(indices[position])
+            if neighbor in settled:
+                continue
+            new_distance = distance + data[position]
+            if new_distance < distances.get(neighbor, math.inf):
+                distances[neighbor] = new_distance
+                previous[neighbor] = node
+                heapq.heappush(queue, (new_distance + lower_bound(neighbor), neighbor))
+    return None
+
+
+# fastest (by length) vs glare avoiding route for every (origin_node, destination_node) pair
+# method: "one_to_many" (Dijkstra per origin, best when pairs share origins) or "alt" (landmark A* per pair)
+def batch_route_pairs(graph, pairs, method="one_to_many", landmark_count=8):
+    timings = {}
+    start_time = time.perf_counter()
+    arrays = build_routing_arrays(graph)
+    timings["arrays"] = time.perf_counter() - start_time
+
+    node_positions = arrays["node_positions"]
+    position_pairs = [(node_positions[origin], node_positions[destination]) for origin, destination in pairs]
+
+    routes = {}
+    for weight in ("length", GLARE_WEIGHT):
+        if method == "alt":
+            start_time = time.perf_counter()
+            landmark_data = build_landmarks(arrays, weight, landmark_count)
+            timings[f"landmarks_{weight}"] = time.perf_counter() - start_time
+
+            start_time = time.perf_counter()
+            routes[weight] = {pair: alt_shortest_path(arrays, weight, landmark_data, *pair) for pair in set(position_pairs)}
+        else:
+            start_time = time.perf_counter()
+            routes[weight] = route_pairs_one_to_many(arrays, weight, position_pairs)
+        timings[f"queries_{weight}"] = time.perf_counter() - start_time
+
+    rows = []
+    for (origin, destination), pair in zip(pairs, position_pairs):
+        fastest_route = routes["length"][pair]
+        glare_route = routes[GLARE_WEIGHT][pair]
+        if fastest_route is None or glare_route is None:
+            rows.append((origin, destination, np.nan, np.nan, np.nan, np.nan))
+            continue
+        rows.append((origin, destination, *get_route_values(arrays, "length", fastest_route), *get_route_values(arrays, GLARE_WEIGHT, glare_route)))
+
+    results = pd.DataFrame(rows, columns=["origin", "destination", "fastest_length", "fastest_glare_length", "glare_avoiding_length", "glare_avoiding_glare_length"])
+    results["glare_length_avoided"] = results["fastest_glare_length"] - results["glare_avoiding_glare_length"]
+    results["extra_length"] = results["glare_avoiding_length"] - results["fastest_length"]
+
+    print(f"\tRouted {len(pairs)} pairs ({method}): " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return results, timings
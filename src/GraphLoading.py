@@ -0,0 +1,197 @@
+# Description:
+# Loads drive road graphs from OSM (live services or a local .osm/.osm.pbf extract) and caches them on disk
+# The cache is keyed by the place/polygon/file and the network filter, so later runs (including routing)
+# load the network in seconds without touching the network
+
+import os
+import re
+import json
+import pickle
+import hashlib
+import networkx as nx
+import geopandas as gpd
+import shapely
+import osmnx as ox
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+GRAPH_CACHE_DIRECTORY = os.environ.get("GRAPH_CACHE_DIRECTORY", os.path.join(script_dir, "../graph_cache"))
+
+# same ways as osmnx's "drive" network filter, applied to ways parsed from a local file
+# (tag, regex of excluded values), ways need a highway tag
+DRIVE_FILTER = [
+    ("area", "yes"),
+    ("access", "private"),
+    ("highway", "abandoned|bridleway|bus_guideway|construction|corridor|cycleway|elevator|escalator|footway|no|path|pedestrian|planned|platform|proposed|raceway|razed|service|steps|track"),
+    ("motor_vehicle", "no"),
+    ("motorcar", "no"),
+    ("service", "alley|driveway|emergency_access|parking|parking_aisle|private"),
+]
+
+
+# cache file for a graph, keyed by everything that changes what the graph contains
+def get_graph_cache_path(cache_key):
+    key_hash = hashlib.sha1(json.dumps(cache_key, sort_keys=True).encode()).hexdigest()
+    return os.path.join(GRAPH_CACHE_DIRECTORY, f"{key_hash}.pickle")
+
+def load_cached_graph(cache_path):
+    if not os.path.exists(cache_path):
+        return None
+    with open(cache_path, "rb") as file:
+        return pickle.load(file)
+
+def save_cached_graph(graph, cache_path):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    # write to a temp file first so an interrupted run never leaves half a graph
+    with open(cache_path + ".tmp", "wb") as file:
+        pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_path + ".tmp", cache_path)
+
+
+def is_drive_edge(data):
+    if "highway" not in data:
+        return False
+    for tag, excluded_values in DRIVE_FILTER:
+        if tag in data and re.search(excluded_values, str(data[tag])):
+            return False
+    return True
+
+
+# keeps every way with a highway tag (and the nodes it uses) from a .osm.pbf file, and writes them as .osm xml for osmnx
+def convert_pbf_to_osm_xml(pbf_path, xml_path):
+    # only needed for .pbf files
+    import osmium
+
+    way_node_ids = set()
+    for way in osmium.FileProcessor(pbf_path, osmium.osm.WAY):
+        if "highway" in way.tags:
+            way_node_ids.update(node.ref for node in way.nodes)
+
+    temp_path = xml_path + ".tmp.osm"
+    writer = osmium.SimpleWriter(temp_path)
+    for osm_object in osmium.FileProcessor(pbf_path, osmium.osm.NODE | osmium.osm.WAY):
+        if osm_object.type_str() == "n" and osm_object.id in way_node_ids:
+            writer.add_node(osm_object)
+        elif osm_object.type_str() == "w" and "highway" in osm_object.tags:
+            writer.add_way(osm_object)
+    writer.close()
+    os.replace(temp_path, xml_path)
+
+
+# writes the part of an extract (.osm/.osm.bz2/.osm.pbf) inside bounds as .osm xml: every highway way with a node inside
+# of them and all of the nodes of those ways (so edges crossing the bounds are kept, like truncate_by_edge)
+# the file is streamed, memory only grows with the part inside of the bounds (ex: one tile of a metro-scale region)
+def cut_osm_file_to_bounds(osm_file, bounds, xml_path):
+    import osmium
+    min_long, min_lat, max_long, max_lat = bounds
+
+    inside_node_ids = set()
+    for node in osmium.FileProcessor(osm_file, osmium.osm.NODE):
+        if min_long <= node.location.lon <= max_long and min_lat <= node.location.lat <= max_lat:
+            inside_node_ids.add(node.id)
+
+    way_ids = set()
+    way_node_ids = set()
+    for way in osmium.FileProcessor(osm_file, osmium.osm.WAY):
+        if "highway" in way.tags and any(node.ref in inside_node_ids for node in way.nodes):
+            way_ids.add(way.id)
+            way_node_ids.update(node.ref for node in way.nodes)
+
+    temp_path = xml_path + ".tmp.osm"
+    writer = osmium.SimpleWriter(temp_path)
+    for osm_object in osmium.FileProcessor(osm_file, osmium.osm.NODE | osmium.osm.WAY):
+        if osm_object.type_str() == "n" and osm_object.id in way_node_ids:
+            writer.add_node(osm_object)
+        elif osm_object.type_str() == "w" and osm_object.id in way_ids:
+            writer.add_way(osm_object)
+    writer.close()
+    os.replace(temp_path, xml_path)
+
+
+# builds the same drive graph as ox.graph_from_place, but from a local .osm/.osm.bz2/.osm.pbf file
+# polygon: only keep the part of the file inside of it (None keeps the whole file)
+def graph_from_osm_file(osm_file, polygon=None, retain_all=False, truncate_by_edge=False):
+    if osm_file.endswith(".pbf"):
+        # osmnx only reads xml, so convert it once (kept next to the cached graphs)
+        xml_path = get_graph_cache_path({"pbf": os.path.abspath(osm_file), "size": os.path.getsize(osm_file), "modified": os.path.getmtime(osm_file)}).replace(".pickle", ".osm")
+        if not os.path.exists(xml_path):
+            print(f"\tConverting {osm_file} to .osm xml...")
+            os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+            convert_pbf_to_osm_xml(osm_file, xml_path)
+        osm_file = xml_path
+
+    # tags the drive filter needs, osmnx drops the others while parsing
+    useful_tags_way = list(ox.settings.useful_tags_way)
+    ox.settings.useful_tags_way = list(dict.fromkeys(useful_tags_way + [tag for tag, _ in DRIVE_FILTER]))
+    try:
+        graph = ox.graph_from_xml(osm_file, simplify=False, retain_all=True)
+    finally:
+        ox.settings.useful_tags_way = useful_tags_way
+
+    # filter (before simplifying, like osmnx does when it downloads a filtered network)
+    graph.remove_edges_from([(u, v, key) for u, v, key, data in graph.edges(keys=True, data=True) if not is_drive_edge(data)])
+    graph.remove_nodes_from(list(nx.isolates(graph)))
+
+    if polygon is not None:
+        graph = ox.truncate.truncate_graph_polygon(graph, polygon, truncate_by_edge=truncate_by_edge)
+    if not retain_all:
+        graph = ox.truncate.largest_component(graph)
+
+    return ox.simplify_graph(graph)
+
+
+def read_boundary_polygon(boundary_file):
+    return shapely.union_all(gpd.read_file(boundary_file).to_crs("EPSG:4326").geometry.values)
+
+
+def load_drive_graph(location=None, polygon=None, osm_file=None, boundary_file=None, retain_all=False, truncate_by_edge=False, use_cache=True):
+    """
+        Returns the drive network from (first one given):
+            osm_file: local .osm/.osm.bz2/.osm.pbf extract (no network needed), cut to boundary_file (GeoJSON/shapefile) and
+                      polygon if given (only the part of the file inside the polygon is read)
+            polygon: shapely polygon (lat/long)
+            location: place name, Example: "Arlington, VA, USA"
+        The graph is cached in GRAPH_CACHE_DIRECTORY, so the next call with the same arguments just loads it
+    """
+    cache_key = {"network_type": "drive", "filter": DRIVE_FILTER, "retain_all": retain_all, "truncate_by_edge": truncate_by_edge}
+    if osm_file:
+        cache_key.update({"osm_file": os.path.abspath(osm_file), "size": os.path.getsize(osm_file), "modified": os.path.getmtime(osm_file)})
+        if boundary_file:
+            with open(boundary_file, "rb") as file:
+                cache_key["boundary"] = hashlib.sha1(file.read()).hexdigest()
+        if polygon is not None:
+            cache_key["polygon"] = hashlib.sha1(shapely.to_wkb(polygon)).hexdigest()
+    elif polygon is not None:
+        cache_key["polygon"] = hashlib.sha1(shapely.to_wkb(polygon)).hexdigest()
+    else:
+        cache_key["location"] = location
+
+    cache_path = get_graph_cache_path(cache_key)
+    if use_cache:
+        graph = load_cached_graph(cache_path)
+        if graph is not None:
+            print(f"\tLoaded cached road graph: {cache_path}")
+            return graph
+
+    if osm_file:
+        boundary_polygon = read_boundary_polygon(boundary_file) if boundary_file else None
+        if polygon is not None:
+            # only the part of the extract around the polygon is parsed
+            boundary_polygon = polygon if boundary_polygon is None else polygon.intersection(boundary_polygon)
+            xml_path = cache_path.replace(".pickle", ".osm")
+            os.makedirs(os.path.dirname(xml_path), exist_ok=True)
+            cut_osm_file_to_bounds(osm_file, polygon.bounds, xml_path)
+            try:
+                graph = graph_from_osm_file(xml_path, boundary_polygon, retain_all, truncate_by_edge)
+            finally:
+                os.remove(xml_path)
+        else:
+            graph = graph_from_osm_file(osm_file, boundary_polygon, retain_all, truncate_by_edge)
+    elif polygon is not None:
+        graph = ox.graph_from_polygon(polygon, network_type="drive", retain_all=retain_all, truncate_by_edge=truncate_by_edge)
+    else:
+        graph = ox.graph_from_place(location, network_type="drive", retain_all=retain_all, truncate_by_edge=truncate_by_edge)
+
+    if use_cache:
+        save_cached_graph(graph, cache_path)
+        print(f"\tRoad graph cached to: {cache_path}")
+    return graph
@@ -1,9 +1,12 @@
 import os
+import time
+import pandas as pd
 from PIL import Image
 from transformers import SegformerFeatureExtractor, SegformerForSemanticSegmentation
 import torch
 import numpy as np
 import cv2
+from PanoramaStore import has_segmentation_maps_in_store, link_segmentation_maps_from_store, add_segmentation_maps_to_store
 
 
 def fill_sky_surrounded_by_buildings(segmentation_map_array):
@@ -98,6 +101,56 @@ def convert_image_to_segmentation_map(image_path, output_path):
     return segmentation_map
 
 
+# pano_id -> zoom level the panoramic was grabbed at (zoom 1 for older environments without the column)
+def get_pano_zoom_levels(base_directory):
+    panoramic_data_path = f"{base_directory}/panoramic_data.csv"
+    if not os.path.exists(panoramic_data_path):
+        return {}
+    panoramic_data = pd.read_csv(panoramic_data_path)
+    if 'zoom' not in panoramic_data.columns:
+        return {}
+    return dict(zip(panoramic_data['pano_id'], panoramic_data['zoom'].fillna(1).astype(int)))
+
+
+# creates both segmentation maps of one panoramic (or links them from the panorama store when another urban environment
+# already has them), inference_cost: optional zoom -> [images, pixels, seconds] that is updated
+# returns "exists", "store" or "segmented"
+def create_both_segmentation_maps_for_panoramic(base_directory, name, zoom=1, inference_cost=None, panoramic_img_file=None):
+    segmentation_save_file = f"{base_directory}/segmentation_maps/{name}.png"
+    segmentation_without_trees_save_file = f"{base_directory}/segmentation_maps_without_trees/{name}.png"
+    if os.path.exists(segmentation_save_file) and os.path.exists(segmentation_without_trees_save_file):
+        return "exists"
+    if has_segmentation_maps_in_store(name, zoom) and link_segmentation_maps_from_store(name, base_directory, zoom):
+        # already segmented for another urban environment, so no inference needed
+        return "store"
+
+    os.makedirs(os.path.dirname(segmentation_save_file), exist_ok=True)
+    os.makedirs(os.path.dirname(segmentation_without_trees_save_file), exist_ok=True)
+    if panoramic_img_file is None:
+        panoramic_img_file = f"{base_directory}/panoramic_imgs/{name}.jpg"
+
+    # write to temp files first so an interrupted run never leaves a half written map that looks complete
+    partial_segmentation_file = segmentation_save_file.replace(".png", ".partial.png")
+    partial_segmentation_without_trees_file = segmentation_without_trees_save_file.replace(".png", ".partial.png")
+    start_time = time.time()
+    segmentation_map = convert_image_to_segmentation_map(panoramic_img_file, partial_segmentation_file)
+    store_remove_trees_panoramic(partial_segmentation_file, partial_segmentation_without_trees_file)
+    os.replace(partial_segmentation_file, segmentation_save_file)
+    os.replace(partial_segmentation_without_trees_file, segmentation_without_trees_save_file)
+
+    if inference_cost is not None:
+        zoom_cost = inference_cost.setdefault(zoom, [0, 0, 0])
+        zoom_cost[0] += 1
+        zoom_cost[1] += segmentation_map.size
+        zoom_cost[2] += time.time() - start_time
+    add_segmentation_maps_to_store(name, base_directory, zoom)
+    return "segmented"
+
+def print_inference_cost_report(inference_cost):
+    for zoom, (images, pixels, seconds) in sorted(inference_cost.items()):
+        print(f"\tZoom {zoom}: segmented {images} panoramics ({pixels / images / 1e6:.2f} MP each) in {seconds:.1f} seconds, {seconds / images:.2f} seconds per panoramic")
+
+
 def create_both_segmentation_maps(base_directory):
     # make sure the segmentation maps are generated for each panoramic image
     panoramic_imgs_directory = f"{base_directory}/panoramic_imgs"
@@ -117,7 +170,12 @@ def create_both_segmentation_maps(base_directory):
     completed_segmentation_maps_without_trees = os.listdir(segmentation_map_without_trees_output_directory)
 
 
+    pano_zoom_levels = get_pano_zoom_levels(base_directory)
+
     count = 0
+    store_hits = 0
+    # inference cost per zoom level: zoom -> [images, pixels, seconds]
+    inference_cost = {}
     for filename in sorted_images:
         # print(f"\tCreating segmentation map for ({count}) {filename}")
         count+=1
@@ -125,11 +183,9 @@ def create_both_segmentation_maps(base_directory):
             print(f"\t\tSegmentation map already exists for {filename}... skipping")
             continue
         name = filename.split(".")[0]
-        segmentation_save_file = f"{segmentation_map_output_directory}/{name}.png"
-        segmentation_without_trees_save_file = f"{segmentation_map_without_trees_output_directory}/{name}.png"
-        panoramic_img_file = f"{panoramic_imgs_directory}/{filename}"
-        # this saves the segmentation_map to the save_file
-        convert_image_to_segmentation_map(panoramic_img_file, segmentation_save_file)
-        store_remove_trees_panoramic(segmentation_save_file, segmentation_without_trees_save_file)
-    print(f"\tAll segmentation maps created and saved") 
-
+        zoom = pano_zoom_levels.get(name, 1)
+        # this saves both segmentation maps
+        if create_both_segmentation_maps_for_panoramic(base_directory, name, zoom, inference_cost, f"{panoramic_imgs_directory}/{filename}") == "store":
+            store_hits += 1
+    print(f"\tAll segmentation maps created and saved ({store_hits} reused from the panorama store)")
+    print_inference_cost_report(inference_cost)
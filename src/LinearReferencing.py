@@ -0,0 +1,155 @@
+# Description:
+# Linear referencing along an edge's LineString
+# Cumulative distances are computed once per edge, then any sub line string between two
+# measures (or two points projected onto the edge) is just NumPy slicing + interpolation
+
+import numpy as np
+from pyproj import Geod
+
+# measures closer than this are treated as the same position on the line
+MEASURE_TOLERANCE = 1e-12
+
+
+# coords are (lon, lat) like shapely, measures are in the same (planar degree) units as shapely's project()
+def build_linear_reference(line_string):
+    coords = np.asarray(line_string.coords, dtype=float)[:, :2]
+    segment_lengths = np.hypot(*np.diff(coords, axis=0).T)
+    measures = np.concatenate(([0.0], np.cumsum(segment_lengths)))
+    return {
+        "coords": coords,
+        "measures": measures,
+        "segment_lengths": segment_lengths,
+        "length": measures[-1],
+    }
+
+
+# measure of the closest position on the line to each (lon, lat) point
+def project_points(linear_reference, lons, lats):
+    coords = linear_reference["coords"]
+    segment_lengths = linear_reference["segment_lengths"]
+    points = np.column_stack((np.atleast_1d(lons), np.atleast_1d(lats))).astype(float)
+
+    starts = coords[:-1]
+    deltas = coords[1:] - starts
+    squared_lengths = segment_lengths ** 2
+
+    # (points x segments) position of each point along each segment, clamped to the segment
+    offsets = points[:, None, :] - starts[None, :, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = np.einsum("psk,sk->ps", offsets, deltas) / squared_lengths
+    fractions = np.clip(np.nan_to_num(fractions, nan=0.0), 0.0, 1.0)
+
+    closest = starts[None, :, :] + fractions[:, :, None] * deltas[None, :, :]
+    squared_distances = np.sum((points[:, None, :] - closest) ** 2, axis=2)
+    closest_segment = np.argmin(squared_distances, axis=1)
+
+    rows = np.arange(len(points))
+    return linear_reference["measures"][closest_segment] + fractions[rows, closest_segment] * segment_lengths[closest_segment]
+
+def project_point(linear_reference, lon, lat):
+    return float(project_points(linear_reference, lon, lat)[0])
+
+
+# (lon, lat) of each measure along the line
+def interpolate_measures(linear_reference, measures):
+    coords = linear_reference["coords"]
+    line_measures = linear_reference["measures"]
+    measures = np.clip(np.atleast_1d(measures).astype(float), 0.0, linear_reference["length"])
+    lons = np.interp(measures, line_measures, coords[:, 0])
+    lats = np.interp(measures, line_measures, coords[:, 1])
+    return np.column_stack((lons, lats))
+
+
+# coords of the line between the two measures (start/end are interpolated, every vertex in between is kept)
+# reversed if the end measure comes before the start measure
+def extract_coords_between_measures(linear_reference, start_measure, end_measure):
+    reverse = end_measure < start_measure
+    low, high = (end_measure, start_measure) if reverse else (start_measure, end_measure)
+
+    line_measures = linear_reference["measures"]
+    first_vertex = np.searchsorted(line_measures, low + MEASURE_TOLERANCE, side="left")
+    last_vertex = np.searchsorted(line_measures, high - MEASURE_TOLERANCE, side="right")
+
+    endpoints = interpolate_measures(linear_reference, [low, high])
+    coords = np.vstack((endpoints[:1], linear_reference["coords"][first_vertex:last_vertex], endpoints[1:]))
+
+    if reverse:
+        coords = coords[::-1]
+    return coords
+
+
+# coord1 and coord2 are (lat, long) like segment ids, returns [(lon, lat), ...] like shapely coords
+def extract_line_string_between_coords(linear_reference, coord1, coord2):
+    measures = project_points(linear_reference, [coord1[1], coord2[1]], [coord1[0], coord2[0]])
+    return extract_line_strings_between_projected_coords(linear_reference, [coord1, coord2], measures, [(0, 1)])[0]
+
+# line strings for many (start, end) pairs of (lat, long) coords that were already projected onto the edge
+# (ex: every segment of an edge at once), each one same as extract_line_string_between_coords
+def extract_line_strings_between_projected_coords(linear_reference, coords, measures, pairs):
+    measures = np.asarray(measures, dtype=float)
+    # tolist() so the coords are plain floats (they get written to segments.csv as python literals)
+    points = interpolate_measures(linear_reference, measures).tolist()
+    vertices = linear_reference["coords"].tolist()
+    line_measures = linear_reference["measures"]
+    # vertices strictly after each measure start at first_vertex, vertices strictly before it end at last_vertex
+    first_vertex = np.searchsorted(line_measures, measures + MEASURE_TOLERANCE, side="left").tolist()
+    last_vertex = np.searchsorted(line_measures, measures - MEASURE_TOLERANCE, side="right").tolist()
+    measures = measures.tolist()
+
+    line_strings = []
+    for start, end in pairs:
+        if abs(measures[end] - measures[start]) <= MEASURE_TOLERANCE:
+            # both points project onto the same position, so there is no geometry to follow
+            line_strings.append([(coords[start][1], coords[start][0]), (coords[end][1], coords[end][0])])
+        elif measures[end] < measures[start]:
+            # reversed
+            line = [points[end]] + vertices[first_vertex[end]:last_vertex[start]] + [points[start]]
+            line_strings.append([tuple(coord) for coord in reversed(line)])
+        else:
+            line = [points[start]] + vertices[first_vertex[start]:last_vertex[end]] + [points[end]]
+            line_strings.append([tuple(coord) for coord in line])
+    return line_strings
+
+
+# Equally spaced sampling and headings along an edge (all array operations, no per point python loops)
+
+geod = Geod(ellps="WGS84")
+METERS_TO_FEET = 1 / 0.3048
+
+
+# geodesic length of the line in feet (sum of every vertex to vertex distance)
+def get_geodesic_length_feet(linear_reference):
+    coords = linear_reference["coords"]
+    _, _, distances = geod.inv(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+    return float(np.sum(distances)) * METERS_TO_FEET
+
+
+# same formula as NodeGrabbing.calculate_heading (clockwise from north, 0-360), for arrays of points
+def calculate_headings(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(value) for value in (lat1, lon1, lat2, lon2))
+    d_lon = lon2 - lon1
+
+    x = np.sin(d_lon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) * np.cos(d_lon))
+
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+# num_points equally spaced (lat, lon, heading) along the line, including both ends
+# each heading points from the sample to the vertex after its closest vertex
+def sample_equally_spaced_points(linear_reference, num_points):
+    coords = linear_reference["coords"]
+    sample_measures = np.linspace(0.0, linear_reference["length"], num_points)
+    samples = interpolate_measures(linear_reference, sample_measures)
+
+    # (samples x vertices) squared distance, to find the closest vertex for every sample
+    squared_distances = np.sum((samples[:, None, :] - coords[None, :, :]) ** 2, axis=2)
+    closest_vertex = np.argmin(squared_distances, axis=1)
+    next_vertex = np.minimum(closest_vertex + 1, len(coords) - 1)
+
+    lons = samples[:, 0]
+    lats = samples[:, 1]
+    headings = calculate_headings(lats, lons, coords[next_vertex, 1], coords[next_vertex, 0])
+
+    # tolist() so they are plain floats (they become segment ids)
+    return list(zip(lats.tolist(), lons.tolist(), headings.tolist()))
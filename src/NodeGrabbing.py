@@ -6,10 +6,19 @@ import folium
 import math
 import pandas as pd
 from geopy.distance import geodesic
-from shapely.geometry import LineString, Point
+from shapely.geometry import LineString
 from pyproj import Geod
 import osmnx as ox
 import os
+import time
+import tracemalloc
+from SegmentBuilding import build_segments_from_graph
+from TiledExtraction import store_all_nodes_at_location_tiled
+from GraphLoading import load_drive_graph
+from SegmentGraph import write_segment_graph, get_segment_graph_directory, load_segment_graph
+from VisualizationFunctions import make_line_features, make_point_features, add_geojson_layers
+import numpy as np
+from LinearReferencing import build_linear_reference, extract_line_string_between_coords, sample_equally_spaced_points, get_geodesic_length_feet
 
 
 geod = Geod(ellps="WGS84")
@@ -67,64 +76,66 @@ def draw_segments_on_map(segments, center_lat, center_lon, base_directory):
     print(f"\tSaving segment's map to: {segment_map_save_path}")
     m.save(segment_map_save_path)
 
+# same map as draw_segments_on_map, but as 3 GeoJSON layers (segments, links, headings) built from the segment graph arrays
+def draw_segments_on_map_geojson(segment_graph, base_directory, external=None):
+    lats = np.asarray(segment_graph["lats"])
+    longs = np.asarray(segment_graph["longs"])
+    segment_ids = segment_graph["segment_ids"].tolist()
+
+    # one line per (segment, linked segment)
+    link_counts = np.diff(segment_graph["link_offsets"])
+    sources = np.repeat(np.arange(len(lats)), link_counts)
+    targets = np.asarray(segment_graph["link_targets"])
+    linked = targets >= 0
+    pairs = np.unique(np.column_stack((sources[linked], targets[linked])), axis=0)
+    link_lines = np.stack((np.column_stack((lats[pairs[:, 0]], longs[pairs[:, 0]])), np.column_stack((lats[pairs[:, 1]], longs[pairs[:, 1]]))), axis=1)
+
+    # one short line per heading
+    distance = 0.0005  # Adjust distance for visual clarity on the map
+    heading_counts = np.diff(segment_graph["heading_offsets"])
+    heading_segments = np.repeat(np.arange(len(lats)), heading_counts)
+    headings_rad = np.radians(np.asarray(segment_graph["headings"]))
+    heading_starts = np.column_stack((lats[heading_segments], longs[heading_segments]))
+    heading_ends = heading_starts + distance * np.column_stack((np.cos(headings_rad), np.sin(headings_rad)))
+    heading_lines = np.stack((heading_starts, heading_ends), axis=1)
+
+    layers = [
+        ("Segments", make_point_features(lats, longs, segment_ids), {"radius": 4, "color": "red", "fill": True, "fillOpacity": 0.8}),
+        ("Segment links", make_line_features(list(link_lines), [f"{segment_ids[source]} => {segment_ids[target]}" for source, target in pairs.tolist()]), {"color": "blue", "weight": 2, "opacity": 0.5}),
+        ("Headings", make_line_features(list(heading_lines), np.asarray(segment_graph["headings"]).tolist()), {"color": "green", "weight": 2, "opacity": 0.7}),
+    ]
+
+    m = folium.Map(location=[lats.mean(), longs.mean()], zoom_start=12)
+    segment_map_save_path = f"{base_directory}/segments_map.html"
+    add_geojson_layers(m, layers, segment_map_save_path, external)
+    print(f"\tSaving segment's map to: {segment_map_save_path}")
+    m.save(segment_map_save_path)
+
 def extract_linestring_segment(line_string, coord1, coord2):
     """
     Extract a LineString segment between two coordinates, following the original LineString geometry.
     """    
 
-    # Ensure the coordinates are in (longitude, latitude) format for shapely
-    coord1 = (coord1[1], coord1[0])  # (lon, lat)
-    coord2 = (coord2[1], coord2[0])  # (lon, lat)
-
-    # Convert coordinates into Point geometries
-    point1 = Point(coord1)
-    point2 = Point(coord2)
-
     if (not line_string) or (not line_string or len(line_string.coords) < 2):
-        # we have no line string, so just return an empty line string
-        return LineString([coord1, coord2])
-
-    # Project the two coordinates onto the LineString
-    start_proj = line_string.interpolate(line_string.project(point1))
-    end_proj = line_string.interpolate(line_string.project(point2))
-
-    # Get all points along the LineString
-    coords = list(line_string.coords)
-
-    # Manually find the indices of the projected points
-    start_idx = None
-    end_idx = None
-    for i, (x, y) in enumerate(coords):
-        if (x, y) == (start_proj.x, start_proj.y):
-            start_idx = i
-        if (x, y) == (end_proj.x, end_proj.y):
-            end_idx = i
-
-    # If indices are found, extract the sublist between the two points
-    if start_idx is not None and end_idx is not None:
-        if start_idx < end_idx:
-            extracted_coords = coords[start_idx:end_idx + 1]
-        else:
-            extracted_coords = coords[end_idx:start_idx + 1][::-1]  # Reverse if the end point is before the start point
-    else:
-        # In case indices aren't found, return an empty LineString
-        extracted_coords = [coord1, coord2]
-
-    if len(extracted_coords) < 2:
-        # we dont really an extracted coords to make a line string, so just return an the basic one
-        return LineString([coord1, coord2])
-    # if len(extracted_coords.coords) < 2:
-    #     # we dont really an extracted coords to make a line string, so just return an the basic one
-    #     return LineString([coord1, coord2])
+        # we have no line string, so just return a line string between the two coordinates
+        return LineString([(coord1[1], coord1[0]), (coord2[1], coord2[0])])
 
-    # Return a new LineString that follows the original geometry between the two coordinates
-    return LineString(extracted_coords)
+    linear_reference = build_linear_reference(line_string)
+    return LineString(extract_line_string_between_coords(linear_reference, coord1, coord2))
 
 def get_raw_line_string_between_node_ids(line_string, id_1, id_2):
     lat_1, long_1 = id_1.split("_")
     lat_2, long_2 = id_2.split("_")
     return list(extract_linestring_segment(line_string, (float(lat_1), float(long_1)), (float(lat_2), float(long_2))).coords)
 
+# same as get_raw_line_string_between_node_ids, but with an edge's linear reference (built once per edge)
+# and the (lat, long) of both segments, so nothing has to be re-parsed from the segment ids
+def get_raw_line_string_between_coords(linear_reference, coord1, coord2):
+    if linear_reference is None:
+        # no line string for this edge
+        return [(coord1[1], coord1[0]), (coord2[1], coord2[0])]
+    return extract_line_string_between_coords(linear_reference, coord1, coord2)
+
 
 def write_as_csv(filepath, dict):
     df = pd.DataFrame.from_dict(dict, orient='index')
@@ -232,72 +243,32 @@ def add_link_heading_linestring_to_segment(segments, segment_id, link_id, headin
 
 
 
-# TODO-WORKING
-def get_equally_spaced_points_from_edge(edge, num_points):
+# linear_reference: the edge's linear reference if it was already built
+def get_equally_spaced_points_from_edge(edge, num_points, linear_reference=None):
     # Extract the LineString geometry from the edge data
     geometry = edge[2].get('geometry')
     if not geometry:
         # No geometry data
         return []
-    
-    line = geometry  # The LineString
-    total_length = line.length
-    
-    # Calculate distances at which to extract points
-    distances = [i * total_length / (num_points - 1) for i in range(num_points)]
-    
-    # Extract points along the LineString
-    spaced_points = [(line.interpolate(dist).y, line.interpolate(dist).x) for dist in distances]
-    
-    # Extract all vertices from the LineString
-    vertices = list(line.coords)
-    vertices_latlon = [(pt[1], pt[0]) for pt in vertices]  # Convert to (lat, lon)
-    
-    # Calculate headings to the next closest point in the vertices
-    points_with_headings = []
-    for i, spaced_point in enumerate(spaced_points):
-        lat1, lon1 = spaced_point
-        # Find the next closest point in the vertices
-        closest_vertex_index = min(
-            range(len(vertices_latlon)),
-            key=lambda i: (vertices_latlon[i][0] - lat1)**2 + (vertices_latlon[i][1] - lon1)**2
-        )
-
-        if closest_vertex_index + 1 < len(vertices_latlon):
-            next_point = vertices_latlon[closest_vertex_index + 1]
-        else:
-            next_point = vertices_latlon[closest_vertex_index]  
-        
-        # Calculate heading if there is a next point
-        if next_point:
-            lat2, lon2 = next_point
-            heading = calculate_heading(lat1, lon1, lat2, lon2)
-        else:
-            heading = None
-        
-        points_with_headings.append((lat1, lon1, heading))
-    return points_with_headings
 
+    if linear_reference is None:
+        linear_reference = build_linear_reference(geometry)
+
+    # (lat, lon, heading) for each point, heading is to the next closest vertex
+    return sample_equally_spaced_points(linear_reference, num_points)
 
-def get_total_feet_from_edge(edge):
+
+def get_total_feet_from_edge(edge, linear_reference=None):
     geometry = edge[2].get('geometry')
     if not geometry:
         # no geometry data... no locations
         return 0
 
-    line = geometry
-    length_in_feet = 0
-    flipped_line = flip_linestring_coords(line)
-    coords = list(flipped_line.coords)
-
-    # Calculate the geodesic length segment by segment
-    for i in range(len(coords) - 1):
-        start = coords[i]
-        end = coords[i + 1]
-        segment_length = geodesic(start, end).feet
-        length_in_feet += segment_length
+    if linear_reference is None:
+        linear_reference = build_linear_reference(geometry)
 
-    return length_in_feet
+    # geodesic length, vertex by vertex
+    return get_geodesic_length_feet(linear_reference)
 
 
 
@@ -315,6 +286,11 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
 
     main_line_string = LineString(geometry)  # The LineString
 
+    # cumulative distances along the edge, computed once and used for every line string within it
+    linear_reference = None
+    if not no_linestring and len(main_line_string.coords) >= 2:
+        linear_reference = build_linear_reference(main_line_string)
+
     if edge not in closed_edges:
         # we have not processed this edge yet...
         u = edge[0]
@@ -341,10 +317,10 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
         #########
         FEET_SPACING = 300
         # how many segments do we need to add?
-        total_feet = get_total_feet_from_edge(edge)
+        total_feet = get_total_feet_from_edge(edge, linear_reference)
 
         num_segments_to_add = int(total_feet // FEET_SPACING) + 2 # add 2 to account for the start and end (we just remove them later)
-        segment_locations_headings = get_equally_spaced_points_from_edge(edge, num_segments_to_add)
+        segment_locations_headings = get_equally_spaced_points_from_edge(edge, num_segments_to_add, linear_reference)
 
         # remove the first and last segment location
         segment_locations_headings = segment_locations_headings[1:-1]
@@ -353,14 +329,14 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
         if len(segment_locations_headings) == 0:
             # cant add any intermediate segments, so we must connect the u and v nodes
             # no matter what, we need to link u to v
-            line_string = get_raw_line_string_between_node_ids(main_line_string, u_key, v_key)
+            line_string = get_raw_line_string_between_coords(linear_reference, (u_lat, u_long), (v_lat, v_long))
             add_link_heading_linestring_to_segment(segments, u_key, v_key, u_heading, line_string)
 
             # segments[u_key]['segment_links'].append(v_key)
             # segments[u_key]['headings'].append(u_heading)
             if not oneway:
                 # then v can also point to u
-                line_string_reverse = get_raw_line_string_between_node_ids(main_line_string, v_key, u_key)
+                line_string_reverse = get_raw_line_string_between_coords(linear_reference, (v_lat, v_long), (u_lat, u_long))
                 add_link_heading_linestring_to_segment(segments, v_key, u_key, v_heading, line_string_reverse)
 
                 # segments[v_key]['segment_links'].append(u_key)
@@ -379,6 +355,8 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
             # default
             previous_segment = u_key
             next_segment = v_key
+            previous_coord = (u_lat, u_long)
+            next_coord = (v_lat, v_long)
 
             segment_heading = u_heading
             reverse_segment_heading = v_heading
@@ -386,12 +364,13 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
             if i != 0:
                 # previous location segment...
                 previous_segment = segment_key(segment_locations_headings[i - 1][0], segment_locations_headings[i - 1][1])
+                previous_coord = (segment_locations_headings[i - 1][0], segment_locations_headings[i - 1][1])
                 segment_heading = heading
                 reverse_segment_heading = reverse_heading(heading)
 
             else: 
                 # we are the first segment, so we need to tell node 'u' to link to us, and head to us
-                node_line_string = get_raw_line_string_between_node_ids(main_line_string, u_key, segment_key_str)
+                node_line_string = get_raw_line_string_between_coords(linear_reference, (u_lat, u_long), location)
                 add_link_heading_linestring_to_segment(segments, u_key, segment_key_str, heading, node_line_string)
                 # segments[u_key]['segment_links'].append(segment_key_str)
                 # segments[u_key]['headings'].append(heading)
@@ -401,6 +380,7 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
                 # we are not the last segment, 
                 # next location segment...
                 next_segment = segment_key(segment_locations_headings[i + 1][0], segment_locations_headings[i + 1][1])
+                next_coord = (segment_locations_headings[i + 1][0], segment_locations_headings[i + 1][1])
                 segment_heading = heading
                 reverse_segment_heading = reverse_heading(heading)
 
@@ -417,7 +397,7 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
             segment_headings.append(segment_heading)
             heading_links[segment_heading] = [next_segment]
             if not no_linestring:
-                line_strings[next_segment] = get_raw_line_string_between_node_ids(main_line_string, segment_key_str, next_segment)
+                line_strings[next_segment] = get_raw_line_string_between_coords(linear_reference, location, next_coord)
             else:
                 line_strings[next_segment] = None
 
@@ -430,7 +410,7 @@ def create_segments_from_edge(nodes, edge, segments, closed_edges):
                     # previous_lat, previous_long = previous_segment.split("_")
                     # linestring_between_us_and_previous = extract_linestring_segment(main_line_string, (lat, long), (float(previous_lat), float(previous_long)))
                     # line_strings[previous_segment] = list(linestring_between_us_and_previous.coords)
-                    line_strings[previous_segment] = get_raw_line_string_between_node_ids(main_line_string, segment_key_str, previous_segment)
+                    line_strings[previous_segment] = get_raw_line_string_between_coords(linear_reference, location, previous_coord)
                 else: 
                     line_strings[previous_segment] = None
             
@@ -488,16 +468,79 @@ def grab_store_all_segments(graph, base_directory):
     draw_segments_on_map(segments, center_lat, center_lon, base_directory)
 
 
-def store_all_nodes_at_location(location, base_directory):
+# same output as grab_store_all_segments (checked by tests/test_segment_building.py), but builds every segment at once
+# from the edges GeoDataFrame
+# map_mode: "polylines" (same segments map as grab_store_all_segments), "geojson" (draw_segments_on_map_geojson, for
+# large cities) or None (no map)
+def grab_store_all_segments_bulk(graph, base_directory, map_mode="polylines"):
+    print("\tGrabbing all segments (bulk)...")
+    segments = build_segments_from_graph(graph)
+
+    output_file = f"{base_directory}/segments.csv"
+    segments.to_csv(output_file)
+    print(f"\tSegments dataset saved to: {output_file}")
+    # binary (memory mapped) copy of the same graph
+    segment_graph_directory = get_segment_graph_directory(base_directory)
+    write_segment_graph(segments, segment_graph_directory)
+
+    if map_mode == "polylines":
+        # get points to center the folium map
+        center_lat = np.mean([lat for _, lat in graph.nodes(data="y")])
+        center_lon = np.mean([long for _, long in graph.nodes(data="x")])
+        draw_segments_on_map(segments.to_dict(orient="index"), center_lat, center_lon, base_directory)
+    elif map_mode == "geojson":
+        draw_segments_on_map_geojson(load_segment_graph(segment_graph_directory), base_directory)
+
+
+def build_segments_per_edge(graph):
+    nodes, edges = ox.graph_to_gdfs(graph)
+    segments = {}
+    add_all_nodes_to_segments(graph, nodes, segments)
+    add_edges_between_nodes_to_segments(graph, nodes, segments)
+    return segments
+
+# compares build time and peak memory of the per edge builder and the bulk builder on the same graph
+# (memory is measured in a second run, since tracemalloc slows everything down)
+def benchmark_segment_builders(graph):
+    results = {}
+
+    for name, builder in (("per_edge", build_segments_per_edge), ("bulk", build_segments_from_graph)):
+        start_time = time.perf_counter()
+        segment_count = len(builder(graph))
+        seconds = time.perf_counter() - start_time
+
+        tracemalloc.start()
+        builder(graph)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results[name] = (seconds, peak_bytes, segment_count)
+
+    print(f"\tGraph: {len(graph.nodes)} nodes, {len(graph.edges)} edges")
+    for name, (seconds, peak_bytes, segment_count) in results.items():
+        print(f"\t{name}: {seconds:.2f} seconds, {peak_bytes / 1e6:.1f} MB peak, {segment_count} segments")
+    return results
+
+
+def store_all_nodes_at_location(location, base_directory, tile_size_km=None, workers=None, osm_file=None, boundary_file=None):
     """
         Location: string representing the location to grab the nodes from
             Example: "Arlington, VA, USA"
         Name: name of directory to store the data
+        tile_size_km: if given, the location is built in tiles of this size (for metro-scale regions)
+        workers: number of processes used to build tiles
+        osm_file: local .osm/.osm.pbf extract to build from instead of live OSM services (cut to boundary_file if given,
+                  tiled builds need boundary_file)
     """
     # point = (38.89383718336061, -77.04345023818883)
 
+    if tile_size_km:
+        store_all_nodes_at_location_tiled(location, base_directory, tile_size_km, workers, osm_file, boundary_file)
+        return
+
     os.makedirs(base_directory, exist_ok=True)
-    graph = ox.graph_from_place(location, network_type='drive')
+    # cached, so rebuilding the same location does not download the network again
+    graph = load_drive_graph(location, osm_file=osm_file, boundary_file=boundary_file)
     
-    grab_store_all_segments(graph, base_directory)
+    grab_store_all_segments_bulk(graph, base_directory)
 
@@ -0,0 +1,138 @@
+# Description:
+# Shared, content-addressed store of panoramas (keyed by panoId)
+# Overlapping urban environments (ex: a city and its county) reference the same
+# tiles, panoramic, segmentation maps and metadata instead of re-downloading and re-segmenting them
+
+import os
+import json
+import shutil
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+PANORAMA_STORE_DIRECTORY = os.environ.get("PANORAMA_STORE_DIRECTORY", os.path.join(script_dir, "../panorama_store"))
+
+# file names of everything stored for a single panoId (tiles are stored as tile_<x>.jpg / tile_<x>_<y>.jpg)
+PANORAMIC_FILE = "panoramic.jpg"
+SEGMENTATION_MAP_FILE = "segmentation_map.png"
+SEGMENTATION_MAP_WITHOUT_TREES_FILE = "segmentation_map_without_trees.png"
+METADATA_FILE = "metadata.json"
+
+DEFAULT_ZOOM = 1
+
+
+# panoIds are stored per zoom level (a panoramic at zoom 1 and zoom 3 are different images)
+# and spread over sub directories (first 2 characters) so no directory gets too large
+def get_store_directory_for_pano_id(pano_id, zoom=DEFAULT_ZOOM):
+    return os.path.join(PANORAMA_STORE_DIRECTORY, f"z{zoom}", pano_id[:2], pano_id)
+
+def get_store_path(pano_id, file_name, zoom=DEFAULT_ZOOM):
+    return os.path.join(get_store_directory_for_pano_id(pano_id, zoom), file_name)
+
+# store file name -> environment path for the panoramic and its tiles
+def get_panoramic_files(base_directory, pano_id, tile_paths):
+    files = {PANORAMIC_FILE: f"{base_directory}/panoramic_imgs/{pano_id}.jpg"}
+    for tile_path in tile_paths:
+        # ex: <pano_id>_1.jpg -> tile_1.jpg
+        files[os.path.basename(tile_path).replace(pano_id, "tile", 1)] = tile_path
+    return files
+
+# store file name -> environment path for both segmentation maps
+def get_segmentation_map_files(base_directory, pano_id):
+    return {
+        SEGMENTATION_MAP_FILE: f"{base_directory}/segmentation_maps/{pano_id}.png",
+        SEGMENTATION_MAP_WITHOUT_TREES_FILE: f"{base_directory}/segmentation_maps_without_trees/{pano_id}.png",
+    }
+
+
+def has_panoramic_in_store(pano_id, zoom=DEFAULT_ZOOM):
+    return os.path.exists(get_store_path(pano_id, PANORAMIC_FILE, zoom))
+
+def has_segmentation_maps_in_store(pano_id, zoom=DEFAULT_ZOOM):
+    return (os.path.exists(get_store_path(pano_id, SEGMENTATION_MAP_FILE, zoom))
+            and os.path.exists(get_store_path(pano_id, SEGMENTATION_MAP_WITHOUT_TREES_FILE, zoom)))
+
+
+def read_metadata(pano_id, zoom=DEFAULT_ZOOM):
+    metadata_path = get_store_path(pano_id, METADATA_FILE, zoom)
+    if not os.path.exists(metadata_path):
+        return {}
+    with open(metadata_path, "r") as file:
+        return json.load(file)
+
+def write_metadata(pano_id, metadata, zoom=DEFAULT_ZOOM):
+    os.makedirs(get_store_directory_for_pano_id(pano_id, zoom), exist_ok=True)
+    metadata_path = get_store_path(pano_id, METADATA_FILE, zoom)
+    # write to a temp file first so an interrupted run never leaves half a json file
+    temp_path = metadata_path + ".tmp"
+    with open(temp_path, "w") as file:
+        json.dump(metadata, file)
+    os.replace(temp_path, metadata_path)
+
+def update_metadata(pano_id, new_metadata, zoom=DEFAULT_ZOOM):
+    metadata = read_metadata(pano_id, zoom)
+    metadata.update(new_metadata)
+    write_metadata(pano_id, metadata, zoom)
+
+
+# links a stored file into an environment (hard link, so no extra disk space), copies if linking is not possible
+def link_file(source_path, destination_path):
+    if os.path.exists(destination_path):
+        if os.path.samefile(source_path, destination_path):
+            return
+        os.remove(destination_path)
+    os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        # ex: store and data directory are on different drives
+        shutil.copyfile(source_path, destination_path)
+
+
+def add_environment_reference(pano_id, base_directory, zoom=DEFAULT_ZOOM):
+    metadata = read_metadata(pano_id, zoom)
+    environment_name = os.path.basename(os.path.normpath(base_directory))
+    references = metadata.get("environments", [])
+    if environment_name not in references:
+        references.append(environment_name)
+        metadata["environments"] = references
+        write_metadata(pano_id, metadata, zoom)
+
+
+# moves the given environment files into the store, and links them back into the environment
+def add_files_to_store(pano_id, base_directory, files, zoom=DEFAULT_ZOOM):
+    os.makedirs(get_store_directory_for_pano_id(pano_id, zoom), exist_ok=True)
+
+    for file_name, environment_path in files.items():
+        store_path = get_store_path(pano_id, file_name, zoom)
+        if not os.path.exists(store_path):
+            shutil.copyfile(environment_path, store_path + ".tmp")
+            os.replace(store_path + ".tmp", store_path)
+        link_file(store_path, environment_path)
+
+    add_environment_reference(pano_id, base_directory, zoom)
+
+# links the given stored files into the environment, returns False if any of them are missing
+def link_files_from_store(pano_id, base_directory, files, zoom=DEFAULT_ZOOM):
+    for file_name in files:
+        if not os.path.exists(get_store_path(pano_id, file_name, zoom)):
+            return False
+
+    for file_name, environment_path in files.items():
+        link_file(get_store_path(pano_id, file_name, zoom), environment_path)
+
+    add_environment_reference(pano_id, base_directory, zoom)
+    return True
+
+
+def add_panoramic_to_store(pano_id, base_directory, tile_paths, metadata=None, zoom=DEFAULT_ZOOM):
+    add_files_to_store(pano_id, base_directory, get_panoramic_files(base_directory, pano_id, tile_paths), zoom)
+    if metadata:
+        update_metadata(pano_id, metadata, zoom)
+
+def link_panoramic_from_store(pano_id, base_directory, tile_paths, zoom=DEFAULT_ZOOM):
+    return link_files_from_store(pano_id, base_directory, get_panoramic_files(base_directory, pano_id, tile_paths), zoom)
+
+def add_segmentation_maps_to_store(pano_id, base_directory, zoom=DEFAULT_ZOOM):
+    add_files_to_store(pano_id, base_directory, get_segmentation_map_files(base_directory, pano_id), zoom)
+
+def link_segmentation_maps_from_store(pano_id, base_directory, zoom=DEFAULT_ZOOM):
+    return link_files_from_store(pano_id, base_directory, get_segmentation_map_files(base_directory, pano_id), zoom)
@@ -0,0 +1,227 @@
+# Description:
+# Resumable build pipeline for an urban environment
+# The steps of create_urban_environment (segments, panoramics, segmentation maps) and the glare datasets/maps built on
+# them are stages of a dependency graph. A finished stage leaves a marker (<base>/pipeline/<stage>.json) with the
+# fingerprint of its inputs (its parameters and the fingerprints of the stages it depends on) and the size and
+# modification time of its outputs, so a restart skips every stage whose inputs did not change and whose outputs are
+# still there untouched, and reruns everything downstream of a stage that reruns.
+# Stages resume inside themselves too: panoramic_data.csv is checkpointed while downloading and segmentation maps are
+# only written when complete, so an interrupted stage continues where it stopped.
+# Segmentation streams from the panoramic download: each panoramic is segmented (in a worker thread) as soon as it is
+# saved, while the next ones download.
+
+import os
+import json
+import time
+import queue
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+PIPELINE_DIRECTORY = "pipeline"
+STAGE_DONE = object()
+
+
+def get_marker_path(base_directory, stage_name):
+    return f"{base_directory}/{PIPELINE_DIRECTORY}/{stage_name.replace(':', '_')}.json"
+
+def read_marker(base_directory, stage_name):
+    marker_path = get_marker_path(base_directory, stage_name)
+    if not os.path.exists(marker_path):
+        return None
+    with open(marker_path, "r") as file:
+        return json.load(file)
+
+def write_marker(base_directory, stage_name, fingerprint, parameters, seconds, outputs=None):
+    marker_path = get_marker_path(base_directory, stage_name)
+    os.makedirs(os.path.dirname(marker_path), exist_ok=True)
+    marker = {"stage": stage_name, "fingerprint": fingerprint, "parameters": parameters, "outputs": outputs or {}, "seconds": seconds,
+              "completed_at": datetime.now(timezone.utc).isoformat()}
+    # write to a temp file first so an interrupted run never leaves a marker for a stage that did not finish
+    with open(marker_path + ".tmp", "w") as file:
+        json.dump(marker, file, indent=2, default=str)
+    os.replace(marker_path + ".tmp", marker_path)
+
+# size and modification time of an input file (None if it does not exist)
+def get_file_fingerprint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return {"path": os.path.abspath(path), "size": os.path.getsize(path), "modified": os.path.getmtime(path)}
+
+# a directory output is summarized by its files (count, total size, latest modification)
+def get_output_fingerprint(path):
+    if not os.path.isdir(path):
+        return get_file_fingerprint(path)
+    sizes = []
+    modified = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                sizes.append(stat.st_size)
+                modified.append(stat.st_mtime)
+    return {"path": os.path.abspath(path), "files": len(sizes), "size": sum(sizes), "modified": max(modified, default=None)}
+
+def get_stage_outputs(stage):
+    return {path: get_output_fingerprint(path) for path in stage.get("outputs", [])}
+
+# a stage reruns when its inputs changed, or an output is missing or changed since it finished (ex: deleted or edited)
+def is_stage_out_of_date(stage, marker, fingerprint):
+    if marker is None or marker["fingerprint"] != fingerprint:
+        return True
+    outputs = get_stage_outputs(stage)
+    # json round trip, like the marker's copy
+    return any(output is None for output in outputs.values()) or marker.get("outputs", {}) != json.loads(json.dumps(outputs))
+
+def get_stage_fingerprint(stage, dependency_fingerprints):
+    key = {"stage": stage["name"], "parameters": stage["parameters"], "dependencies": dependency_fingerprints}
+    return hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+# stage: {"name", "dependencies": [stage names], "parameters": {...} (fingerprinted), "run": run(emit),
+#         optional "outputs": [files or directories the stage writes], "stream_from": stage name and "consume": consume(item)}
+# run(emit) does the whole stage, emit(item) (None if nothing streams from it) hands items to streaming stages
+# a streaming stage consumes the items of its source while the source runs, then runs normally (catching up on anything
+# it did not get, ex: items from an earlier run)
+def get_stage_order(stages):
+    stage_names = {stage["name"] for stage in stages}
+    ordered = []
+    done = set()
+    remaining = list(stages)
+    while remaining:
+        ready = [stage for stage in remaining if all(dependency in done for dependency in stage["dependencies"])]
+        if not ready:
+            missing = {dependency for stage in remaining for dependency in stage["dependencies"] if dependency not in stage_names}
+            raise ValueError(f"Pipeline stages have a cycle or missing dependencies: {sorted(missing) or [stage['name'] for stage in remaining]}")
+        for stage in ready:
+            ordered.append(stage)
+            done.add(stage["name"])
+            remaining.remove(stage)
+    return ordered
+
+def start_stream_consumer(stage, stop):
+    items = queue.Queue()
+    errors = []
+
+    def consume_items():
+        while True:
+            item = items.get()
+            if item is STAGE_DONE:
+                return
+            if errors or stop.is_set():
+                continue
+            try:
+                stage["consume"](item)
+            except Exception as error:
+                # stop consuming, the error is raised once the source stage finishes
+                errors.append(error)
+
+    thread = threading.Thread(target=consume_items, name=f"{stage['name']}-stream", daemon=True)
+    thread.start()
+    return items, thread, errors
+
+# runs every stage whose marker is missing or out of date, force: stage names to rerun anyway
+def run_pipeline(base_directory, stages, force=()):
+    start_time = time.perf_counter()
+    ordered = get_stage_order(stages)
+    fingerprints = {}
+    pending = set()
+    for stage in ordered:
+        fingerprints[stage["name"]] = get_stage_fingerprint(stage, {dependency: fingerprints[dependency] for dependency in stage["dependencies"]})
+        marker = read_marker(base_directory, stage["name"])
+        # everything downstream of a stage that reruns reruns too (its inputs are rebuilt)
+        if (stage["name"] in force or any(dependency in pending for dependency in stage["dependencies"])
+                or is_stage_out_of_date(stage, marker, fingerprints[stage["name"]])):
+            pending.add(stage["name"])
+
+    for stage in ordered:
+        if stage["name"] not in pending:
+            print(f"\tStage {stage['name']} already done, skipping")
+            continue
+
+        # streaming stages that still have to run consume this stage's items while it runs
+        stop = threading.Event()
+        consumers = [(consumer, *start_stream_consumer(consumer, stop)) for consumer in ordered
+                     if consumer.get("stream_from") == stage["name"] and consumer["name"] in pending]
+        emit = None
+        if consumers:
+            def emit(item):
+                for _, items, _, _ in consumers:
+                    items.put(item)
+
+        print(f"\tRunning stage {stage['name']}" + (f" (streaming to {', '.join(consumer['name'] for consumer, *_ in consumers)})" if consumers else ""))
+        stage_start_time = time.perf_counter()
+        try:
+            stage["run"](emit)
+        except BaseException:
+            # the consumers skip what is left in their queues, the next run picks it up
+            stop.set()
+            raise
+        finally:
+            for consumer, items, thread, _ in consumers:
+                items.put(STAGE_DONE)
+                thread.join()
+
+        seconds = time.perf_counter() - stage_start_time
+        write_marker(base_directory, stage["name"], fingerprints[stage["name"]], stage["parameters"], seconds, get_stage_outputs(stage))
+        print(f"\tStage {stage['name']} done in {seconds:.1f} seconds")
+        # the source stage finished, a failed consumer stage is left without a marker
+        for consumer, _, _, errors in consumers:
+            if errors:
+                raise errors[0]
+
+    print(f"\tPipeline done in {time.perf_counter() - start_time:.1f} seconds ({len(pending)} of {len(ordered)} stages run)")
+
+
+# stages of create_urban_environment, plus a glare dataset and map for every date_time (UTC)
+# the API key is not fingerprinted (it does not change what is built), heavy modules are imported by the stage using them
+def make_environment_stages(location, base_directory, api_key, zoom=1, date_times=(), tile_size_km=None, workers=None, osm_file=None, boundary_file=None):
+    def run_segments(emit):
+        from NodeGrabbing import store_all_nodes_at_location
+        store_all_nodes_at_location(location, base_directory, tile_size_km, workers, osm_file, boundary_file)
+
+    def run_panoramics(emit):
+        from TileGrabbing import grab_tiles_given_directory
+        grab_tiles_given_directory(base_directory, api_key, zoom, on_panoramic_saved=emit)
+
+    def consume_panoramic(item):
+        from ImageProcessing import create_both_segmentation_maps_for_panoramic
+        pano_id, pano_zoom = item
+        create_both_segmentation_maps_for_panoramic(base_directory, pano_id, pano_zoom)
+
+    def run_segmentation(emit):
+        # catches every panoramic not segmented while streaming (skips the ones that were)
+        from ImageProcessing import create_both_segmentation_maps
+        create_both_segmentation_maps(base_directory)
+
+    stages = [
+        {"name": "segments", "dependencies": [], "run": run_segments,
+         "parameters": {"location": location, "tile_size_km": tile_size_km, "workers": workers, "osm_file": get_file_fingerprint(osm_file), "boundary_file": get_file_fingerprint(boundary_file)},
+         "outputs": [f"{base_directory}/segments.csv"]},
+        {"name": "panoramics", "dependencies": ["segments"], "run": run_panoramics, "parameters": {"zoom": zoom},
+         "outputs": [f"{base_directory}/panoramic_data.csv", f"{base_directory}/panoramic_imgs"]},
+        {"name": "segmentation", "dependencies": ["panoramics"], "run": run_segmentation, "parameters": {},
+         "outputs": [f"{base_directory}/segmentation_maps", f"{base_directory}/segmentation_maps_without_trees"],
+         "stream_from": "panoramics", "consume": consume_panoramic},
+    ]
+
+    for date_time in date_times:
+        date_string = date_time.strftime("%Y-%m-%d_%H-%M-%S")
+
+        def run_glare(emit, date_time=date_time):
+            from SunGlareDetectionFunctions import calculate_sun_glare_for_panoramic_data_at_date_time
+            calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_time)
+
+        def run_map(emit, date_time=date_time):
+            from VisualizationFunctions import create_sun_glare_map
+            create_sun_glare_map(base_directory, date_time)
+
+        stages.append({"name": f"glare:{date_string}", "dependencies": ["segmentation"], "run": run_glare, "parameters": {"date_time": date_string},
+                       "outputs": [f"{base_directory}/sun_glare_data_{date_string}.csv"]})
+        stages.append({"name": f"map:{date_string}", "dependencies": [f"glare:{date_string}"], "run": run_map, "parameters": {"date_time": date_string},
+                       "outputs": [f"{base_directory}/sun_glare_map_{date_string}.html"]})
+    return stages
+
+def run_environment_pipeline(location, base_directory, api_key, zoom=1, date_times=(), force=(), **segment_options):
+    os.makedirs(base_directory, exist_ok=True)
+    run_pipeline(base_directory, make_environment_stages(location, base_directory, api_key, zoom, date_times, **segment_options), force)
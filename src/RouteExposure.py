@@ -0,0 +1,183 @@
+# Description:
+# Glare exposure timeline along a driven route
+# A route (node path from the routing code, or a GPS polyline) is timed from its departure time, sampled every second,
+# snapped to the closest panorama and to that panorama's segment heading closest to the heading actually driven, and
+# every sample of every route is evaluated for sun glare in one batch (calculate_sun_glare_batch, numpy sun positions for
+# all of the seconds at once)
+
+import time
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+from LinearReferencing import calculate_headings, geod
+from GlareRouting import add_travel_times, get_utc_date_time, DEFAULT_SPEED_KPH
+from SegmentGraph import has_segment_graph, convert_segments_csv_to_segment_graph, load_segment_graph, get_segment_graph_directory, get_segment_indices
+from SunGlareDetectionFunctions import calculate_sun_glare_batch
+from VisualizationFunctions import get_closest_segment_headings, convert_anti_clockwise_east_headings_to_clockwise_north
+
+# samples farther than this from every panorama have no glare data
+MAX_PANORAMA_DISTANCE_METERS = 25
+METERS_PER_DEGREE_LAT = 110540
+METERS_PER_DEGREE_LONG_AT_EQUATOR = 111320
+
+
+# (longs, lats, seconds since departure) of every vertex along a node path
+# graph must already have travel times (add_travel_times)
+# node_times: time each node is reached (ex: from time_dependent_shortest_path), otherwise edge travel times are used
+def get_route_polyline_from_nodes(graph, route, node_times=None):
+    longs = [graph.nodes[route[0]]["x"]]
+    lats = [graph.nodes[route[0]]["y"]]
+    seconds = [0.0]
+    for position, (u, v) in enumerate(zip(route[:-1], route[1:])):
+        # the parallel edge a router would take
+        data = min(graph.get_edge_data(u, v).values(), key=lambda edge_data: edge_data["travel_time"])
+        if "geometry" in data:
+            coords = np.asarray(data["geometry"].coords, dtype=float)[:, :2]
+        else:
+            coords = np.array([[graph.nodes[u]["x"], graph.nodes[u]["y"]], [graph.nodes[v]["x"], graph.nodes[v]["y"]]])
+
+        if node_times is not None:
+            start_second = (node_times[position] - node_times[0]).total_seconds()
+            edge_seconds = (node_times[position + 1] - node_times[0]).total_seconds() - start_second
+        else:
+            start_second = seconds[-1]
+            edge_seconds = data["travel_time"]
+
+        # time spread along the edge by distance
+        distances = np.concatenate(([0.0], np.cumsum(np.hypot(*np.diff(coords, axis=0).T))))
+        fractions = distances / distances[-1] if distances[-1] > 0 else np.linspace(0, 1, len(coords))
+        longs.extend(coords[1:, 0].tolist())
+        lats.extend(coords[1:, 1].tolist())
+        seconds.extend((start_second + fractions[1:] * edge_seconds).tolist())
+    return np.array(longs), np.array(lats), np.array(seconds)
+
+# (longs, lats, seconds since departure) of a GPS polyline [(lat, long), ...], driven at speed_kph unless point_seconds
+# (seconds since departure of every point) are given
+def get_route_polyline_from_gps(points, speed_kph=DEFAULT_SPEED_KPH, point_seconds=None):
+    points = np.asarray(points, dtype=float)
+    lats = points[:, 0]
+    longs = points[:, 1]
+    if point_seconds is None:
+        _, _, distances = geod.inv(longs[:-1], lats[:-1], longs[1:], lats[1:])
+        point_seconds = np.concatenate(([0.0], np.cumsum(distances))) / (speed_kph / 3.6)
+    return longs, lats, np.asarray(point_seconds, dtype=float)
+
+
+# position and driving heading (clockwise from north) every second from departure to arrival
+def sample_route_per_second(longs, lats, seconds):
+    # drop vertices that do not move forward in time (np.interp needs increasing times)
+    keep = np.concatenate(([True], np.diff(seconds) > 0))
+    longs, lats, seconds = longs[keep], lats[keep], seconds[keep]
+    if len(seconds) < 2:
+        return np.zeros(1), lats[:1], longs[:1], np.full(1, np.nan)
+
+    sample_seconds = np.arange(0, np.floor(seconds[-1]) + 1)
+    sample_lats = np.interp(sample_seconds, seconds, lats)
+    sample_longs = np.interp(sample_seconds, seconds, longs)
+    # heading of the piece of the route being driven
+    pieces = np.clip(np.searchsorted(seconds, sample_seconds, side="right") - 1, 0, len(seconds) - 2)
+    headings = calculate_headings(lats[pieces], longs[pieces], lats[pieces + 1], longs[pieces + 1])
+    return sample_seconds, sample_lats, sample_longs, headings
+
+
+# panoramas of an environment with a KD tree (local meters) to snap samples to them
+def build_panorama_index(base_directory):
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv")
+    if not has_segment_graph(base_directory):
+        convert_segments_csv_to_segment_graph(base_directory)
+    segment_graph = load_segment_graph(get_segment_graph_directory(base_directory))
+
+    origin_lat = panoramic_data["lat"].mean()
+    long_scale = METERS_PER_DEGREE_LONG_AT_EQUATOR * np.cos(np.radians(origin_lat))
+    origin_long = panoramic_data["long"].mean()
+
+    def to_meters(lats, longs):
+        return np.column_stack(((np.asarray(longs) - origin_long) * long_scale, (np.asarray(lats) - origin_lat) * METERS_PER_DEGREE_LAT))
+
+    return {
+        "panoramic_data": panoramic_data,
+        "segment_graph": segment_graph,
+        "segment_indices": get_segment_indices(segment_graph, panoramic_data["segment_id"].astype(str)),
+        "tree": cKDTree(to_meters(panoramic_data["lat"], panoramic_data["long"])),
+        "to_meters": to_meters,
+    }
+
+# panorama position (in panoramic_data) of every sample, -1 when none is close enough
+def snap_samples_to_panoramas(panorama_index, lats, longs, max_distance=MAX_PANORAMA_DISTANCE_METERS):
+    distances, positions = panorama_index["tree"].query(panorama_index["to_meters"](lats, longs), distance_upper_bound=max_distance)
+    return np.where(np.isfinite(distances), positions, -1)
+
+
+# routes: node paths (route_type="nodes", needs graph) or GPS polylines [(lat, long), ...] (route_type="gps")
+# departure_times: one datetime per route (naive is UTC), node_times: optional list (per route) of node arrival datetimes
+# returns (per second profile of every route, one summary row per route)
+def evaluate_route_exposures(base_directory, routes, departure_times, graph=None, route_type="nodes", node_times=None, speed_kph=DEFAULT_SPEED_KPH, panorama_index=None):
+    start_time = time.perf_counter()
+    if panorama_index is None:
+        panorama_index = build_panorama_index(base_directory)
+    # speeds and travel times are added once for all the routes
+    if route_type == "nodes":
+        graph = add_travel_times(graph)
+
+    # every second of every route in one table
+    samples = []
+    for route_number, (route, departure_time) in enumerate(zip(routes, departure_times)):
+        if route_type == "nodes":
+            polyline = get_route_polyline_from_nodes(graph, route, node_times[route_number] if node_times is not None else None)
+        else:
+            polyline = get_route_polyline_from_gps(route, speed_kph)
+        sample_seconds, lats, longs, headings = sample_route_per_second(*polyline)
+        samples.append(pd.DataFrame({"route": route_number, "second": sample_seconds.astype(int), "timestamp": get_utc_date_time(departure_time).timestamp() + sample_seconds,
+                                     "lat": lats, "long": longs, "heading": headings}))
+    profiles = pd.concat(samples, ignore_index=True)
+
+    # closest panorama, and its segment heading closest to the driven heading
+    pano_positions = snap_samples_to_panoramas(panorama_index, profiles["lat"].to_numpy(), profiles["long"].to_numpy())
+    has_panorama = pano_positions >= 0
+    segment_indices = np.where(has_panorama, panorama_index["segment_indices"][np.maximum(pano_positions, 0)], -1)
+    segment_headings = get_closest_segment_headings(panorama_index["segment_graph"], segment_indices, profiles["heading"].to_numpy())
+    evaluated = np.flatnonzero(has_panorama & ~np.isnan(segment_headings))
+
+    # segment headings are clockwise from north, glare uses anticlockwise from east (the conversion is its own inverse)
+    anticlockwise_headings = convert_anti_clockwise_east_headings_to_clockwise_north(segment_headings[evaluated])
+    pano_rows = panorama_index["panoramic_data"].iloc[pano_positions[evaluated]]
+    has_sun_glare, angle_risk, blockage_type = calculate_sun_glare_batch(base_directory, pano_rows, anticlockwise_headings, profiles["timestamp"].to_numpy()[evaluated])
+
+    profiles["pano_id"] = None
+    profiles.loc[evaluated, "pano_id"] = pano_rows["pano_id"].to_numpy()
+    profiles["segment_heading"] = segment_headings
+    profiles["evaluated"] = False
+    profiles.loc[evaluated, "evaluated"] = True
+    profiles["angle_risk"] = False
+    profiles.loc[evaluated, "angle_risk"] = angle_risk
+    profiles["has_sun_glare"] = False
+    profiles.loc[evaluated, "has_sun_glare"] = has_sun_glare
+    profiles["blockage_type"] = "none"
+    profiles.loc[evaluated, "blockage_type"] = blockage_type
+    profiles["time"] = pd.to_datetime(profiles["timestamp"], unit="s", utc=True)
+
+    summary = summarize_route_exposures(profiles)
+    print(f"\tEvaluated {len(routes)} routes ({len(profiles)} seconds, {len(evaluated)} near a panorama) in {time.perf_counter() - start_time:.2f} seconds")
+    return profiles, summary
+
+
+# per route: duration, seconds with glare data, glare seconds, longest continuous glare and when glare first starts
+def summarize_route_exposures(profiles):
+    glare = profiles["has_sun_glare"].to_numpy()
+    routes = profiles["route"].to_numpy()
+    # consecutive glare seconds (within a route) share a run id
+    run_starts = glare & np.concatenate(([True], ~glare[:-1] | (routes[1:] != routes[:-1])))
+    run_ids = np.cumsum(run_starts)
+    run_lengths = pd.Series(glare).groupby([routes, np.where(glare, run_ids, 0)]).sum()
+    run_lengths = run_lengths[run_lengths.index.get_level_values(1) > 0]
+
+    grouped = profiles.groupby("route")
+    summary = pd.DataFrame({
+        "duration_seconds": grouped["second"].max() + 1,
+        "evaluated_seconds": grouped["evaluated"].sum(),
+        "glare_seconds": grouped["has_sun_glare"].sum(),
+        "first_glare_second": profiles[profiles["has_sun_glare"]].groupby("route")["second"].min(),
+        "longest_glare_seconds": run_lengths.groupby(level=0).max(),
+    })
+    summary["longest_glare_seconds"] = summary["longest_glare_seconds"].fillna(0).astype(int)
+    return summary
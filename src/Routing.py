@@ -4,6 +4,8 @@ import pandas as pd
 from geopy.distance import geodesic
 import os
 import matplotlib.pyplot as plt
+from GraphLoading import load_drive_graph
+from GlareRouting import add_glare_weights, route_fastest_and_glare_avoiding
 
 # Load sun glare data
 
@@ -17,42 +19,17 @@ sun_glare_df = pd.read_csv(sun_glare_data_path)
 
 # load the road network
 place_name = "washington, dc, usa"  # Replace with your desired location
-G = ox.graph_from_place(place_name, network_type="drive")
+# cached after the first run (pass osm_file= to build it from a local extract instead)
+G = load_drive_graph(place_name)
 
-# create a glare penalty
-GLARE_PENALTY = 3  
-
-
-# function to find nearest node
-def nearest_node(graph, lat, lon):
-    return ox.distance.nearest_nodes(graph, lon, lat)
-
-# mark edges with glare risk
-def add_glare_penalty(graph, glare_df):
-    for _, row in glare_df.iterrows():
-        node = nearest_node(graph, row["lat"], row["long"])
-        for _, _, data in graph.edges(node, data=True):
-            if row["has_sun_glare"]:
-                # add penalty weight for edges with glare
-                data["weight"] = data.get("weight", 1) * GLARE_PENALTY  
-            else:
-                data["weight"] = data.get("weight", 1)
-    return graph
-
-# add sun glare penalties to the graph
-G_glare_penalized = add_glare_penalty(G, sun_glare_df)
+# snap every glare row at once and add a separate glare weight to each edge (the lengths are not changed)
+G, timings = add_glare_weights(G, sun_glare_df)
 
 origin_point = (38.887207850686245, -77.01517876315336)  
 destination_point = (38.901044444849354, -77.04488235444373) 
 
-origin_node = nearest_node(G, *origin_point)
-destination_node = nearest_node(G, *destination_point)
-
-# fastest route 
-fastest_route = nx.shortest_path(G, source=origin_node, target=destination_node, weight="length")
-
-# sun glare avoidance route
-glare_avoidance_route = nx.shortest_path(G_glare_penalized, source=origin_node, target=destination_node, weight="weight")
+# fastest route and sun glare avoidance route
+fastest_route, glare_avoidance_route = route_fastest_and_glare_avoiding(G, origin_point, destination_point)
 
 # plot the routes using osmnx
 fig, ax = ox.plot_graph_routes(
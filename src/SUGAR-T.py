@@ -1,46 +1,66 @@
 import os
-from NodeGrabbing import store_all_nodes_at_location
-from TileGrabbing import grab_tiles_given_directory
-from ImageProcessing import create_both_segmentation_maps
-from SunGlareDetectionFunctions import calculate_sun_glare_for_panoramic_data_at_date_time
-from datetime import datetime, timezone
-from VisualizationFunctions import create_sun_glare_map
-from TileGrabbing import crop_both_tile_images, combine_panoramic_tiles
+import sys
+import time
+import argparse
+import importlib
+from datetime import datetime, timedelta, timezone
+
+# heavy modules (torch/transformers through ImageProcessing, osmnx, folium...) are imported by the command that needs
+# them, so listing environments or printing help starts instantly
+CLI_START_TIME = time.perf_counter()
+MODULE_IMPORT_TIMES = {}
+DATE_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+API_KEY_ENVIRONMENT_VARIABLE = "GOOGLE_MAPS_API_KEY"
+
+
+def import_timed(module_name):
+    start_time = time.perf_counter()
+    module = importlib.import_module(module_name)
+    if module_name not in MODULE_IMPORT_TIMES:
+        MODULE_IMPORT_TIMES[module_name] = time.perf_counter() - start_time
+    return module
+
+def get_data_directory():
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(script_dir, "../data")
+
+def get_environment_name(location):
+    return location.replace(", ", "_").replace(" ", "_").lower()
+
+# date and UTC time in the format YYYY-MM-DD-HH-MM-SS
+def parse_date_time(date_time_str):
+    y, m, d, h, min, s = date_time_str.split("-")
+    return datetime(int(y), int(m), int(d), int(h), int(min), int(s), tzinfo=timezone.utc)
+
 
 # pass in a directory name and a time, and calculate the sun glare
-def calculate_sun_glare_for_directory_name_at_time(directory_name, date_time):
+def calculate_sun_glare_for_directory_name_at_time(directory_name, date_time, create_map=True):
+    SunGlareDetectionFunctions = import_timed("SunGlareDetectionFunctions")
 
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_directory = os.path.join(script_dir, "../data", directory_name)
-    calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_time)
+    base_directory = os.path.join(get_data_directory(), directory_name)
+    SunGlareDetectionFunctions.calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_time)
 
     # after calculating sun glare, create a map
-    create_sun_glare_map(base_directory, date_time)
-    
+    if create_map:
+        import_timed("VisualizationFunctions").create_sun_glare_map(base_directory, date_time)
+
 
-def create_urban_environment(location, api_key):
+# builds the environment with the resumable pipeline (Pipeline.py): stages that already finished are skipped, and glare
+# datasets/maps are added for every date_time
+def create_urban_environment(location, api_key, zoom=1, date_times=(), force=()):
     try:
         print('Starting Tool...')
-        name = location.replace(", ", "_").replace(" ", "_").lower()
+        name = get_environment_name(location)
 
-        
-        print(f"Starting process to detect sun glare in {location}")
-
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        base_directory = os.path.join(script_dir, "../data", name)
 
-        os.makedirs(base_directory, exist_ok=True)
-
-        print("First step: get all segments we will use to detect sun glare")
-        store_all_nodes_at_location(location, base_directory)
+        print(f"Starting process to detect sun glare in {location}")
 
-        print("Next step: grab all images needed from Google Street View")
-        grab_tiles_given_directory(base_directory, api_key)
+        base_directory = os.path.join(get_data_directory(), name)
 
-        print("Now, Create 2 segmentation maps for each image, one with trees, and one without trees")
-        create_both_segmentation_maps(base_directory)
+        print("Segments, Street View images and segmentation maps (segmented while the images download)")
+        import_timed("Pipeline").run_environment_pipeline(location, base_directory, api_key, zoom, date_times, force)
     except KeyboardInterrupt:
-        print("Keyboard interrupt detected. Exiting...")
+        print("Keyboard interrupt detected. Run again to resume where it stopped. Exiting...")
         exit()
 
 
@@ -61,15 +81,16 @@ def ask_for_location():
 
 def ask_for_date_time():
     date_time_str = input("Enter the date and UTC time in the format (YYYY-MM-DD-HH-MM-SS): ")
-    y, m, d, h, min, s = date_time_str.split("-")
+    return parse_date_time(date_time_str)
 
-    return datetime(int(y), int(m), int(d), int(h), int(min), int(s), tzinfo=timezone.utc)
+def get_urban_environment_names():
+    data_directory = get_data_directory()
+    if not os.path.isdir(data_directory):
+        return []
+    return sorted(os.listdir(data_directory))
 
 def check_valid_urban_environment_name(name):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_directory = os.path.join(script_dir, "../data")
-    data_directories = os.listdir(base_directory)
-    return name in data_directories
+    return name in get_urban_environment_names()
 
 def handle_create_sun_glare_dataset():
     # user wants to create a sun glare dataset
@@ -84,27 +105,27 @@ def handle_create_sun_glare_dataset():
         # valid urban environment name
         print("Creating sun glare dataset for urban environment...")
         calculate_sun_glare_for_directory_name_at_time(urban_environment, date_time_str)
-    
+
 
 def check_urban_environment_already_created(name):
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_directory = os.path.join(script_dir, "../data")
-    data_directories = os.listdir(base_directory)
-    return name in data_directories
+    return name in get_urban_environment_names()
 
 def handle_view_created_urban_environments():
     # show all the created urban environments (every folder in the data directory)
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    base_directory = os.path.join(script_dir, "../data")
-    data_directories = os.listdir(base_directory)
     print("Urban Environments:")
-    for directory in data_directories:
+    for directory in get_urban_environment_names():
         print(f"\t{directory}")
 
 def ask_for_api_key():
     api_key = input("Enter your Google Maps Platoform API key: ")
     return api_key
 
+def ask_for_zoom():
+    zoom_str = input("Enter the Street View zoom level (0-5, lower is faster, higher has more detail) [1]: ")
+    if zoom_str.strip() == "":
+        return 1
+    return int(zoom_str)
+
 def handle_create_urban_environment():
     print("Creating urban environment...")
     location = ask_for_location()
@@ -112,10 +133,11 @@ def handle_create_urban_environment():
         print(f"Urban environment for {location} already exists.")
         return
     api_key = ask_for_api_key()
+    zoom = ask_for_zoom()
 
-    # create the urban environment    
+    # create the urban environment
     print(f"Creating urban environment for {location}")
-    create_urban_environment(location, api_key)
+    create_urban_environment(location, api_key, zoom)
 
 
 
@@ -141,10 +163,127 @@ def run_main_interface():
             handle_view_created_urban_environments()
         else:
             print("Invalid command. Please try again.")
-        
 
 
-if __name__ == '__main__':
-    run_main_interface()
-    
+# Non-interactive commands (every prompt of the menu is a flag)
+#   list
+#   create-environment "Arlington, VA, USA" [--api-key KEY] [--zoom 1] [--glare-time T ...]   (API key defaults to $GOOGLE_MAPS_API_KEY)
+#   glare arlington_va_usa --time 2024-06-12-23-00-00 [--no-map]
+#   sweep arlington_va_usa --start 2024-06-12-12-00-00 --end 2024-06-12-23-00-00 [--step-minutes 60] [--png]
+#   map arlington_va_usa --time 2024-06-12-23-00-00 [--mode polylines|geojson] [--png]
+def get_base_directory_for_command(environment):
+    if not check_valid_urban_environment_name(environment):
+        sys.exit(f"Urban environment {environment} does not exist (see the list command)")
+    return os.path.join(get_data_directory(), environment)
+
+def run_list_command(args):
+    handle_view_created_urban_environments()
 
+def run_create_environment_command(args):
+    api_key = args.api_key or os.environ.get(API_KEY_ENVIRONMENT_VARIABLE)
+    if not api_key:
+        sys.exit(f"No API key, pass --api-key or set {API_KEY_ENVIRONMENT_VARIABLE}")
+    if check_urban_environment_already_created(get_environment_name(args.location)) and not args.force:
+        sys.exit(f"Urban environment for {args.location} already exists (use --force to continue building it)")
+    create_urban_environment(args.location, api_key, args.zoom, args.glare_time, args.rerun)
+
+def run_glare_command(args):
+    get_base_directory_for_command(args.environment)
+    calculate_sun_glare_for_directory_name_at_time(args.environment, args.time, create_map=not args.no_map)
+
+def run_sweep_command(args):
+    base_directory = get_base_directory_for_command(args.environment)
+    date_times = []
+    date_time = args.start
+    while date_time <= args.end:
+        date_times.append(date_time)
+        date_time += timedelta(minutes=args.step_minutes)
+
+    for date_time in date_times:
+        print(f"Calculating sun glare at {date_time}")
+        calculate_sun_glare_for_directory_name_at_time(args.environment, date_time, create_map=False)
+
+    VisualizationFunctions = import_timed("VisualizationFunctions")
+    if args.png:
+        VisualizationFunctions.render_sun_glare_time_sweep(base_directory, [date_time.strftime("%Y-%m-%d_%H-%M-%S") for date_time in date_times], args.width)
+    else:
+        VisualizationFunctions.create_sun_glare_time_series_map(base_directory, date_times)
+
+def run_map_command(args):
+    base_directory = get_base_directory_for_command(args.environment)
+    VisualizationFunctions = import_timed("VisualizationFunctions")
+    if args.png:
+        VisualizationFunctions.render_sun_glare_png(base_directory, args.time.strftime("%Y-%m-%d_%H-%M-%S"), args.width)
+    else:
+        VisualizationFunctions.create_sun_glare_map(base_directory, args.time, map_mode=args.mode, simplify_tolerance=args.simplify)
+
+def parse_date_time_argument(date_time_str):
+    try:
+        return parse_date_time(date_time_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{date_time_str} is not a UTC time in the format YYYY-MM-DD-HH-MM-SS")
+
+def make_argument_parser():
+    parser = argparse.ArgumentParser(prog="SUGAR-T", description="The easy and dynamic sun glare detection tool (no command starts the interactive menu)")
+    parser.add_argument("--profile-startup", action="store_true", help="report how long startup and module imports took")
+    commands = parser.add_subparsers(dest="command")
+
+    commands.add_parser("list", help="list the created urban environments").set_defaults(run=run_list_command)
+
+    create_parser = commands.add_parser("create-environment", help="create an urban environment (segments, Street View images, segmentation maps)")
+    create_parser.add_argument("location", help="city/town, state/region, country (ex: \"Arlington, VA, USA\")")
+    create_parser.add_argument("--api-key", help=f"Google Maps Platform API key (defaults to ${API_KEY_ENVIRONMENT_VARIABLE})")
+    create_parser.add_argument("--zoom", type=int, default=1, help="Street View zoom level (0-5, lower is faster, higher has more detail)")
+    create_parser.add_argument("--force", action="store_true", help="continue building an environment that already exists")
+    create_parser.add_argument("--glare-time", type=parse_date_time_argument, action="append", default=[], help="also build the glare dataset and map at this UTC time (repeatable)")
+    create_parser.add_argument("--rerun", action="append", default=[], help="rerun this pipeline stage even if it is done (repeatable)")
+    create_parser.set_defaults(run=run_create_environment_command)
+
+    glare_parser = commands.add_parser("glare", help="create the sun glare dataset (and map) of an environment at a UTC time")
+    glare_parser.add_argument("environment")
+    glare_parser.add_argument("--time", type=parse_date_time_argument, required=True, help="UTC time YYYY-MM-DD-HH-MM-SS")
+    glare_parser.add_argument("--no-map", action="store_true", help="only create the dataset")
+    glare_parser.set_defaults(run=run_glare_command)
+
+    sweep_parser = commands.add_parser("sweep", help="create sun glare datasets over a time range and one time series map (or pngs)")
+    sweep_parser.add_argument("environment")
+    sweep_parser.add_argument("--start", type=parse_date_time_argument, required=True, help="UTC time YYYY-MM-DD-HH-MM-SS")
+    sweep_parser.add_argument("--end", type=parse_date_time_argument, required=True, help="UTC time YYYY-MM-DD-HH-MM-SS")
+    sweep_parser.add_argument("--step-minutes", type=int, default=60)
+    sweep_parser.add_argument("--png", action="store_true", help="render one png per time instead of the time series map")
+    sweep_parser.add_argument("--width", type=int, default=1600, help="png width in pixels")
+    sweep_parser.set_defaults(run=run_sweep_command)
+
+    map_parser = commands.add_parser("map", help="create the map of an existing sun glare dataset")
+    map_parser.add_argument("environment")
+    map_parser.add_argument("--time", type=parse_date_time_argument, required=True, help="UTC time YYYY-MM-DD-HH-MM-SS")
+    map_parser.add_argument("--mode", choices=["polylines", "geojson"], default="polylines")
+    map_parser.add_argument("--simplify", type=float, default=None, help="line simplification tolerance (degrees)")
+    map_parser.add_argument("--png", action="store_true", help="render a png instead of an html map")
+    map_parser.add_argument("--width", type=int, default=1600, help="png width in pixels")
+    map_parser.set_defaults(run=run_map_command)
+    return parser
+
+def print_startup_profile(command_start_time):
+    print("Startup profile:")
+    print(f"\tcli ready: {command_start_time - CLI_START_TIME:.3f} seconds")
+    for module_name, import_time in sorted(MODULE_IMPORT_TIMES.items(), key=lambda item: -item[1]):
+        print(f"\timport {module_name}: {import_time:.3f} seconds")
+    print(f"\tcommand: {time.perf_counter() - command_start_time - sum(MODULE_IMPORT_TIMES.values()):.3f} seconds (without imports)")
+
+def main(argv=None):
+    args = make_argument_parser().parse_args(argv)
+    if args.command is None:
+        run_main_interface()
+        return
+
+    command_start_time = time.perf_counter()
+    try:
+        args.run(args)
+    finally:
+        if args.profile_startup:
+            print_startup_profile(command_start_time)
+
+
+if __name__ == '__main__':
+    main()
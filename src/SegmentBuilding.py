@@ -0,0 +1,244 @@
+# Description:
+# Bulk builder for the segment graph (segments.csv)
+# Builds every segment straight from osmnx's node/edge GeoDataFrames in columnar form, giving the same segments as
+# NodeGrabbing's per edge builder without nodes.iterrows(), nodes.loc lookups or the quadratic closed_edges list
+
+import numpy as np
+import pandas as pd
+import shapely
+import osmnx as ox
+from LinearReferencing import build_linear_reference, project_points, extract_line_strings_between_projected_coords, sample_equally_spaced_points, calculate_headings, geod, METERS_TO_FEET
+
+FEET_SPACING = 300
+SEGMENT_COLUMNS = ["lat", "long", "headings", "segment_links", "line_strings", "heading_links"]
+
+
+# same ids as NodeGrabbing.segment_key, for arrays of coordinates
+def make_segment_keys(lats, longs):
+    return [f"{lat}_{long}" for lat, long in zip(np.asarray(lats, dtype=float).tolist(), np.asarray(longs, dtype=float).tolist())]
+
+# splits values into one list per key (keys in order of first appearance, values keep their order)
+def group_lists(keys, values):
+    # object Series so lists/tuples stay single values
+    keys = pd.Series(list(keys), dtype=object)
+    values = pd.Series(list(values), dtype=object).to_numpy()
+    if len(values) == 0:
+        return [], []
+
+    codes, unique_keys = pd.factorize(keys)
+    order = np.argsort(codes, kind="stable")
+    boundaries = np.flatnonzero(np.diff(codes[order])) + 1
+    return list(unique_keys), [group.tolist() for group in np.split(values[order], boundaries)]
+
+
+def is_missing_value(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+# parallel edges with the same data (attributes and geometry) as an earlier edge between the same u and v
+# the per edge builder processes them once (its closed_edges check), so they are dropped before building
+def get_repeated_parallel_edges(edges):
+    repeated = np.zeros(len(edges), dtype=bool)
+    u_v_pairs = list(zip(edges.index.get_level_values(0), edges.index.get_level_values(1)))
+    parallel = np.flatnonzero(pd.Series(u_v_pairs, dtype=object).duplicated(keep=False).to_numpy())
+
+    seen = {}
+    for position in parallel.tolist():
+        # edge data like the graph has it (an attribute missing from the graph edge is NaN/None in the GeoDataFrame)
+        data = {column: value for column, value in zip(edges.columns, edges.iloc[position].tolist()) if not is_missing_value(value)}
+        earlier = seen.setdefault(u_v_pairs[position], [])
+        if data in earlier:
+            repeated[position] = True
+        else:
+            earlier.append(data)
+    return repeated
+
+
+# geodesic length (feet) of every edge that has a geometry, 0 for edges without one
+def get_total_feet_for_edges(geometries, has_geometry):
+    total_feet = np.zeros(len(geometries))
+    if not has_geometry.any():
+        return total_feet
+
+    coords, edge_index = shapely.get_coordinates(geometries[has_geometry], return_index=True)
+    # only measure between vertices of the same edge
+    same_edge = edge_index[1:] == edge_index[:-1]
+    starts = coords[:-1][same_edge]
+    ends = coords[1:][same_edge]
+    _, _, distances = geod.inv(starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+
+    total_feet[has_geometry] = np.bincount(edge_index[1:][same_edge], weights=distances, minlength=int(has_geometry.sum())) * METERS_TO_FEET
+    return total_feet
+
+
+# the (segment -> link) records added to nodes are merged like NodeGrabbing.add_link_heading_linestring_to_segment:
+# first line string per link, unique headings, and every link for each heading (in the order edges are processed)
+def aggregate_node_links(segment_ids, link_ids, headings, line_strings, orders):
+    links = pd.DataFrame({
+        "segment_id": segment_ids,
+        "link_id": link_ids,
+        "heading": headings,
+        "line_string": line_strings,
+        "order": orders,
+    }).sort_values("order", kind="stable")
+
+    first_links = links.drop_duplicates(["segment_id", "link_id"])
+    link_segment_ids, segment_links = group_lists(first_links["segment_id"], first_links["link_id"])
+    _, link_line_strings = group_lists(first_links["segment_id"], first_links["line_string"])
+    line_strings = [dict(zip(ids, strings)) for ids, strings in zip(segment_links, link_line_strings)]
+
+    unique_headings = links.drop_duplicates(["segment_id", "heading"])
+    heading_segment_ids, segment_headings = group_lists(unique_headings["segment_id"], unique_headings["heading"])
+
+    # every link for each (segment, heading), then grouped into one dict per segment
+    segment_heading_pairs = list(zip(links["segment_id"], links["heading"]))
+    pair_keys, pair_links = group_lists(segment_heading_pairs, links["link_id"])
+    pair_segment_ids, pair_dicts = group_lists([segment_id for segment_id, _ in pair_keys], [(heading, link_list) for (_, heading), link_list in zip(pair_keys, pair_links)])
+    heading_links = [dict(pairs) for pairs in pair_dicts]
+
+    return pd.DataFrame({"segment_links": pd.Series(segment_links, index=link_segment_ids, dtype=object),
+                         "line_strings": pd.Series(line_strings, index=link_segment_ids, dtype=object),
+                         "headings": pd.Series(segment_headings, index=heading_segment_ids, dtype=object),
+                         "heading_links": pd.Series(heading_links, index=pair_segment_ids, dtype=object)})
+
+
+# nodes, edges: GeoDataFrames from ox.graph_to_gdfs(graph, fill_edge_geometry=False)
+# (edges without a geometry of their own are straight u -> v links, and never get segments in between)
+# returns (node_segments, intermediate_segments) both indexed by segment_id, intermediate segments also keep
+# the u/v node ids of the edge they were created in (u_id, v_id)
+# edges are processed in the order of the GeoDataFrame, which is the graph's (every node's out edges, in node order),
+# the same order the per edge builder walks them in, so the same duplicate segment wins
+def build_segment_tables(nodes, edges):
+    edges = edges[~get_repeated_parallel_edges(edges)]
+
+    # nodes are segments (with no headings/links until edges are added)
+    node_keys = make_segment_keys(nodes.geometry.y.values, nodes.geometry.x.values)
+    node_segments = pd.DataFrame({"lat": nodes.geometry.y.values, "long": nodes.geometry.x.values}, index=node_keys)
+    node_segments = node_segments[~node_segments.index.duplicated(keep="first")]
+    node_key_lookup = pd.Series(node_keys, index=nodes.index)
+
+    # every edge endpoint in one lookup
+    u_ids = edges.index.get_level_values(0)
+    v_ids = edges.index.get_level_values(1)
+    u_lats = nodes.geometry.y.reindex(u_ids).values
+    u_longs = nodes.geometry.x.reindex(u_ids).values
+    v_lats = nodes.geometry.y.reindex(v_ids).values
+    v_longs = nodes.geometry.x.reindex(v_ids).values
+    u_keys = node_key_lookup.reindex(u_ids).values
+    v_keys = node_key_lookup.reindex(v_ids).values
+
+    oneway = edges["oneway"].astype(bool).values
+    u_headings = calculate_headings(u_lats, u_longs, v_lats, v_longs)
+    v_headings = calculate_headings(v_lats, v_longs, u_lats, u_longs)
+
+    geometries = np.asarray(edges.geometry.values, dtype=object)
+    has_geometry = ~shapely.is_missing(geometries)
+    total_feet = get_total_feet_for_edges(geometries, has_geometry)
+    # add 2 to account for the start and end (they are the u and v nodes)
+    num_points = (total_feet // FEET_SPACING).astype(int) + 2
+    num_points[~has_geometry] = 2
+
+    # edges with no segments in between just link u -> v (and v -> u when two way)
+    short = num_points == 2
+    edge_order = np.arange(len(edges)) * 2
+    short_line_strings = [[(u_long, u_lat), (v_long, v_lat)] for u_lat, u_long, v_lat, v_long in zip(u_lats.tolist(), u_longs.tolist(), v_lats.tolist(), v_longs.tolist())]
+    short_reverse_line_strings = [line_string[::-1] for line_string in short_line_strings]
+
+    intermediate_rows = []
+    long_link_records = []
+
+    for position in np.flatnonzero(has_geometry):
+        linear_reference = build_linear_reference(geometries[position])
+        # plain floats, they can end up in the line strings written to segments.csv
+        u_coord = (float(u_lats[position]), float(u_longs[position]))
+        v_coord = (float(v_lats[position]), float(v_longs[position]))
+
+        if short[position]:
+            coords = [u_coord, v_coord]
+            measures = project_points(linear_reference, [u_coord[1], v_coord[1]], [u_coord[0], v_coord[0]])
+            short_line_strings[position], short_reverse_line_strings[position] = extract_line_strings_between_projected_coords(linear_reference, coords, measures, [(0, 1), (1, 0)])
+            continue
+
+        # remove the first and last location (the u and v nodes)
+        locations = sample_equally_spaced_points(linear_reference, num_points[position])[1:-1]
+        keys = make_segment_keys([lat for lat, _, _ in locations], [long for _, long, _ in locations])
+        last = len(locations) - 1
+
+        # project u, every location and v onto the edge at once (u is 0, locations are 1..n, v is n + 1)
+        coords = [u_coord] + [location[:2] for location in locations] + [v_coord]
+        measures = project_points(linear_reference, [long for _, long in coords], [lat for lat, _ in coords])
+
+        # every line string this edge needs: u -> first, then each location -> next (and -> previous when two way)
+        pairs = [(0, 1)]
+        for index in range(1, len(locations) + 1):
+            pairs.append((index, index + 1))
+            if not oneway[position]:
+                pairs.append((index, index - 1))
+        line_strings_between = dict(zip(pairs, extract_line_strings_between_projected_coords(linear_reference, coords, measures, pairs)))
+
+        for i, (lat, long, heading) in enumerate(locations):
+            # position of this location in coords/measures
+            index = i + 1
+            if i == 0:
+                # node 'u' links to the first segment in the edge
+                long_link_records.append((u_keys[position], keys[0], heading, line_strings_between[(0, index)], edge_order[position]))
+                previous_key = u_keys[position]
+            else:
+                previous_key = keys[i - 1]
+
+            if i == last:
+                next_key = v_keys[position]
+            else:
+                next_key = keys[i + 1]
+
+            # a lone segment keeps v's heading back to u
+            reverse_heading = float(v_headings[position]) if last == 0 else (heading + 180) % 360
+
+            headings = [heading]
+            segment_links = [next_key]
+            line_strings = {next_key: line_strings_between[(index, index + 1)]}
+            heading_links = {heading: [next_key]}
+            if not oneway[position]:
+                headings.append(reverse_heading)
+                segment_links.append(previous_key)
+                line_strings[previous_key] = line_strings_between[(index, index - 1)]
+                heading_links[reverse_heading] = [previous_key]
+
+            intermediate_rows.append((keys[i], lat, long, headings, segment_links, line_strings, heading_links, u_ids[position], v_ids[position]))
+
+    # all links added to the nodes, in edge processing order
+    short_positions = np.flatnonzero(short)
+    two_way_positions = np.flatnonzero(short & ~oneway)
+    long_segment_ids, long_link_ids, long_headings, long_line_strings, long_orders = zip(*long_link_records) if long_link_records else ((), (), (), (), ())
+
+    node_links = aggregate_node_links(
+        segment_ids=np.concatenate((u_keys[short_positions], v_keys[two_way_positions], np.asarray(long_segment_ids, dtype=object))),
+        link_ids=np.concatenate((v_keys[short_positions], u_keys[two_way_positions], np.asarray(long_link_ids, dtype=object))),
+        headings=np.concatenate((u_headings[short_positions], v_headings[two_way_positions], np.asarray(long_headings, dtype=float))).tolist(),
+        line_strings=[short_line_strings[position] for position in short_positions] + [short_reverse_line_strings[position] for position in two_way_positions] + list(long_line_strings),
+        orders=np.concatenate((edge_order[short_positions], edge_order[two_way_positions] + 1, np.asarray(long_orders, dtype=int))),
+    )
+
+    node_segments = node_segments.join(node_links)
+    for column, empty in (("headings", list), ("segment_links", list), ("line_strings", dict), ("heading_links", dict)):
+        missing = node_segments[column].isna()
+        node_segments.loc[missing, column] = pd.Series([empty() for _ in range(int(missing.sum()))], index=node_segments.index[missing], dtype=object)
+
+    # segments in between nodes, the first one created for an id wins
+    intermediate_segments = pd.DataFrame(intermediate_rows, columns=["segment_id"] + SEGMENT_COLUMNS + ["u_id", "v_id"]).set_index("segment_id")
+    intermediate_segments = intermediate_segments[~intermediate_segments.index.duplicated(keep="first")]
+    intermediate_segments = intermediate_segments[~intermediate_segments.index.isin(node_segments.index)]
+
+    return node_segments[SEGMENT_COLUMNS], intermediate_segments
+
+
+# returns a DataFrame indexed by segment_id with the same rows as segments.csv
+def build_segments_from_gdfs(nodes, edges):
+    node_segments, intermediate_segments = build_segment_tables(nodes, edges)
+    segments = pd.concat([node_segments, intermediate_segments[SEGMENT_COLUMNS]])
+    segments.index.name = "segment_id"
+    return segments
+
+
+def build_segments_from_graph(graph):
+    nodes, edges = ox.graph_to_gdfs(graph, fill_edge_geometry=False)
+    return build_segments_from_gdfs(nodes, edges)
@@ -0,0 +1,296 @@
+# Description:
+# Compact binary format for the segment graph (segments.csv)
+# Segments get integer ids (their position in the sorted segment_id array), links and headings are stored as CSR arrays
+# and every link's line string is a slice of one packed coordinate buffer. Every array is a .npy file, so the graph is
+# memory mapped on load (no csv parsing or ast.literal_eval) and only the parts that are used are read from disk
+#
+# Files (n segments, k links, m line string coords):
+#   segment_ids          (n)      segment_id strings (lat_long), sorted so ids can be looked up with a binary search
+#   lats, longs          (n)
+#   heading_offsets      (n + 1)  headings of segment i are headings[heading_offsets[i]:heading_offsets[i + 1]]
+#   headings             (...)
+#   link_offsets         (n + 1)  links of segment i are link_offsets[i]:link_offsets[i + 1] in the link arrays
+#   link_targets         (k)      integer id of the linked segment (-1 if it is not in the graph)
+#   link_headings        (k)      heading the link is taken from (the heading_links key), NaN if it has none
+#   line_string_offsets  (k + 1)  line string of link j is line_string_coords[line_string_offsets[j]:line_string_offsets[j + 1]]
+#   line_string_coords   (m x 2)  (long, lat) like the line strings in segments.csv
+
+import os
+import ast
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+SEGMENT_GRAPH_VERSION = 1
+SEGMENT_GRAPH_METADATA_FILE = "segment_graph.json"
+SEGMENT_GRAPH_ARRAYS = ["segment_ids", "lats", "longs", "heading_offsets", "headings", "link_offsets", "link_targets",
+                        "link_headings", "line_string_offsets", "line_string_coords"]
+
+
+# scratch arrays of write_segment_graph_from_csv (rows in csv order): name -> (dtype, columns)
+SEGMENT_GRAPH_SCRATCH_ARRAYS = {"headings": (np.float64, 1), "link_targets": (np.int64, 1), "link_headings": (np.float64, 1),
+                                "line_string_lengths": (np.int64, 1), "line_string_coords": (np.float64, 2)}
+# segments.csv rows parsed at a time when converting it
+SEGMENT_GRAPH_CHUNK_SIZE = 100000
+
+
+def get_segment_graph_directory(base_directory):
+    return f"{base_directory}/segment_graph"
+
+
+# the graph's arrays for every segment (in the order of segments), links are looked up in sorted_segment_ids
+# segments: DataFrame with the segments.csv columns (headings, links... as python objects)
+def build_segment_graph_pieces(segments, sorted_segment_ids):
+    heading_counts = []
+    headings = []
+    link_counts = []
+    link_ids = []
+    link_headings = []
+    line_string_lengths = []
+    line_string_coords = []
+
+    for segment_headings, segment_links, line_strings, heading_links in zip(segments["headings"], segments["segment_links"], segments["line_strings"], segments["heading_links"]):
+        heading_counts.append(len(segment_headings))
+        headings.extend(segment_headings)
+
+        # one entry per (heading, link), links without a heading keep a NaN heading
+        links = [(heading, link) for heading, heading_link_ids in heading_links.items() for link in heading_link_ids]
+        linked = {link for _, link in links}
+        links += [(np.nan, link) for link in segment_links if link not in linked]
+
+        link_counts.append(len(links))
+        for heading, link in links:
+            link_ids.append(link)
+            link_headings.append(heading)
+            line_string = line_strings.get(link, [])
+            line_string_lengths.append(len(line_string))
+            line_string_coords.extend(line_string)
+
+    return {
+        "heading_counts": np.asarray(heading_counts, dtype=np.int64),
+        "headings": np.asarray(headings, dtype=np.float64),
+        "link_counts": np.asarray(link_counts, dtype=np.int64),
+        "link_targets": get_segment_indices({"segment_ids": sorted_segment_ids}, link_ids).astype(np.int64),
+        "link_headings": np.asarray(link_headings, dtype=np.float64),
+        "line_string_lengths": np.asarray(line_string_lengths, dtype=np.int64),
+        "line_string_coords": np.asarray(line_string_coords, dtype=np.float64).reshape(-1, 2),
+    }
+
+def get_offsets(counts):
+    return np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+
+
+# graphs are written to a temp directory first so an interrupted run never leaves half a graph
+def make_segment_graph_temp_directory(output_directory):
+    temp_directory = output_directory + ".tmp"
+    shutil.rmtree(temp_directory, ignore_errors=True)
+    os.makedirs(temp_directory)
+    return temp_directory
+
+def finish_segment_graph(temp_directory, output_directory, segment_count, link_count, coord_count):
+    with open(f"{temp_directory}/{SEGMENT_GRAPH_METADATA_FILE}", "w") as file:
+        json.dump({"version": SEGMENT_GRAPH_VERSION, "segments": int(segment_count), "links": int(link_count), "coords": int(coord_count)}, file)
+    shutil.rmtree(output_directory, ignore_errors=True)
+    os.replace(temp_directory, output_directory)
+    print(f"\tSegment graph saved to: {output_directory}")
+
+
+# segments: DataFrame indexed by segment_id with the segments.csv columns (headings, links... as python objects)
+def write_segment_graph(segments, output_directory):
+    segments = segments.sort_index()
+    segment_ids = segments.index.astype(str).to_numpy()
+    pieces = build_segment_graph_pieces(segments, segment_ids)
+
+    arrays = {
+        "segment_ids": segment_ids.astype(str),
+        "lats": segments["lat"].to_numpy(dtype=float),
+        "longs": segments["long"].to_numpy(dtype=float),
+        "heading_offsets": get_offsets(pieces["heading_counts"]),
+        "headings": pieces["headings"],
+        "link_offsets": get_offsets(pieces["link_counts"]),
+        "link_targets": pieces["link_targets"],
+        "link_headings": pieces["link_headings"],
+        "line_string_offsets": get_offsets(pieces["line_string_lengths"]),
+        "line_string_coords": pieces["line_string_coords"],
+    }
+
+    temp_directory = make_segment_graph_temp_directory(output_directory)
+    for name, array in arrays.items():
+        np.save(f"{temp_directory}/{name}.npy", array)
+    finish_segment_graph(temp_directory, output_directory, len(segment_ids), len(pieces["link_targets"]), len(pieces["line_string_coords"]))
+
+
+def parse_segment_columns(segments):
+    for column in ("headings", "segment_links", "line_strings", "heading_links"):
+        segments[column] = segments[column].apply(ast.literal_eval)
+    return segments
+
+def read_segments_csv(segments_csv_path):
+    return parse_segment_columns(pd.read_csv(segments_csv_path, index_col="segment_id"))
+
+
+# reads rows start:end of a scratch array (rows in csv order)
+def read_scratch_rows(scratch_directory, name, start, end):
+    dtype, columns = SEGMENT_GRAPH_SCRATCH_ARRAYS[name]
+    item_size = np.dtype(dtype).itemsize * columns
+    rows = np.fromfile(f"{scratch_directory}/{name}.bin", dtype=dtype, count=(end - start) * columns, offset=start * item_size)
+    return rows.reshape(-1, 2) if columns == 2 else rows
+
+# moves the items of every scratch row (counts items per row, rows in csv order) to sorted_offsets[rank of the row] in
+# output, chunk_size rows at a time, returns where every item went if keep_destinations
+def move_scratch_items(scratch_directory, names, outputs, counts, ranks, sorted_offsets, chunk_size, keep_destinations=False):
+    scratch_offsets = get_offsets(counts)
+    destinations = np.empty(scratch_offsets[-1], dtype=np.int64) if keep_destinations else None
+    for start in range(0, len(counts), chunk_size):
+        end = min(start + chunk_size, len(counts))
+        item_start, item_end = scratch_offsets[start], scratch_offsets[end]
+        chunk_destinations = np.repeat(sorted_offsets[ranks[start:end]] - scratch_offsets[start:end], counts[start:end]) + np.arange(item_start, item_end)
+        for name, output in zip(names, outputs):
+            output[chunk_destinations] = read_scratch_rows(scratch_directory, name, item_start, item_end)
+        if keep_destinations:
+            destinations[item_start:item_end] = chunk_destinations
+    return destinations
+
+# same graph as write_segment_graph(read_segments_csv(segments_csv_path), output_directory), but the csv is parsed
+# chunk_size rows at a time: every chunk's headings, links and line strings are appended to scratch files (in csv order)
+# and a final pass moves them to their sorted position in memory mapped arrays. Only the segment ids and a few numbers
+# per segment and link are kept in memory, so memory does not grow with the line strings of the whole area
+def write_segment_graph_from_csv(segments_csv_path, output_directory, chunk_size=SEGMENT_GRAPH_CHUNK_SIZE):
+    temp_directory = make_segment_graph_temp_directory(output_directory)
+    scratch_directory = f"{temp_directory}/scratch"
+    os.makedirs(scratch_directory)
+
+    # sorted ids first, since links point at positions in them
+    csv_segment_ids = np.concatenate([np.empty(0, dtype=str)] + [chunk["segment_id"].to_numpy(dtype=str) for chunk in pd.read_csv(segments_csv_path, usecols=["segment_id"], dtype={"segment_id": str}, chunksize=chunk_size)])
+    order = np.argsort(csv_segment_ids, kind="stable")
+    segment_ids = csv_segment_ids[order]
+    ranks = np.empty(len(order), dtype=np.int64)
+    ranks[order] = np.arange(len(order))
+    np.save(f"{temp_directory}/segment_ids.npy", segment_ids)
+    del csv_segment_ids
+
+    lats = np.lib.format.open_memmap(f"{temp_directory}/lats.npy", mode="w+", dtype=np.float64, shape=(len(segment_ids),))
+    longs = np.lib.format.open_memmap(f"{temp_directory}/longs.npy", mode="w+", dtype=np.float64, shape=(len(segment_ids),))
+    heading_counts = np.zeros(len(segment_ids), dtype=np.int64)
+    link_counts = np.zeros(len(segment_ids), dtype=np.int64)
+    for name in SEGMENT_GRAPH_SCRATCH_ARRAYS:
+        open(f"{scratch_directory}/{name}.bin", "wb").close()
+
+    row = 0
+    for chunk in pd.read_csv(segments_csv_path, index_col="segment_id", chunksize=chunk_size):
+        chunk = parse_segment_columns(chunk)
+        rows = np.arange(row, row + len(chunk))
+        row += len(chunk)
+        lats[ranks[rows]] = chunk["lat"].to_numpy(dtype=float)
+        longs[ranks[rows]] = chunk["long"].to_numpy(dtype=float)
+        pieces = build_segment_graph_pieces(chunk, segment_ids)
+        heading_counts[rows] = pieces["heading_counts"]
+        link_counts[rows] = pieces["link_counts"]
+        for name in SEGMENT_GRAPH_SCRATCH_ARRAYS:
+            with open(f"{scratch_directory}/{name}.bin", "ab") as file:
+                file.write(pieces[name].tobytes())
+
+    # segments in sorted order
+    heading_offsets = get_offsets(heading_counts[order])
+    link_offsets = get_offsets(link_counts[order])
+    np.save(f"{temp_directory}/heading_offsets.npy", heading_offsets)
+    np.save(f"{temp_directory}/link_offsets.npy", link_offsets)
+    headings = np.lib.format.open_memmap(f"{temp_directory}/headings.npy", mode="w+", dtype=np.float64, shape=(int(heading_offsets[-1]),))
+    move_scratch_items(scratch_directory, ["headings"], [headings], heading_counts, ranks, heading_offsets, chunk_size)
+
+    link_count = int(link_offsets[-1])
+    link_targets = np.lib.format.open_memmap(f"{temp_directory}/link_targets.npy", mode="w+", dtype=np.int64, shape=(link_count,))
+    link_headings = np.lib.format.open_memmap(f"{temp_directory}/link_headings.npy", mode="w+", dtype=np.float64, shape=(link_count,))
+    line_string_lengths = np.zeros(link_count, dtype=np.int64)
+    link_ranks = move_scratch_items(scratch_directory, ["link_targets", "link_headings", "line_string_lengths"], [link_targets, link_headings, line_string_lengths],
+                                    link_counts, ranks, link_offsets, chunk_size, keep_destinations=True)
+
+    # every link's line string follows its link
+    line_string_offsets = get_offsets(line_string_lengths)
+    np.save(f"{temp_directory}/line_string_offsets.npy", line_string_offsets)
+    line_string_coords = np.lib.format.open_memmap(f"{temp_directory}/line_string_coords.npy", mode="w+", dtype=np.float64, shape=(int(line_string_offsets[-1]), 2))
+    scratch_line_string_lengths = np.fromfile(f"{scratch_directory}/line_string_lengths.bin", dtype=np.int64)
+    move_scratch_items(scratch_directory, ["line_string_coords"], [line_string_coords], scratch_line_string_lengths, link_ranks, line_string_offsets, chunk_size)
+
+    for array in (lats, longs, headings, link_targets, link_headings, line_string_coords):
+        array.flush()
+    del lats, longs, headings, link_targets, link_headings, line_string_coords
+    shutil.rmtree(scratch_directory)
+    finish_segment_graph(temp_directory, output_directory, len(segment_ids), link_count, line_string_offsets[-1])
+
+def convert_segments_csv_to_segment_graph(base_directory, chunk_size=SEGMENT_GRAPH_CHUNK_SIZE):
+    write_segment_graph_from_csv(f"{base_directory}/segments.csv", get_segment_graph_directory(base_directory), chunk_size)
+
+
+def has_segment_graph(base_directory):
+    return os.path.exists(f"{get_segment_graph_directory(base_directory)}/{SEGMENT_GRAPH_METADATA_FILE}")
+
+# returns a dict of (read only, memory mapped) arrays
+def load_segment_graph(directory, mmap=True):
+    with open(f"{directory}/{SEGMENT_GRAPH_METADATA_FILE}", "r") as file:
+        metadata = json.load(file)
+    if metadata["version"] != SEGMENT_GRAPH_VERSION:
+        raise ValueError(f"Segment graph version {metadata['version']} is not supported (expected {SEGMENT_GRAPH_VERSION}), rebuild it from segments.csv")
+
+    mmap_mode = "r" if mmap else None
+    return {name: np.load(f"{directory}/{name}.npy", mmap_mode=mmap_mode) for name in SEGMENT_GRAPH_ARRAYS}
+
+
+# integer ids of the given segment_ids (-1 for ids that are not in the graph)
+def get_segment_indices(segment_graph, segment_ids):
+    graph_ids = segment_graph["segment_ids"]
+    segment_ids = np.asarray(segment_ids, dtype=str)
+    indices = np.searchsorted(graph_ids, segment_ids)
+    found = indices < len(graph_ids)
+    found[found] = graph_ids[indices[found]] == segment_ids[found]
+    return np.where(found, indices, -1)
+
+def get_segment_index(segment_graph, segment_id):
+    return int(get_segment_indices(segment_graph, [segment_id])[0])
+
+
+def get_segment_headings(segment_graph, index):
+    offsets = segment_graph["heading_offsets"]
+    return segment_graph["headings"][offsets[index]:offsets[index + 1]]
+
+# (link targets, link headings) of a segment
+def get_segment_links(segment_graph, index):
+    offsets = segment_graph["link_offsets"]
+    start, end = offsets[index], offsets[index + 1]
+    return segment_graph["link_targets"][start:end], segment_graph["link_headings"][start:end]
+
+# (long, lat) coords of a link (index into the link arrays)
+def get_link_line_string(segment_graph, link):
+    offsets = segment_graph["line_string_offsets"]
+    return segment_graph["line_string_coords"][offsets[link]:offsets[link + 1]]
+
+
+# the segment as a segments.csv row (same python objects as ast.literal_eval gives), for code written for the csv
+def get_segment_record(segment_graph, index):
+    segment_ids = segment_graph["segment_ids"]
+    link_start = int(segment_graph["link_offsets"][index])
+    link_targets, link_headings = get_segment_links(segment_graph, index)
+
+    segment_links = []
+    line_strings = {}
+    heading_links = {}
+    for link, (target, heading) in enumerate(zip(link_targets.tolist(), link_headings.tolist()), start=link_start):
+        if target < 0:
+            continue
+        target_id = str(segment_ids[target])
+        if target_id not in line_strings:
+            segment_links.append(target_id)
+            line_strings[target_id] = [tuple(coord) for coord in get_link_line_string(segment_graph, link).tolist()]
+        if not np.isnan(heading):
+            heading_links.setdefault(heading, []).append(target_id)
+
+    return {
+        "segment_id": str(segment_ids[index]),
+        "lat": float(segment_graph["lats"][index]),
+        "long": float(segment_graph["longs"][index]),
+        "headings": get_segment_headings(segment_graph, index).tolist(),
+        "segment_links": segment_links,
+        "line_strings": line_strings,
+        "heading_links": heading_links,
+    }
@@ -7,6 +7,7 @@ import math
 import numpy as np
 import pandas as pd
 import ast
+from SegmentGraph import has_segment_graph, load_segment_graph, get_segment_graph_directory, get_segment_indices, get_segment_headings
 
 def plot_dot_on_image(img_path, xc, yc, color='red', title="Sun's Incidence Point on Cylindrical GSV Panorama"):
 
@@ -26,6 +27,22 @@ def get_image_width_height(base_directory, pano_id):
         width, height = img.size
     return width, height
 
+# uses the resolution stored in panoramic_data (image_width, image_height) if it is there
+# so the image does not have to be opened, otherwise reads it from the panoramic image
+def get_image_width_height_for_pano_row(base_directory, pano_row):
+    image_width = pano_row.get("image_width")
+    image_height = pano_row.get("image_height")
+    if image_width is not None and image_height is not None and not (pd.isna(image_width) or pd.isna(image_height)):
+        return int(image_width), int(image_height)
+    return get_image_width_height(base_directory, pano_row["pano_id"])
+
+# scales a point on the panoramic onto the segmentation map (in case they are not the same resolution)
+def scale_point_to_segmentation_map(segmentation_map, x, y, image_width, image_height):
+    map_height, map_width = segmentation_map.shape[:2]
+    if map_width == image_width and map_height == image_height:
+        return x, y
+    return x * map_width / image_width, y * map_height / image_height
+
 def get_sun_position_east(latitude: float, longitude: float, date: datetime):
     altitude = get_altitude(latitude, longitude, date)  # degrees
     azimuth = get_azimuth(latitude, longitude, date)  #  degrees
@@ -56,12 +73,14 @@ def plot_dot_on_image_obj(img, x, y, title="No Title" , color='red' ):
     plt.title(title)
     plt.show()
 
-def get_sun_position_on_panoramic_with_heading_date_slope(base_directory, pano_id, lat, long, heading, date=datetime.now(timezone.utc), driveway_slope=0):
+def get_sun_position_on_panoramic_with_heading_date_slope(base_directory, pano_id, lat, long, heading, date=datetime.now(timezone.utc), driveway_slope=0, image_size=None):
     driving_direction = heading
     
     altitude, azimuth = get_sun_position_east(lat, long, date)
     
-    wc, hc = get_image_width_height(base_directory, pano_id)
+    if image_size is None:
+        image_size = get_image_width_height(base_directory, pano_id)
+    wc, hc = image_size
     cx = wc/2
     cy = hc/2
 
@@ -75,12 +94,16 @@ def get_sun_position_on_panoramic_with_heading_date_slope(base_directory, pano_i
     
     return sun_x, sun_y
 
-def determine_sun_position(base_directory, pano_id, lat, long, date, heading, tilt):
+# image_size: (width, height) of the panoramic, read from the image if not given
+def determine_sun_position(base_directory, pano_id, lat, long, date, heading, tilt, image_size=None):
+
+    if image_size is None:
+        image_size = get_image_width_height(base_directory, pano_id)
 
     # calculate the sun position for the given time
-    xc, yc = get_sun_position_on_panoramic_with_heading_date_slope(base_directory, pano_id, lat, long, heading, date=date, driveway_slope=tilt)
+    xc, yc = get_sun_position_on_panoramic_with_heading_date_slope(base_directory, pano_id, lat, long, heading, date=date, driveway_slope=tilt, image_size=image_size)
 
-    wc, hc = get_image_width_height(base_directory, pano_id)
+    wc, hc = image_size
     
     # wrap the x-coordinate around the panoramic width
     xc = xc % wc
@@ -157,8 +180,9 @@ def calculate_sun_glare_given_heading_panoramic_row(base_directory, segment_head
     panoramic_heading = pano_row["heading"]
     tilt = pano_row["tilt"]
     pano_id = pano_row["pano_id"]
+    image_size = get_image_width_height_for_pano_row(base_directory, pano_row)
 
-    sun_x, sun_y = determine_sun_position(base_directory, pano_id, lat, long, date_time, panoramic_heading, tilt)
+    sun_x, sun_y = determine_sun_position(base_directory, pano_id, lat, long, date_time, panoramic_heading, tilt, image_size)
     altitude, azimuth = get_sun_position_east(lat, long, date_time)
 
     h_glare = angle_difference(azimuth, segment_heading)
@@ -178,7 +202,8 @@ def calculate_sun_glare_given_heading_panoramic_row(base_directory, segment_head
 
         print(f"Segmentation Map Path: {segmentation_map_path}")
         segmentation_map = np.array(Image.open(segmentation_map_path))
-        sun_glare_blocked, _ = check_if_sun_is_blocked(segmentation_map, sun_x, sun_y)
+        map_x, map_y = scale_point_to_segmentation_map(segmentation_map, sun_x, sun_y, *image_size)
+        sun_glare_blocked, _ = check_if_sun_is_blocked(segmentation_map, map_x, map_y)
         return not sun_glare_blocked
     else:
         return False
@@ -236,10 +261,12 @@ def has_leaves_off(lat, lon, day_of_year):
     return False
 
 
-def calculate_sun_glare_for_a_single_panoramic_image(base_directory, sun_glare_dict, pano_id, lat, long, panoramic_heading, tilt, date_time, segment_headings):
+def calculate_sun_glare_for_a_single_panoramic_image(base_directory, sun_glare_dict, pano_id, lat, long, panoramic_heading, tilt, date_time, segment_headings, image_size=None):
 
+    if image_size is None:
+        image_size = get_image_width_height(base_directory, pano_id)
 
-    sun_x, sun_y = determine_sun_position(base_directory, pano_id, lat, long, date_time, panoramic_heading, tilt)
+    sun_x, sun_y = determine_sun_position(base_directory, pano_id, lat, long, date_time, panoramic_heading, tilt, image_size)
     altitude, azimuth = get_sun_position_east(lat, long, date_time)
     # each panoramic image can have multiple headings (like an intersection or 2 lane road)
     # we want to save each heading and the sun glare for that heading
@@ -265,8 +292,9 @@ def calculate_sun_glare_for_a_single_panoramic_image(base_directory, sun_glare_d
             print(f"Segmentation Map Path: {segmentation_map_path}")    
 
             segmentation_map = np.array(Image.open(segmentation_map_path))
+            map_x, map_y = scale_point_to_segmentation_map(segmentation_map, sun_x, sun_y, *image_size)
 
-            sun_glare_blocked, blockage_type = check_if_sun_is_blocked(segmentation_map, sun_x, sun_y)
+            sun_glare_blocked, blockage_type = check_if_sun_is_blocked(segmentation_map, map_x, map_y)
 
             if sun_glare_blocked:
                 # plot_dot_on_image(panoramic_file, sun_x, sun_y, color='yellow', title=f"Sun Glare at {date_time}")
@@ -287,8 +315,14 @@ def calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_tim
     panoramic_data_path = f"{base_directory}/panoramic_data.csv"
     pano_data = pd.read_csv(panoramic_data_path)
     
-    segments_path = f"{base_directory}/segments.csv"
-    segments = pd.read_csv(segments_path)
+    # the binary segment graph is memory mapped (no csv parsing), segments.csv is used for environments built without it
+    segment_graph = None
+    if has_segment_graph(base_directory):
+        segment_graph = load_segment_graph(get_segment_graph_directory(base_directory))
+        segment_indices = get_segment_indices(segment_graph, pano_data["segment_id"].astype(str))
+    else:
+        segments_path = f"{base_directory}/segments.csv"
+        segments = pd.read_csv(segments_path)
     sun_glare_dict = {}
 
     for index, panoramic in pano_data.iterrows():
@@ -302,15 +336,27 @@ def calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_tim
         tilt = panoramic["tilt"]
         year = panoramic["year"]
         month = panoramic["month"]
-        segment = segments.loc[segments['segment_id'] == segment_id]
-        segment_headings = segment['headings'].apply(ast.literal_eval)
-        segment_headings = segment_headings.iloc[0]
+        if segment_graph is not None:
+            # -1 is a segment missing from the segment graph (its headings would be read from the wrong segment)
+            if segment_indices[index] == -1:
+                print(f"\tWarning: segment_id {segment_id} of {pano_id} is not in the segment graph, skipping")
+                continue
+            segment_headings = get_segment_headings(segment_graph, segment_indices[index]).tolist()
+        else:
+            segment = segments.loc[segments['segment_id'] == segment_id]
+            if segment.empty:
+                print(f"\tWarning: segment_id {segment_id} of {pano_id} is not in segments.csv, skipping")
+                continue
+            segment_headings = segment['headings'].apply(ast.literal_eval)
+            segment_headings = segment_headings.iloc[0]
 
         # convert segment headings to anticlockwise from east
         for i in range(len(segment_headings)):
             segment_headings[i] = convert_heading_to_anticlockwise_from_east(segment_headings[i])
 
-        calculate_sun_glare_for_a_single_panoramic_image(base_directory, sun_glare_dict, pano_id, lat, long, heading, tilt, date_time, segment_headings)
+        image_size = get_image_width_height_for_pano_row(base_directory, panoramic)
+
+        calculate_sun_glare_for_a_single_panoramic_image(base_directory, sun_glare_dict, pano_id, lat, long, heading, tilt, date_time, segment_headings, image_size)
 
         date_time_string = date_time.strftime("%Y-%m-%d_%H-%M-%S")
         sung_glare_data_path = f"{base_directory}/sun_glare_data_{date_time_string}.csv"
@@ -318,3 +364,152 @@ def calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, date_tim
 
 
 
+
+
+# Batch sun glare evaluation
+# same result as calculate_sun_glare_given_heading_panoramic_row for many (panorama, segment heading, time) at once:
+# sun positions are computed with numpy for every (location, time) together, and each
+# segmentation map is read once and indexed at every sun position that falls on it
+
+GLARE_ANGLE_LIMIT = 25
+SKY_CLASS = 10
+BUILDING_CLASS = 2
+TREE_CLASS = 8
+
+# refraction at the standard pressure and temperature pysolar uses (101325 Pa, 288.15 K), NREL SPA formula
+SUN_RADIUS = 0.26667
+ATMOSPHERIC_REFRACTION = 0.5667
+REFRACTION_SCALE = 101325.0 * 2.830 * 1.02 / (1010.0 * 288.15 * 60.0)
+
+
+# (altitude, azimuth anticlockwise from east) like get_sun_position_east, timestamps are epoch seconds (UTC)
+# NOAA solar position (declination, equation of time, hour angle) as array math over all of the times and locations,
+# within ~0.05 degrees of pysolar for 1950-2100 (pysolar is a full SPA and is much slower, one call per time)
+def get_sun_positions_east_batch(lats, longs, timestamps):
+    lats = np.radians(np.asarray(lats, dtype=float))
+    longs = np.asarray(longs, dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    # julian century from J2000
+    julian_century = (timestamps / 86400.0 + 2440587.5 - 2451545.0) / 36525.0
+    mean_longitude = np.radians((280.46646 + julian_century * (36000.76983 + julian_century * 0.0003032)) % 360)
+    mean_anomaly = np.radians(357.52911 + julian_century * (35999.05029 - 0.0001537 * julian_century))
+    eccentricity = 0.016708634 - julian_century * (0.000042037 + 0.0000001267 * julian_century)
+    equation_of_center = np.sin(mean_anomaly) * (1.914602 - julian_century * (0.004817 + 0.000014 * julian_century)) \
+        + np.sin(2 * mean_anomaly) * (0.019993 - 0.000101 * julian_century) + np.sin(3 * mean_anomaly) * 0.000289
+    omega = np.radians(125.04 - 1934.136 * julian_century)
+    apparent_longitude = np.radians(np.degrees(mean_longitude) + equation_of_center - 0.00569 - 0.00478 * np.sin(omega))
+    mean_obliquity = 23 + (26 + (21.448 - julian_century * (46.815 + julian_century * (0.00059 - julian_century * 0.001813))) / 60) / 60
+    obliquity = np.radians(mean_obliquity + 0.00256 * np.cos(omega))
+    declination = np.arcsin(np.sin(obliquity) * np.sin(apparent_longitude))
+
+    # equation of time (minutes)
+    y = np.tan(obliquity / 2) ** 2
+    equation_of_time = 4 * np.degrees(y * np.sin(2 * mean_longitude) - 2 * eccentricity * np.sin(mean_anomaly)
+        + 4 * eccentricity * y * np.sin(mean_anomaly) * np.cos(2 * mean_longitude)
+        - 0.5 * y * y * np.sin(4 * mean_longitude) - 1.25 * eccentricity * eccentricity * np.sin(2 * mean_anomaly))
+
+    # hour angle from the true solar time (minutes)
+    true_solar_time = (np.mod(timestamps, 86400.0) / 60.0 + equation_of_time + 4 * longs) % 1440
+    hour_angle = np.radians(true_solar_time / 4 - 180)
+
+    cos_zenith = np.sin(lats) * np.sin(declination) + np.cos(lats) * np.cos(declination) * np.cos(hour_angle)
+    altitudes = 90 - np.degrees(np.arccos(np.clip(cos_zenith, -1, 1)))
+    # clockwise from north
+    azimuths = (np.degrees(np.arctan2(np.sin(hour_angle), np.cos(hour_angle) * np.sin(lats) - np.tan(declination) * np.cos(lats))) + 180) % 360
+
+    # same refraction as pysolar (none when the sun is well below the horizon)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        refraction = REFRACTION_SCALE / np.tan(np.radians(altitudes + 10.3 / (altitudes + 5.11)))
+    altitudes = altitudes + np.where(altitudes >= -(SUN_RADIUS + ATMOSPHERIC_REFRACTION), refraction, 0.0)
+
+    # convert to be anticlockwise from east
+    azimuths = 90 - azimuths
+    azimuths = np.where(azimuths < 0, azimuths + 360, azimuths)
+    return altitudes, azimuths
+
+def angle_differences(angles1, angles2):
+    return np.abs((angles2 - angles1 + 180) % 360 - 180)
+
+# same as has_leaves_off for arrays
+def has_leaves_off_batch(lats, longs, days_of_year):
+    lats = np.asarray(lats, dtype=float)
+    longs = np.asarray(longs, dtype=float)
+    days_of_year = np.asarray(days_of_year)
+    north = (lats >= 23.5) & (lats <= 66.5)
+    south = (lats >= -66.5) & (lats <= -23.5)
+    leaves_off = (north & ((days_of_year >= 274) | (days_of_year <= 105))) | (south & (days_of_year >= 121) & (days_of_year <= 258))
+    # invalid data gets the default value
+    invalid = ~(((lats >= -90) & (lats <= 90)) | ((longs >= -180) & (longs <= 180)))
+    return leaves_off | invalid
+
+# (widths, heights) like get_image_width_height_for_pano_row, each panoramic image is opened at most once
+def get_image_sizes_for_pano_rows(base_directory, pano_rows):
+    # copies, the missing sizes are filled in below (to_numpy can return a read only view)
+    widths = pano_rows["image_width"].to_numpy(dtype=float, copy=True) if "image_width" in pano_rows else np.full(len(pano_rows), np.nan)
+    heights = pano_rows["image_height"].to_numpy(dtype=float, copy=True) if "image_height" in pano_rows else np.full(len(pano_rows), np.nan)
+    missing = np.isnan(widths) | np.isnan(heights)
+    if missing.any():
+        missing_pano_ids = pano_rows["pano_id"].to_numpy()[missing]
+        sizes = {pano_id: get_image_width_height(base_directory, pano_id) for pano_id in set(missing_pano_ids.tolist())}
+        widths[missing] = [sizes[pano_id][0] for pano_id in missing_pano_ids]
+        heights[missing] = [sizes[pano_id][1] for pano_id in missing_pano_ids]
+    return widths, heights
+
+# same as determine_sun_position for arrays (x wrapped around the panoramic width)
+def get_sun_positions_on_panoramics(panoramic_headings, tilts, altitudes, azimuths, image_widths, image_heights):
+    sun_x = ((np.radians(panoramic_headings) - np.radians(azimuths)) / (2 * np.pi)) * image_widths + image_widths / 2
+    sun_y = image_heights / 2 - ((np.radians(altitudes) - np.radians(tilts)) / (np.pi / 2)) * image_heights
+    return sun_x % image_widths, sun_y
+
+
+# pano_rows: DataFrame with pano_id, lat, long, heading, tilt (image_width/image_height if known), one row per evaluation
+# segment_headings: anticlockwise from east, timestamps: epoch seconds (UTC), both one per row
+# returns (has_sun_glare, angle_risk, blockage_type) arrays, segmentation_maps: optional dict used as a cache of loaded maps
+def calculate_sun_glare_batch(base_directory, pano_rows, segment_headings, timestamps, segmentation_maps=None):
+    if segmentation_maps is None:
+        segmentation_maps = {}
+    lats = pano_rows["lat"].to_numpy(dtype=float)
+    longs = pano_rows["long"].to_numpy(dtype=float)
+    tilts = pano_rows["tilt"].to_numpy(dtype=float)
+    timestamps = np.asarray(timestamps, dtype=float)
+
+    altitudes, azimuths = get_sun_positions_east_batch(lats, longs, timestamps)
+    angle_risk = (angle_differences(azimuths, np.asarray(segment_headings, dtype=float)) < GLARE_ANGLE_LIMIT) & (angle_differences(altitudes, tilts) < GLARE_ANGLE_LIMIT)
+
+    has_sun_glare = np.zeros(len(pano_rows), dtype=bool)
+    blockage_type = np.full(len(pano_rows), "none", dtype=object)
+    risk_rows = np.flatnonzero(angle_risk)
+    if len(risk_rows) == 0:
+        return has_sun_glare, angle_risk, blockage_type
+
+    # the sun's pixel on the panoramic (only where the angle can cause glare)
+    risk_pano_rows = pano_rows.iloc[risk_rows]
+    widths, heights = get_image_sizes_for_pano_rows(base_directory, risk_pano_rows)
+    sun_x, sun_y = get_sun_positions_on_panoramics(risk_pano_rows["heading"].to_numpy(dtype=float), tilts[risk_rows], altitudes[risk_rows], azimuths[risk_rows], widths, heights)
+
+    # treeless segmentation map when the leaves are off
+    days_of_year = pd.to_datetime(timestamps[risk_rows], unit="s", utc=True).dayofyear.to_numpy()
+    leaves_off = has_leaves_off_batch(lats[risk_rows], longs[risk_rows], days_of_year)
+    pano_ids = risk_pano_rows["pano_id"].to_numpy()
+    map_keys = pd.Series([f"{base_directory}/{'segmentation_maps_without_trees' if off else 'segmentation_maps'}/{pano_id}.png" for pano_id, off in zip(pano_ids.tolist(), leaves_off.tolist())])
+
+    for segmentation_map_path, positions in map_keys.groupby(map_keys).indices.items():
+        if segmentation_map_path not in segmentation_maps:
+            segmentation_maps[segmentation_map_path] = np.array(Image.open(segmentation_map_path))
+        segmentation_map = segmentation_maps[segmentation_map_path]
+        map_height, map_width = segmentation_map.shape[:2]
+
+        # same as scale_point_to_segmentation_map + check_if_sun_is_blocked
+        x = sun_x[positions]
+        y = sun_y[positions]
+        scaled = (map_width != widths[positions]) | (map_height != heights[positions])
+        x = np.where(scaled, x * map_width / widths[positions], x).astype(int)
+        y = np.clip(np.where(scaled, y * map_height / heights[positions], y).astype(int), -map_height, map_height - 1)
+        classes = segmentation_map[y, x]
+
+        blocked = classes != SKY_CLASS
+        has_sun_glare[risk_rows[positions]] = ~blocked
+        blockage_type[risk_rows[positions]] = np.where(~blocked, "none", np.where(classes == BUILDING_CLASS, "building", np.where(classes == TREE_CLASS, "tree", "other")))
+
+    return has_sun_glare, angle_risk, blockage_type
@@ -11,6 +11,7 @@ import numpy as np
 from PIL import Image
 import pandas as pd
 from dotenv import load_dotenv
+from PanoramaStore import has_panoramic_in_store, link_panoramic_from_store, add_panoramic_to_store, read_metadata, get_store_path, PANORAMIC_FILE
 
 API_KEY = ""
 SESSION_ID = ""
@@ -19,6 +20,23 @@ ERROR_COUNT = 0
 DUPLICATE_IMAGE_CALLS = 0 # only 1 image is called, but this lets us know if that happens alot
 TOTAL_API_CALLS = 0
 API_CALLS = 0
+STORE_HITS = 0 # panoramics reused from the shared panorama store (no image calls needed)
+
+# Street View zoom level, lower zoom is faster (city-wide screening), higher zoom has more detail (crash-site studies)
+# zoom z is a grid of 2^z x 2^(z-1) tiles (512px each), ex: zoom 1 is the two tiles side by side
+ZOOM = 1
+MIN_ZOOM = 0
+MAX_ZOOM = 5
+TILE_SIZE = 512
+
+# per zoom download cost (reported at the end of tile grabbing)
+PANORAMICS_DOWNLOADED = 0
+TILES_DOWNLOADED = 0
+BYTES_DOWNLOADED = 0
+DOWNLOAD_SECONDS = 0
+
+# panoramic_data.csv is saved every this many new panoramics, so an interrupted run resumes from there
+PANORAMIC_DATA_CHECKPOINT_INTERVAL = 100
 
 def setup_session():
     global SESSION_ID
@@ -69,7 +87,7 @@ def check_if_calls_should_sleep():
 # gets the image for the panoId, the panorama automatically faces the direction of traggic (in the center
 def get_image_for_panoId(pano_id, output_path, tile_x=0, tile_y=0, z=1):
     check_if_calls_should_sleep()
-    url = f"https://tile.googleapis.com/v1/streetview/tiles/{z}/{tile_x}/{tile_y}?session={SESSION_ID}&key={API_KEY}&panoId={pano_id}&zoom=1"
+    url = f"https://tile.googleapis.com/v1/streetview/tiles/{z}/{tile_x}/{tile_y}?session={SESSION_ID}&key={API_KEY}&panoId={pano_id}&zoom={z}"
 
     response = requests.get(url)
     if response.status_code == 200:
@@ -176,23 +194,91 @@ def combine_panoramic_tiles(tile1_path, tile2_path, output_path):
     # Save the combined image
     combined_image.save(output_path)
 
+# columns, rows of tiles making up a panoramic at the given zoom
+def get_tile_layout(zoom):
+    if zoom < MIN_ZOOM or zoom > MAX_ZOOM:
+        raise ValueError(f"Zoom must be between {MIN_ZOOM} and {MAX_ZOOM}, got {zoom}")
+    columns = 2 ** zoom
+    rows = max(1, 2 ** (zoom - 1))
+    return columns, rows
+
+# (tile_x, tile_y, path) for every tile of a panoramic
+# single row layouts keep the original <pano_id>_<x>.jpg names
+def get_tile_paths(base_directory, pano_id, zoom):
+    columns, rows = get_tile_layout(zoom)
+    tile_paths = []
+    for tile_y in range(rows):
+        for tile_x in range(columns):
+            if rows == 1:
+                tile_paths.append((tile_x, tile_y, f"{base_directory}/tile_imgs/{pano_id}_{tile_x}.jpg"))
+            else:
+                tile_paths.append((tile_x, tile_y, f"{base_directory}/tile_imgs/{pano_id}_{tile_x}_{tile_y}.jpg"))
+    return tile_paths
+
+# max resolution of a panoramic at the given zoom (before black rows are removed)
+def get_zoom_resolution(zoom):
+    columns, rows = get_tile_layout(zoom)
+    return columns * TILE_SIZE, rows * TILE_SIZE
+
+# stitches any tile layout into a panoramic, removes black rows at the bottom and crops it so width is 2x height
+def stitch_panoramic_tiles(tile_paths, output_path):
+    with Image.open(tile_paths[0][2]) as first_tile:
+        tile_width, tile_height = first_tile.size
+
+    columns = max(tile_x for tile_x, _, _ in tile_paths) + 1
+    rows = max(tile_y for _, tile_y, _ in tile_paths) + 1
+    combined_image = Image.new("RGB", (columns * tile_width, rows * tile_height))
+
+    for tile_x, tile_y, tile_path in tile_paths:
+        with Image.open(tile_path) as tile:
+            combined_image.paste(tile, (tile_x * tile_width, tile_y * tile_height))
+
+    combined_image = remove_black_rows(combined_image)
+    width = min(combined_image.width, 2 * combined_image.height)
+    combined_image = combined_image.crop((0, 0, width, combined_image.height))
+    combined_image.save(output_path)
+
+    return combined_image.size
+
 def write_as_csv(filepath, dict):
     df = pd.DataFrame.from_dict(dict, orient='index')
     df.index.name = 'pano_id'
-    df.to_csv(filepath)
+    # write to a temp file first so an interrupted run never leaves a half written csv
+    df.to_csv(filepath + ".tmp")
+    os.replace(filepath + ".tmp", filepath)
 
 
 # returns true if was successful else false
-def save_panoramic_image_from_pano_id(pano_id, base_directory, saved_panoramic_imgs):
+def save_panoramic_image_from_pano_id(pano_id, base_directory, saved_panoramic_imgs, metadata=None, zoom=None):
     global DUPLICATE_IMAGE_CALLS
+    global STORE_HITS
+    global ERROR_COUNT
+    global PANORAMICS_DOWNLOADED
+    global TILES_DOWNLOADED
+    global BYTES_DOWNLOADED
+    global DOWNLOAD_SECONDS
+
+    if zoom is None:
+        zoom = ZOOM
     pano_save_path = f"{base_directory}/panoramic_imgs/{pano_id}.jpg"
-    image_0_save_path = f"{base_directory}/tile_imgs/{pano_id}_0.jpg"
-    image_1_save_path = f"{base_directory}/tile_imgs/{pano_id}_1.jpg"
+    tile_paths = get_tile_paths(base_directory, pano_id, zoom)
+    tile_save_paths = [tile_path for _, _, tile_path in tile_paths]
+
+    if pano_id not in saved_panoramic_imgs and has_panoramic_in_store(pano_id, zoom):
+        # another urban environment already grabbed this panoramic, so just reference it
+        if link_panoramic_from_store(pano_id, base_directory, tile_save_paths, zoom):
+            saved_panoramic_imgs.append(pano_id)
+            STORE_HITS += 1
+            return True
 
     try:
         if pano_id not in saved_panoramic_imgs:
-            image_0_content = get_image_for_panoId(pano_id, pano_save_path, 0, 0)
-            image_1_content = get_image_for_panoId(pano_id, pano_save_path, 1, 0)
+            start_time = time.time()
+            tile_contents = [get_image_for_panoId(pano_id, pano_save_path, tile_x, tile_y, z=zoom) for tile_x, tile_y, _ in tile_paths]
+            DOWNLOAD_SECONDS += time.time() - start_time
+            if any(tile_content is None for tile_content in tile_contents):
+                # at least one tile call failed, so the panoramic would be incomplete
+                raise ValueError(f"Missing tiles for {pano_id}")
             # add pano_id to saved_panoramic_imgs
             saved_panoramic_imgs.append(pano_id)
         else:
@@ -205,25 +291,46 @@ def save_panoramic_image_from_pano_id(pano_id, base_directory, saved_panoramic_i
         ERROR_COUNT += 1
         return False
 
-    # Save both of these images
-    with open(image_0_save_path, "wb") as file:
-        file.write(image_0_content)
-    
-    with open(image_1_save_path, "wb") as file:
-        file.write(image_1_content)
+    # Save all of the tiles
+    for tile_save_path, tile_content in zip(tile_save_paths, tile_contents):
+        with open(tile_save_path, "wb") as file:
+            file.write(tile_content)
+        BYTES_DOWNLOADED += len(tile_content)
 
-    # crop the images (since some have black rows at the bottom)
-    crop_both_tile_images(image_0_save_path, image_1_save_path)
+    PANORAMICS_DOWNLOADED += 1
+    TILES_DOWNLOADED += len(tile_paths)
 
+    # combine them into a panoramic (removing black rows at the bottom) and save it
+    stitch_panoramic_tiles(tile_paths, pano_save_path)
 
-    # combine them into a panoramic
-    combine_panoramic_tiles(image_0_save_path, image_1_save_path, pano_save_path)
-    # save the panoramic
+    # share it with every other urban environment
+    add_panoramic_to_store(pano_id, base_directory, tile_save_paths, metadata, zoom)
 
     return True
 
 
-def get_store_all_panoramics_from_segments(base_directory):
+# zoom of a panoramic that was already in panoramic_imgs before this run (it may have been grabbed at another zoom)
+# the store zoom that references this environment and holds the same image, otherwise guessed from the image width
+def get_saved_panoramic_zoom(base_directory, pano_id):
+    pano_path = f"{base_directory}/panoramic_imgs/{pano_id}.jpg"
+    environment_name = os.path.basename(os.path.normpath(base_directory))
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        if not has_panoramic_in_store(pano_id, zoom) or environment_name not in read_metadata(pano_id, zoom).get("environments", []):
+            continue
+        store_path = get_store_path(pano_id, PANORAMIC_FILE, zoom)
+        # hard linked, or copied when the store is on another drive
+        if os.path.samefile(store_path, pano_path) or os.path.getsize(store_path) == os.path.getsize(pano_path):
+            return zoom
+
+    # a panoramic is 2^zoom tiles wide before black rows are removed and the width is cropped to 2x the height
+    # (ex: zoom 1 is 832 to 1024 pixels wide)
+    with Image.open(pano_path) as img:
+        width = img.width
+    return int(np.clip(round(np.log2(width / TILE_SIZE)), MIN_ZOOM, MAX_ZOOM))
+
+
+# on_panoramic_saved(pano_id, zoom) is called as soon as each panoramic is saved (ex: to segment it while the rest download)
+def get_store_all_panoramics_from_segments(base_directory, on_panoramic_saved=None):
     global ERROR_COUNT
     panoramic_data_path = f"{base_directory}/panoramic_data.csv"
 
@@ -256,6 +363,7 @@ def get_store_all_panoramics_from_segments(base_directory):
         panoramic_data = panoramic_data.set_index('pano_id').T.to_dict()
     
     error_count = 0
+    saved_since_checkpoint = 0
 
     # loop through all segments
     for index, segment in segments.iterrows():
@@ -265,10 +373,11 @@ def get_store_all_panoramics_from_segments(base_directory):
             print(f"\tAlready have data for segment_id: {segment['segment_id']}, skipping")
             continue
 
-        # NOTE allows for partial saving if quotas are reached
-        # if index % 1000 == 0:
-        #     # evert 1000 segments, save the data as a safety measure
-        #     write_as_csv(panoramic_data_path, panoramic_data)
+        # NOTE allows for partial saving if quotas are reached (or the run is interrupted), the saved segments are skipped
+        # when it runs again
+        if saved_since_checkpoint >= PANORAMIC_DATA_CHECKPOINT_INTERVAL:
+            write_as_csv(panoramic_data_path, panoramic_data)
+            saved_since_checkpoint = 0
 
         segment_id = segment['segment_id']
         
@@ -290,11 +399,19 @@ def get_store_all_panoramics_from_segments(base_directory):
             date = coord_data['date']
             pano_year, pano_month = date.split("-")
             
-           
+            # reused panoramics keep the zoom they were grabbed at, only new ones are at ZOOM
+            was_saved = pano_id in saved_panoramic_imgs
 
-            if (save_panoramic_image_from_pano_id(pano_id, base_directory, saved_panoramic_imgs)):
+            if (save_panoramic_image_from_pano_id(pano_id, base_directory, saved_panoramic_imgs, coord_data)):
                 # succesful at getting and saving images (including panoramic)
                 # now just store the data about the coords
+                # (and the resolution, so segmentation and sun glare geometry match the image)
+                with Image.open(f"{panoramic_directory_path}/{pano_id}.jpg") as img:
+                    image_width, image_height = img.size
+                zoom = ZOOM
+                if was_saved:
+                    recorded_zoom = panoramic_data.get(pano_id, {}).get("zoom")
+                    zoom = int(recorded_zoom) if pd.notna(recorded_zoom) else get_saved_panoramic_zoom(base_directory, pano_id)
                 panoramic_data[pano_id] = {
                     "segment_id": segment_id,
                     "lat": segment_lat,
@@ -306,8 +423,14 @@ def get_store_all_panoramics_from_segments(base_directory):
                     "segment_headings": segment_headings,
                     "segment_links": segment_links,
                     "segment_heading_links": segment_heading_links,
-                    "segment_line_strings": segment_line_strings
+                    "segment_line_strings": segment_line_strings,
+                    "zoom": zoom,
+                    "image_width": image_width,
+                    "image_height": image_height
                 }
+                saved_since_checkpoint += 1
+                if on_panoramic_saved is not None:
+                    on_panoramic_saved(pano_id, zoom)
 
             else: 
                 error_count += 1
@@ -325,17 +448,31 @@ def get_store_all_panoramics_from_segments(base_directory):
 
 
 
-def grab_tiles_given_directory(base_directory, api_key):
+def print_zoom_cost_report():
+    columns, rows = get_tile_layout(ZOOM)
+    max_width, max_height = get_zoom_resolution(ZOOM)
+    print(f"\tZoom {ZOOM}: {columns}x{rows} tiles ({columns * rows} image calls) per panoramic, up to {max_width}x{max_height} pixels")
+    if PANORAMICS_DOWNLOADED > 0:
+        print(f"\tDownloaded {PANORAMICS_DOWNLOADED} panoramics ({TILES_DOWNLOADED} tiles, {BYTES_DOWNLOADED / 1e6:.1f} MB) in {DOWNLOAD_SECONDS:.1f} seconds")
+        print(f"\tAverage per panoramic: {BYTES_DOWNLOADED / PANORAMICS_DOWNLOADED / 1e3:.0f} KB, {DOWNLOAD_SECONDS / PANORAMICS_DOWNLOADED:.2f} seconds")
+
+
+def grab_tiles_given_directory(base_directory, api_key, zoom=1, on_panoramic_saved=None):
     global API_KEY
+    global ZOOM
     API_KEY = api_key
+    get_tile_layout(zoom) # validates the zoom
+    ZOOM = zoom
     print(f"API_KEY = {API_KEY}")
     setup_session()
-    get_store_all_panoramics_from_segments(base_directory)
+    get_store_all_panoramics_from_segments(base_directory, on_panoramic_saved)
     
     print("\tAll Panoramic Images Grabbed")
     print(f"\tTotal API Calls: {TOTAL_API_CALLS}")
     print(f"\tDuplicate Image Calls: {DUPLICATE_IMAGE_CALLS}")
+    print(f"\tPanoramics Reused From Store: {STORE_HITS}")
     print(f"\tTotal Image Grabbing Errors: {ERROR_COUNT}")
+    print_zoom_cost_report()
 
 
 
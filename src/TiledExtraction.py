@@ -0,0 +1,176 @@
+# Description:
+# Tiled road network extraction for metro-scale regions
+# The place polygon is split into a grid of cells, each cell's drive network is built independently in a process pool
+# (so peak memory is bounded by the tile size), and the segments are streamed to disk tile by tile into segments.csv
+# The segment graph is then written from segments.csv in chunks (write_segment_graph_from_csv), so it does not load the
+# whole area either
+
+import os
+import math
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import shapely
+from shapely.geometry import box
+import osmnx as ox
+from osmnx._errors import InsufficientResponseError
+from SegmentBuilding import build_segment_tables, SEGMENT_COLUMNS
+from GraphLoading import load_drive_graph, read_boundary_polygon
+from SegmentGraph import convert_segments_csv_to_segment_graph
+
+KM_PER_DEGREE_LAT = 111.32
+
+
+# square-ish cells (tile_size_km on each side) covering the polygon, only cells that overlap it are returned
+# each tile: (row, col, (min_long, min_lat, max_long, max_lat))
+def make_tile_grid(polygon, tile_size_km):
+    min_long, min_lat, max_long, max_lat = polygon.bounds
+    center_lat = (min_lat + max_lat) / 2
+
+    lat_step = tile_size_km / KM_PER_DEGREE_LAT
+    long_step = tile_size_km / (KM_PER_DEGREE_LAT * math.cos(math.radians(center_lat)))
+
+    # +1 so the max bounds are strictly inside the last cell (cells are half-open)
+    rows = int((max_lat - min_lat) // lat_step) + 1
+    cols = int((max_long - min_long) // long_step) + 1
+
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            bounds = (min_long + col * long_step, min_lat + row * lat_step, min_long + (col + 1) * long_step, min_lat + (row + 1) * lat_step)
+            if box(*bounds).intersects(polygon):
+                tiles.append((row, col, bounds))
+    return tiles
+
+
+def get_tile_paths(tiles_directory, row, col):
+    return f"{tiles_directory}/tile_{row}_{col}.csv", f"{tiles_directory}/tile_{row}_{col}_boundary.csv"
+
+# writes to a temp file first so a tile file only exists once it is complete (used to resume)
+def write_tile_csv(segments, path):
+    segments.index.name = "segment_id"
+    segments.to_csv(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+
+# (half-open) cell membership, so every node belongs to exactly one tile
+def in_tile(lats, longs, bounds):
+    min_long, min_lat, max_long, max_lat = bounds
+    return (longs >= min_long) & (longs < max_long) & (lats >= min_lat) & (lats < max_lat)
+
+
+# builds one tile (runs in a worker process)
+# a tile owns the nodes inside of its cell and every edge leaving them (edges are owned by their u node), so edges
+# crossing into another tile are built once. The tile's graph also includes the edges coming in from other tiles, so
+# links added to owned nodes by those edges are not lost.
+# segments from edges that cross the tile boundary go into a separate boundary file (deduplicated when merging)
+def build_tile_segments(tile):
+    row, col, bounds, place_polygon, tiles_directory, osm_file = tile
+    tile_path, boundary_path = get_tile_paths(tiles_directory, row, col)
+    empty = pd.DataFrame(columns=SEGMENT_COLUMNS)
+
+    area = box(*bounds).intersection(place_polygon)
+    try:
+        if area.is_empty:
+            raise ValueError("Tile does not overlap the place")
+        # with an osm_file, only the tile's part of the extract is read
+        graph = load_drive_graph(polygon=area, osm_file=osm_file, retain_all=True, truncate_by_edge=True)
+    except (ValueError, InsufficientResponseError):
+        # no roads in this tile
+        write_tile_csv(empty.copy(), boundary_path)
+        write_tile_csv(empty.copy(), tile_path)
+        return row, col, 0, 0
+
+    nodes, edges = ox.graph_to_gdfs(graph, fill_edge_geometry=False)
+
+    # same as building the whole place at once: nodes outside the place (and their edges) are dropped
+    inside_place = shapely.contains_xy(place_polygon, nodes.geometry.x.values, nodes.geometry.y.values)
+    nodes = nodes[inside_place]
+    edges = edges[edges.index.get_level_values(0).isin(nodes.index) & edges.index.get_level_values(1).isin(nodes.index)]
+
+    # in the whole place's order: osmnx adds nodes in ascending OSM id order (the order Overpass and .osm extracts
+    # list them) and orders edges by their u node, but a tile's own response does not have to be in that order (ex: one
+    # split into several queries), and the order decides which edge creates a segment two edges share
+    nodes = nodes.sort_index(kind="stable")
+    edges = edges.iloc[np.argsort(edges.index.get_level_values(0), kind="stable")]
+
+    node_segments, intermediate_segments = build_segment_tables(nodes, edges)
+
+    owned_node_ids = nodes.index[in_tile(nodes.geometry.y.values, nodes.geometry.x.values, bounds)]
+    owned_nodes = node_segments[in_tile(node_segments['lat'].values, node_segments['long'].values, bounds)]
+
+    owned_edge = intermediate_segments['u_id'].isin(owned_node_ids)
+    crossing_edge = ~intermediate_segments['v_id'].isin(owned_node_ids)
+    inner_segments = intermediate_segments[owned_edge & ~crossing_edge][SEGMENT_COLUMNS]
+    # the owning edge's u node is kept, so duplicates are resolved in the whole place's edge order when merging
+    boundary_segments = intermediate_segments[owned_edge & crossing_edge][SEGMENT_COLUMNS + ["u_id"]]
+
+    # boundary file first, the tile file marks the tile as done
+    write_tile_csv(boundary_segments, boundary_path)
+    write_tile_csv(pd.concat([owned_nodes, inner_segments]), tile_path)
+
+    return row, col, len(owned_nodes) + len(inner_segments), len(boundary_segments)
+
+
+# streams every tile's segments into one segments.csv (only the boundary segments are loaded, to deduplicate them)
+def merge_tile_segments(tiles, tiles_directory, output_file):
+    header_written = False
+    with open(output_file, "w", newline="") as output:
+        for row, col, _ in tiles:
+            tile_path, _ = get_tile_paths(tiles_directory, row, col)
+            with open(tile_path, "r", newline="") as tile_file:
+                header = tile_file.readline()
+                if not header_written:
+                    output.write(header)
+                    header_written = True
+                for line in tile_file:
+                    output.write(line)
+
+    # the same segment can be created from both sides of a boundary (ex: the midpoint of a two way street), building
+    # the whole place keeps the one from the first edge, so the lowest u id wins (see build_tile_segments)
+    boundary_segments = [pd.read_csv(get_tile_paths(tiles_directory, row, col)[1], index_col="segment_id") for row, col, _ in tiles]
+    boundary_segments = [segments for segments in boundary_segments if len(segments) > 0]
+    if boundary_segments:
+        boundary_segments = pd.concat(boundary_segments)
+        if "u_id" in boundary_segments:
+            # stable, so tiles written before u_id was kept stay in tile order (after the others)
+            boundary_segments = boundary_segments.sort_values("u_id", kind="stable")
+        boundary_segments = boundary_segments[~boundary_segments.index.duplicated(keep="first")]
+        boundary_segments[SEGMENT_COLUMNS].to_csv(output_file, mode="a", header=not header_written)
+
+
+def store_all_nodes_at_location_tiled(location, base_directory, tile_size_km=5, workers=None, osm_file=None, boundary_file=None):
+    """
+        Location: string representing the location to grab the nodes from
+            Example: "Arlington, VA, USA"
+        tile_size_km: size of each grid cell, peak memory (per worker) grows with it
+        workers: number of processes (defaults to the number of CPUs)
+        osm_file: local .osm/.osm.pbf extract to build every tile from instead of live OSM services (needs boundary_file)
+        boundary_file: GeoJSON/shapefile of the place, used instead of geocoding the location
+    """
+    if osm_file and not boundary_file:
+        raise ValueError("Tiled builds from an osm_file need a boundary_file (the place polygon), the location is not geocoded offline")
+    os.makedirs(base_directory, exist_ok=True)
+    tiles_directory = f"{base_directory}/segment_tiles"
+    os.makedirs(tiles_directory, exist_ok=True)
+
+    if boundary_file:
+        place_polygon = read_boundary_polygon(boundary_file)
+    else:
+        place_polygon = shapely.union_all(ox.geocode_to_gdf(location).geometry.values)
+    tiles = make_tile_grid(place_polygon, tile_size_km)
+
+    # tiles already built by an earlier (interrupted) run are skipped
+    pending = [(row, col, bounds, place_polygon, tiles_directory, osm_file) for row, col, bounds in tiles
+               if not os.path.exists(get_tile_paths(tiles_directory, row, col)[0])]
+    print(f"\tGrabbing all segments in {len(tiles)} tiles ({len(tiles) - len(pending)} already built)")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for count, (row, col, segment_count, boundary_count) in enumerate(executor.map(build_tile_segments, pending), start=1):
+            print(f"\t\tTile ({row}, {col}) done: {segment_count} segments, {boundary_count} on the boundary ({count}/{len(pending)})")
+
+    output_file = f"{base_directory}/segments.csv"
+    merge_tile_segments(tiles, tiles_directory, output_file)
+    print(f"\tSegments dataset saved to: {output_file}")
+    # streamed, memory does not grow with the line strings and links of the whole area
+    convert_segments_csv_to_segment_graph(base_directory)
@@ -1,11 +1,25 @@
 import os
+import time
 import json
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.geometry import LineString
 from geopy.distance import geodesic
 import folium
+from scipy.sparse import csr_matrix, vstack, save_npz, load_npz
 
+GLARE_BUFFER_METERS = 10
+# only used when there is no data to pick a local UTM zone from (EPSG:3857 units are not meters away from the equator)
+METRIC_CRS = "EPSG:3857"
+# features per chunk and characters per read when streaming a traffic GeoJSON
+TRAFFIC_CHUNK_SIZE = 50000
+GEOJSON_READ_SIZE = 1 << 20
+# probeCount of the first item of a segmentProbeCounts JSON string
+PROBE_COUNT_PATTERN = r'^\s*\[\s*\{[^{}]*?"probeCount"\s*:\s*(-?\d+(?:\.\d+)?)'
+TRAFFIC_GLARE_INDEX_DIRECTORY = "traffic_glare_index"
+# inputs a cached traffic glare index was built from
+TRAFFIC_GLARE_INDEX_SOURCE_FILE = "source.json"
 
 # Function to check if the 'segmentProbeCounts' is a JSON string and parse it
 def get_probe_count(segment):
@@ -47,6 +61,305 @@ def get_coordinate_from_segment(segment):
     return []
 
 
+# probe count of every segment (NaN where get_probe_count gives "N/A"), segmentProbeCounts can be JSON strings or
+# already parsed lists (streamed features)
+def get_probe_counts(traffic_gdf):
+    if 'segmentProbeCounts' not in traffic_gdf:
+        return pd.Series(np.nan, index=traffic_gdf.index)
+    values = traffic_gdf['segmentProbeCounts']
+    is_string = values.map(lambda value: isinstance(value, str)).to_numpy(dtype=bool)
+    is_list = values.map(lambda value: isinstance(value, list)).to_numpy(dtype=bool)
+
+    probe_counts = pd.Series(np.nan, index=traffic_gdf.index)
+    if is_string.any():
+        probe_counts[is_string] = pd.to_numeric(values[is_string].str.extract(PROBE_COUNT_PATTERN, expand=False), errors="coerce")
+    if is_list.any():
+        probe_counts[is_list] = pd.to_numeric(values[is_list].str[0].str.get('probeCount'), errors="coerce")
+    return probe_counts
+
+# local UTM zone of the first GeoDataFrame with geometry, so buffers are in meters on the ground
+# (a buffer of 10 EPSG:3857 units is only ~7.8 meters at DC's latitude)
+def get_metric_crs(*gdfs):
+    for gdf in gdfs:
+        geometries = gdf.geometry[gdf.geometry.notna() & ~gdf.geometry.is_empty]
+        if len(geometries):
+            return geometries.estimate_utm_crs()
+    return METRIC_CRS
+
+# buffer of every traffic segment with coordinates, reprojected once for the whole GeoDataFrame
+# metric_crs: projected CRS (meters) to buffer in, defaults to the segments' UTM zone
+def buffer_traffic_segments(traffic_gdf, buffer_meters=GLARE_BUFFER_METERS, metric_crs=None):
+    has_coordinates = traffic_gdf.geometry.notna() & ~traffic_gdf.geometry.is_empty
+    if metric_crs is None:
+        metric_crs = get_metric_crs(traffic_gdf)
+    segments = traffic_gdf[has_coordinates].to_crs(metric_crs)
+    return gpd.GeoDataFrame(geometry=segments.geometry.buffer(buffer_meters).to_numpy(), crs=metric_crs, index=pd.RangeIndex(len(segments))), has_coordinates
+
+# per segment glare flag (a glare point within the segment buffer, like segment_has_glare but with the radius in meters
+# on the ground rather than EPSG:3857 units) from one spatial join
+# of all glare points against all buffers (the join uses the STRtree of the buffers)
+def get_segments_with_glare(traffic_gdf, sun_glare_gdf, buffer_meters=GLARE_BUFFER_METERS, metric_crs=None):
+    if metric_crs is None:
+        metric_crs = get_metric_crs(sun_glare_gdf, traffic_gdf)
+    buffers, has_coordinates = buffer_traffic_segments(traffic_gdf, buffer_meters, metric_crs)
+    glare_points = sun_glare_gdf.loc[sun_glare_gdf['has_sun_glare'].astype(bool), ['geometry']].to_crs(metric_crs)
+    joined = gpd.sjoin(glare_points, buffers, how="inner", predicate="within")
+
+    has_glare = pd.Series(False, index=traffic_gdf.index)
+    segment_positions = np.flatnonzero(has_coordinates.to_numpy())[joined['index_right'].unique()]
+    has_glare.iloc[segment_positions] = True
+    return has_glare, has_coordinates
+
+# glare flag and probe count per segment plus probe count weighted totals, for a whole traffic GeoDataFrame at once
+# sun_glare_gdf: output of preprocess_sun_glare_data
+def overlay_sun_glare_on_traffic(traffic_gdf, sun_glare_gdf, buffer_meters=GLARE_BUFFER_METERS, metric_crs=None):
+    has_glare, has_coordinates = get_segments_with_glare(traffic_gdf, sun_glare_gdf, buffer_meters, metric_crs)
+    probe_counts = get_probe_counts(traffic_gdf)
+
+    overlay = pd.DataFrame({'has_coordinates': has_coordinates, 'has_glare': has_glare, 'probe_count': probe_counts}, index=traffic_gdf.index)
+    totals = summarize_traffic_overlay(overlay)
+    return overlay, totals
+
+# totals of an overlay (or several concatenated overlays)
+def summarize_traffic_overlay(overlay):
+    return {
+        'segments': int(len(overlay)),
+        'segments_with_coordinates': int(overlay['has_coordinates'].sum()),
+        'segments_with_glare': int(overlay['has_glare'].sum()),
+        'probe_count': float(overlay['probe_count'].sum()),
+        'probe_count_with_glare': float(overlay.loc[overlay['has_glare'], 'probe_count'].sum()),
+    }
+
+def add_traffic_overlay_totals(totals, chunk_totals):
+    if totals is None:
+        return dict(chunk_totals)
+    return {key: totals[key] + chunk_totals[key] for key in totals}
+
+
+# features of a GeoJSON FeatureCollection one at a time, only read_size characters (plus the feature or top level member
+# being decoded) are held in memory. The other top level members are decoded and skipped (so a "features" key nested in
+# them is not taken for the collection's), raises ValueError when the file ends before the collection does
+def iter_geojson_features(geojson_path, read_size=GEOJSON_READ_SIZE):
+    decoder = json.JSONDecoder()
+    with open(geojson_path, "r", encoding="utf-8") as file:
+        buffer = ""
+        position = 0
+
+        # next character that is not skipped (reads more of the file when needed), None at the end of the file
+        def next_character(skipped=" \t\r\n"):
+            nonlocal buffer, position
+            while True:
+                while position < len(buffer) and buffer[position] in skipped:
+                    position += 1
+                if position < len(buffer):
+                    return buffer[position]
+                buffer = file.read(read_size)
+                position = 0
+                if not buffer:
+                    return None
+
+        # the JSON value at position, reading more of the file until it is complete (a value that ends with the buffer
+        # can continue in the file, ex: a number)
+        def decode_value():
+            nonlocal buffer, position
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buffer, position)
+                    if end < len(buffer):
+                        position = end
+                        return value
+                except json.JSONDecodeError:
+                    end = None
+                chunk = file.read(read_size)
+                if not chunk:
+                    if end is None:
+                        raise ValueError(f"{geojson_path} ends in the middle of a value (truncated?)")
+                    position = end
+                    return value
+                buffer = buffer[position:] + chunk
+                position = 0
+
+        def expect(character):
+            nonlocal position
+            found = next_character()
+            if found != character:
+                raise ValueError(f"{geojson_path} is not a GeoJSON FeatureCollection (expected {character!r}, found {found!r})")
+            position += 1
+
+        expect("{")
+        # top level members up to the features array
+        while True:
+            character = next_character(" \t\r\n,")
+            if character == "}":
+                return
+            if character is None:
+                raise ValueError(f"{geojson_path} ends before its FeatureCollection does (truncated?)")
+            key = decode_value()
+            expect(":")
+            if key == "features":
+                break
+            next_character()
+            decode_value()
+
+        expect("[")
+        while True:
+            character = next_character(" \t\r\n,")
+            if character == "]":
+                return
+            if character is None:
+                raise ValueError(f"{geojson_path} ends before its features array does (truncated?)")
+            yield decode_value()
+
+# GeoDataFrames of at most chunk_size features, indexed by feature number in the file
+def read_geojson_chunks(geojson_path, chunk_size=TRAFFIC_CHUNK_SIZE, crs="EPSG:4326"):
+    features = []
+    start = 0
+    for feature in iter_geojson_features(geojson_path):
+        features.append(feature)
+        if len(features) == chunk_size:
+            yield make_feature_chunk(features, start, crs)
+            start += len(features)
+            features = []
+    if features:
+        yield make_feature_chunk(features, start, crs)
+
+def make_feature_chunk(features, start, crs):
+    chunk = gpd.GeoDataFrame.from_features(features, crs=crs)
+    chunk.index = pd.RangeIndex(start, start + len(chunk))
+    return chunk
+
+# overlay of a traffic GeoJSON of any size, chunk by chunk so peak memory depends on chunk_size and not on the file
+# per segment results are appended to output_path (csv) if given, returns the totals of the whole file
+def overlay_sun_glare_on_traffic_file(geojson_path, sun_glare_gdf, chunk_size=TRAFFIC_CHUNK_SIZE, buffer_meters=GLARE_BUFFER_METERS, output_path=None):
+    totals = None
+    # one UTM zone for every chunk (from the glare points, else from the first chunk)
+    metric_crs = get_metric_crs(sun_glare_gdf) if len(sun_glare_gdf) else None
+    for chunk_number, traffic_chunk in enumerate(read_geojson_chunks(geojson_path, chunk_size)):
+        if metric_crs is None:
+            metric_crs = get_metric_crs(traffic_chunk)
+        overlay, chunk_totals = overlay_sun_glare_on_traffic(traffic_chunk, sun_glare_gdf, buffer_meters, metric_crs)
+        totals = add_traffic_overlay_totals(totals, chunk_totals)
+        if output_path is not None:
+            overlay.to_csv(output_path, mode="w" if chunk_number == 0 else "a", header=chunk_number == 0, index_label="feature")
+        print(f"\tProcessed {totals['segments']} segments ({totals['segments_with_glare']} with glare)")
+
+    if totals is None:
+        totals = summarize_traffic_overlay(pd.DataFrame(columns=['has_coordinates', 'has_glare', 'probe_count']))
+    return totals
+
+
+
+# sun glare rows sit on their panorama's coordinates, so the traffic segment to glare point association is the same for
+# every timestamp: a sparse (segment x panorama) matrix, True where the panorama is within the segment buffer
+# panorama_gdf has to be in a metric CRS already (segments are buffered in it)
+def build_traffic_panorama_matrix(traffic_gdf, panorama_gdf, buffer_meters=GLARE_BUFFER_METERS):
+    buffers, has_coordinates = buffer_traffic_segments(traffic_gdf, buffer_meters, panorama_gdf.crs)
+    joined = gpd.sjoin(panorama_gdf[['geometry']], buffers, how="inner", predicate="within")
+    segment_positions = np.flatnonzero(has_coordinates.to_numpy())[joined['index_right'].to_numpy()]
+    pano_positions = panorama_gdf.index.get_indexer(joined.index)
+    matrix = csr_matrix((np.ones(len(joined), dtype=bool), (segment_positions, pano_positions)), shape=(len(traffic_gdf), len(panorama_gdf)))
+    return matrix, has_coordinates
+
+# association of every traffic segment in a GeoJSON (streamed in chunks) with the panoramas of an environment
+def build_traffic_glare_index(base_directory, geojson_path, chunk_size=TRAFFIC_CHUNK_SIZE, buffer_meters=GLARE_BUFFER_METERS):
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv", usecols=['pano_id', 'lat', 'long']).drop_duplicates('pano_id')
+    panorama_gdf = gpd.GeoDataFrame(index=pd.Index(panoramic_data['pano_id'].astype(str)),
+                                    geometry=gpd.points_from_xy(panoramic_data['long'], panoramic_data['lat']),
+                                    crs="EPSG:4326")
+    panorama_gdf = panorama_gdf.to_crs(get_metric_crs(panorama_gdf))
+
+    matrices = []
+    probe_counts = []
+    has_coordinates = []
+    for traffic_chunk in read_geojson_chunks(geojson_path, chunk_size):
+        matrix, chunk_has_coordinates = build_traffic_panorama_matrix(traffic_chunk, panorama_gdf, buffer_meters)
+        matrices.append(matrix)
+        probe_counts.append(get_probe_counts(traffic_chunk).to_numpy(dtype=float))
+        has_coordinates.append(chunk_has_coordinates.to_numpy(dtype=bool))
+
+    return {
+        "matrix": vstack(matrices, format="csr") if matrices else csr_matrix((0, len(panorama_gdf)), dtype=bool),
+        "pano_ids": panorama_gdf.index.to_numpy(dtype=str),
+        "probe_counts": np.concatenate(probe_counts) if probe_counts else np.zeros(0),
+        "has_coordinates": np.concatenate(has_coordinates) if has_coordinates else np.zeros(0, dtype=bool),
+    }
+
+# the files and parameters an index is built from (sizes and modification times, so an edited file rebuilds it)
+def get_traffic_glare_index_source(base_directory, geojson_path, chunk_size=TRAFFIC_CHUNK_SIZE, buffer_meters=GLARE_BUFFER_METERS):
+    source = {"chunk_size": chunk_size, "buffer_meters": buffer_meters}
+    for name, path in (("traffic", geojson_path), ("panoramic_data", f"{base_directory}/panoramic_data.csv")):
+        source[name] = {"path": os.path.abspath(path), "size": os.path.getsize(path), "modified": os.path.getmtime(path)}
+    # as it reads back from json
+    return json.loads(json.dumps(source))
+
+def save_traffic_glare_index(traffic_glare_index, directory, source=None):
+    os.makedirs(directory, exist_ok=True)
+    # the source is written last, so an interrupted save is never mistaken for a complete index
+    source_path = f"{directory}/{TRAFFIC_GLARE_INDEX_SOURCE_FILE}"
+    if os.path.exists(source_path):
+        os.remove(source_path)
+    save_npz(f"{directory}/matrix.npz", traffic_glare_index["matrix"])
+    for name in ("pano_ids", "probe_counts", "has_coordinates"):
+        np.save(f"{directory}/{name}.npy", traffic_glare_index[name])
+    if source is not None:
+        with open(source_path + ".tmp", "w") as file:
+            json.dump(source, file)
+        os.replace(source_path + ".tmp", source_path)
+    print(f"\tTraffic glare index saved to: {directory}")
+
+def load_traffic_glare_index(directory):
+    traffic_glare_index = {"matrix": load_npz(f"{directory}/matrix.npz").tocsr()}
+    for name in ("pano_ids", "probe_counts", "has_coordinates"):
+        traffic_glare_index[name] = np.load(f"{directory}/{name}.npy")
+    return traffic_glare_index
+
+def load_traffic_glare_index_source(directory):
+    source_path = f"{directory}/{TRAFFIC_GLARE_INDEX_SOURCE_FILE}"
+    if not os.path.exists(source_path):
+        return None
+    with open(source_path, "r") as file:
+        return json.load(file)
+
+# the cached index of an environment, built (and saved) from the GeoJSON the first time and rebuilt whenever the
+# GeoJSON, panoramic_data.csv, chunk_size or buffer_meters change
+def get_traffic_glare_index(base_directory, geojson_path, rebuild=False, chunk_size=TRAFFIC_CHUNK_SIZE, buffer_meters=GLARE_BUFFER_METERS):
+    directory = f"{base_directory}/{TRAFFIC_GLARE_INDEX_DIRECTORY}"
+    source = get_traffic_glare_index_source(base_directory, geojson_path, chunk_size, buffer_meters)
+    if not rebuild and load_traffic_glare_index_source(directory) == source:
+        return load_traffic_glare_index(directory)
+    traffic_glare_index = build_traffic_glare_index(base_directory, geojson_path, chunk_size, buffer_meters)
+    save_traffic_glare_index(traffic_glare_index, directory, source)
+    return traffic_glare_index
+
+
+# True for every panorama (in index order) with at least one glare row in the sun glare data
+def get_panorama_glare_vector(traffic_glare_index, sun_glare_df):
+    glare_pano_ids = sun_glare_df.loc[sun_glare_df['has_sun_glare'].astype(bool), 'pano_id'].astype(str).unique()
+    positions = pd.Index(traffic_glare_index["pano_ids"]).get_indexer(glare_pano_ids)
+    pano_glare = np.zeros(len(traffic_glare_index["pano_ids"]), dtype=bool)
+    pano_glare[positions[positions >= 0]] = True
+    return pano_glare
+
+# (segment x time) glare exposure for any number of sun glare timestamps, with one sparse product for all of them
+# returns (exposure DataFrame with one bool column per date string, per timestamp totals DataFrame)
+def compute_traffic_glare_exposure(traffic_glare_index, base_directory, date_strings):
+    start_time = time.perf_counter()
+    pano_glare = np.column_stack([
+        get_panorama_glare_vector(traffic_glare_index, pd.read_csv(f"{base_directory}/sun_glare_data_{date_string}.csv", usecols=['pano_id', 'has_sun_glare']))
+        for date_string in date_strings
+    ]) if date_strings else np.zeros((len(traffic_glare_index["pano_ids"]), 0), dtype=bool)
+
+    exposure = np.asarray(traffic_glare_index["matrix"].astype(np.int32) @ pano_glare.astype(np.int32)) > 0
+    probe_counts = np.nan_to_num(traffic_glare_index["probe_counts"])
+
+    totals = pd.DataFrame({
+        'segments_with_glare': exposure.sum(axis=0),
+        'probe_count_with_glare': probe_counts @ exposure,
+    }, index=pd.Index(date_strings, name='date_string'))
+    print(f"\tExposure of {exposure.shape[0]} segments at {len(date_strings)} timestamps in {time.perf_counter() - start_time:.2f} seconds")
+    return pd.DataFrame(exposure, columns=date_strings), totals
+
+
 
 if __name__ == "__main__":
     print("Running TrafficOverlay.py")
@@ -57,26 +370,11 @@ if __name__ == "__main__":
 
     print("Loading dataframes...")
     sun_glare_df = pd.read_csv(f"{base_directory}/washington_dc/sun_glare_data_{date_string}.csv")
-    geojson_df = gpd.read_file(f"{script_dir}/../public_data/dc_traffic_data.geojson")
-    
+
     # preprocess the sun glare data 
     sun_glare_df = preprocess_sun_glare_data(sun_glare_df)
-    line_coords = []  
-    total_drivers_effected = 0
-    # iterate through geojson_df and process each segment
-    print(f"Processing {geojson_df.size} segments... This may take a while")    
-    for index, segment in geojson_df.iterrows():
-
-        if 'segmentProbeCounts' in segment:
-            probe_count = get_probe_count(segment)
-            coords = get_coordinate_from_segment(segment)
-            
-            if coords:  # Only check for glare if coordinates are available
-                has_glare = segment_has_glare(coords, sun_glare_df)
-                glare_status = "Has glare" if has_glare else "No glare"
-            else:
-                glare_status = "No coordinates"
-                continue
-            total_drivers_effected += 1 if has_glare else 0
-         
-    print(f"Total drivers in traffic congestion effected by glare: {total_drivers_effected}")
\ No newline at end of file
+    # the traffic data is streamed in chunks, it does not have to fit in memory
+    totals = overlay_sun_glare_on_traffic_file(f"{script_dir}/../public_data/dc_traffic_data.geojson", sun_glare_df)
+
+    print(f"Total drivers in traffic congestion effected by glare: {totals['segments_with_glare']}")
+    print(f"Probe counts on segments with glare: {totals['probe_count_with_glare']:.0f} of {totals['probe_count']:.0f}")
@@ -1,9 +1,20 @@
 
 import folium
 import math
-from shapely.geometry import LineString
 import pandas as pd
-import ast
+import os
+import json
+import base64
+import time
+import numpy as np
+import shapely
+from PIL import Image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from branca.element import MacroElement, Template
+from SegmentGraph import has_segment_graph, convert_segments_csv_to_segment_graph, load_segment_graph, get_segment_graph_directory, get_segment_indices
 
 def apply_offset_to_coordinates(coord, heading, offset_buckets):
 
@@ -34,39 +45,21 @@ def apply_offset_to_coordinates(coord, heading, offset_buckets):
 
     return modified_lat, modified_lon
 
-def draw_linestring_on_map(sun_glare_id,line_string, map_object, color, heading):
-    one = 0.00001
-    half = 0.00001
-    modifier = 2
-    
-    offset_buckets = {
-        "north": (-half, -one),        
-        "northeast": (modifier*-half, modifier*-half),  
-        "east": (-one, -half),        
-        "southeast": (modifier*-half, modifier*half),  
-        "south": (half, one),      
-        "southwest": (modifier*half, modifier*half), 
-        "west": (one, half),       
-        "northwest": (modifier*half, modifier*-half),  
-    }
-
-    if line_string:
-        coordinates = [(coord[1], coord[0]) for coord in line_string.coords]
-        
-        if heading is not None and offset_buckets:
-            # apply the offset to each coordinate based on the heading
-            coordinates = [apply_offset_to_coordinates(coord, heading, offset_buckets) for coord in coordinates]
-        
-        # create a PolyLine with the given coordinates and color
-        folium.PolyLine(
-            locations=coordinates,
-            color=color,
-            weight=6,
-            opacity=0.7,
-            popup=f"{sun_glare_id}"
-        ).add_to(map_object)
-    else:
-        print("\tLineString is empty, cannot draw.")
+# (long, lat) offset of a drawn line for each heading bucket, so both directions of a street are visible
+OFFSET_ONE = 0.00001
+OFFSET_HALF = 0.00001
+OFFSET_MODIFIER = 2
+
+OFFSET_BUCKETS = {
+    "north": (-OFFSET_HALF, -OFFSET_ONE),
+    "northeast": (OFFSET_MODIFIER*-OFFSET_HALF, OFFSET_MODIFIER*-OFFSET_HALF),
+    "east": (-OFFSET_ONE, -OFFSET_HALF),
+    "southeast": (OFFSET_MODIFIER*-OFFSET_HALF, OFFSET_MODIFIER*OFFSET_HALF),
+    "south": (OFFSET_HALF, OFFSET_ONE),
+    "southwest": (OFFSET_MODIFIER*OFFSET_HALF, OFFSET_MODIFIER*OFFSET_HALF),
+    "west": (OFFSET_ONE, OFFSET_HALF),
+    "northwest": (OFFSET_MODIFIER*OFFSET_HALF, OFFSET_MODIFIER*-OFFSET_HALF),
+}
 
 def convert_anti_clockwise_east_heading_to_clockwise_north(anti_clockwise_heading):
     # convert the heading from anti-clockwise east to clockwise north
@@ -115,83 +108,573 @@ def get_closest_segment_heading(segment_headings, target_heading):
         
 
 
-def visualize_just_data(base_directory, date_string, center_point):
-    
-    sun_glare_dataset_path = f"{base_directory}/sun_glare_data_{date_string}.csv"
-    segments_dataset_path = f"{base_directory}/segments.csv"
-    panoramic_dataset_path = f"{base_directory}/panoramic_data.csv"
-
-    sun_glare_data = pd.read_csv(sun_glare_dataset_path)
-    segments_data = pd.read_csv(segments_dataset_path)
-    panoramic_data = pd.read_csv(panoramic_dataset_path)
-
-    segments_data['headings'] = segments_data['headings'].apply(ast.literal_eval)
-    segments_data['line_strings'] = segments_data['line_strings'].apply(ast.literal_eval)
-    segments_data['segment_links'] = segments_data['segment_links'].apply(ast.literal_eval)
-    segments_data['heading_links'] = segments_data['heading_links'].apply(ast.literal_eval)
-
+# Vectorized map builder (one line per glare row and segment link of its closest segment heading)
+# glare rows, panoramas and segments are joined once by index, and colors, closest headings, links and offset
+# coordinates are computed for every row at once from the segment graph arrays
+
+# heading bucket order used by apply_offset_to_coordinates (45 degree buckets, north is centered on 0)
+OFFSET_BUCKET_ORDER = ["north", "northeast", "east", "southeast", "south", "southwest", "west", "northwest"]
+
+
+# same as get_circle_color_for_sun_glare for every row
+def get_circle_colors_for_sun_glare(sun_glare_data):
+    angle_risk = (sun_glare_data['angle_risk'] == True).to_numpy()
+    has_sun_glare = (sun_glare_data['has_sun_glare'] == True).to_numpy()
+    blockage_type = sun_glare_data['blockage_type'].to_numpy()
+
+    return np.select(
+        [~angle_risk, has_sun_glare, blockage_type == 'building', blockage_type == 'tree'],
+        ['green', 'red', 'orange', 'yellow'],
+        default='black')
+
+def convert_anti_clockwise_east_headings_to_clockwise_north(anti_clockwise_headings):
+    clockwise_headings = 90 - np.asarray(anti_clockwise_headings, dtype=float)
+    return np.where(clockwise_headings < 0, clockwise_headings + 360, clockwise_headings)
+
+# (long, lat) offsets of each heading, same buckets as apply_offset_to_coordinates
+def get_offsets_for_headings(headings, offset_buckets=OFFSET_BUCKETS):
+    bucket_offsets = np.array([offset_buckets[bucket] for bucket in OFFSET_BUCKET_ORDER], dtype=float)
+    buckets = (((headings + 22.5) % 360) // 45).astype(int)
+    offsets = bucket_offsets[buckets]
+    # headings outside of 0-360 are not offset
+    offsets[(headings < 0) | (headings >= 360)] = 0
+    return offsets
+
+
+# same as get_closest_segment_heading for every row (first closest heading wins)
+# rows whose segment is missing or has no headings get NaN
+def get_closest_segment_headings(segment_graph, segment_indices, target_headings):
+    closest_headings = np.full(len(segment_indices), np.nan)
+    heading_offsets = segment_graph["heading_offsets"]
+    valid_rows = np.flatnonzero(segment_indices >= 0)
+    starts = heading_offsets[segment_indices[valid_rows]]
+    counts = heading_offsets[segment_indices[valid_rows] + 1] - starts
+    if counts.sum() == 0:
+        return closest_headings
+
+    # one entry per (row, segment heading)
+    rows = np.repeat(valid_rows, counts)
+    positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    headings = np.asarray(segment_graph["headings"][positions])
+    diffs = np.abs((target_headings[rows] - headings + 180) % 360 - 180)
+
+    # first entry of each row after sorting by (row, diff), stable so ties keep the first heading
+    order = np.lexsort((diffs, rows))
+    first = np.concatenate(([True], rows[order][1:] != rows[order][:-1]))
+    closest_headings[rows[order][first]] = headings[order][first]
+    return closest_headings
+
+
+# returns one row per drawn line: pano_heading_id, color, heading (clockwise from north), coordinates [(lat, long), ...]
+def build_sun_glare_lines(base_directory, date_string):
+    sun_glare_data = pd.read_csv(f"{base_directory}/sun_glare_data_{date_string}.csv")
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv")
+
+    if not has_segment_graph(base_directory):
+        # built once from segments.csv, later maps just memory map it
+        convert_segments_csv_to_segment_graph(base_directory)
+    segment_graph = load_segment_graph(get_segment_graph_directory(base_directory))
+
+    # indexed joins (glare -> panorama -> segment) instead of a lookup per row
+    pano_segment_ids = panoramic_data.drop_duplicates('pano_id').set_index('pano_id')['segment_id'].astype(str)
+    segment_ids = sun_glare_data['pano_id'].map(pano_segment_ids)
+    segment_indices = np.full(len(sun_glare_data), -1)
+    has_pano = segment_ids.notna().to_numpy()
+    segment_indices[has_pano] = get_segment_indices(segment_graph, segment_ids[has_pano].to_numpy())
+
+    colors = get_circle_colors_for_sun_glare(sun_glare_data)
+    headings = convert_anti_clockwise_east_headings_to_clockwise_north(sun_glare_data['heading'].to_numpy())
+    segment_headings = get_closest_segment_headings(segment_graph, segment_indices, headings)
+
+    # one entry per (row, link of its segment), kept if the link is taken from the closest segment heading
+    link_offsets = segment_graph["link_offsets"]
+    valid_rows = np.flatnonzero(~np.isnan(segment_headings))
+    starts = link_offsets[segment_indices[valid_rows]]
+    counts = link_offsets[segment_indices[valid_rows] + 1] - starts
+    rows = np.repeat(valid_rows, counts)
+    links = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    keep = np.asarray(segment_graph["link_headings"][links]) == segment_headings[rows]
+    rows = rows[keep]
+    links = links[keep]
+
+    # every coordinate of every kept line string at once, offset by the row's heading
+    line_string_offsets = segment_graph["line_string_offsets"]
+    coord_starts = line_string_offsets[links]
+    coord_counts = line_string_offsets[links + 1] - coord_starts
+    coord_positions = np.repeat(coord_starts - np.cumsum(coord_counts) + coord_counts, coord_counts) + np.arange(coord_counts.sum())
+    coords = np.asarray(segment_graph["line_string_coords"][coord_positions]) + np.repeat(get_offsets_for_headings(headings[rows]), coord_counts, axis=0)
+    # (lat, long) like folium
+    coordinates = np.split(coords[:, ::-1], np.cumsum(coord_counts)[:-1]) if len(links) else []
+
+    lines = pd.DataFrame({
+        "pano_heading_id": sun_glare_data['pano_heading_id'].to_numpy()[rows],
+        "color": colors[rows],
+        "heading": headings[rows],
+        "coordinates": [line.tolist() for line in coordinates],
+    })
+    # empty line strings can not be drawn
+    return lines[coord_counts > 0], len(sun_glare_data)
+
+
+def visualize_sun_glare_data(base_directory, date_string, center_point):
+    start_time = time.perf_counter()
+    lines, row_count = build_sun_glare_lines(base_directory, date_string)
 
     m = folium.Map(location=center_point, zoom_start=16)
+    # one GeoJson element per color instead of one PolyLine per line, each line keeps its sun_glare_id popup
+    for color, color_lines in lines.groupby('color', sort=False):
+        features = make_line_features(color_lines['coordinates'].tolist(), color_lines['pano_heading_id'].tolist(), label_property="sun_glare_id")
+        folium.GeoJson(
+            {"type": "FeatureCollection", "features": features},
+            style_function=lambda feature, color=color: {"color": color, "weight": 6, "opacity": 0.7},
+            popup=folium.GeoJsonPopup(fields=["sun_glare_id"], labels=False),
+            tooltip=folium.GeoJsonTooltip(fields=["sun_glare_id"], labels=False),
+        ).add_to(m)
 
-    row_counter = 0
-    for i, row in sun_glare_data.iterrows():
-        
-        pano_id = row['pano_id']
-        pano_heading_id = row['pano_heading_id']
-        pano_row = panoramic_data.loc[panoramic_data['pano_id'] == pano_id]
-        segment_id = str(pano_row['segment_id'].iloc[0])
-        segment_row = segments_data.loc[segments_data['segment_id'] == segment_id]
-        
-        row_counter += 1
-        circle_color = get_circle_color_for_sun_glare(row)
-
-        lat = row['lat']
-        long = row['long']
-        anti_east_heading = row['heading']
-        heading = convert_anti_clockwise_east_heading_to_clockwise_north(row['heading'])
-        segment_headings = segment_row['headings'].iloc[0]
-        segment_heading = get_closest_segment_heading(segment_headings, heading)
-
+    saved_html_map_path = f"{base_directory}/sun_glare_map_{date_string}.html"
+    m.save(saved_html_map_path)
+    print(f"\tMap created with {row_count} detections ({len(lines)} lines) in {time.perf_counter() - start_time:.1f} seconds and saved to {saved_html_map_path}")
+
+
+# GeoJSON map output
+# one FeatureCollection layer per glare category with a single shared style (instead of one map element per line),
+# optionally simplified, and written as external .geojson files that the page fetches when they are large
+
+GLARE_COLORS = ['red', 'orange', 'yellow', 'green', 'black']
+GLARE_COLOR_NAMES = {
+    'red': "Sun glare",
+    'orange': "Sun glare blocked by a building",
+    'yellow': "Sun glare blocked by a tree",
+    'green': "No sun glare risk",
+    'black': "Sun glare blocked (unknown)",
+}
+GLARE_LINE_STYLE = {"weight": 6, "opacity": 0.7}
+
+# layers with more features than this are written as external files by default
+EXTERNAL_GEOJSON_MIN_FEATURES = 20000
+# 6 decimals is ~0.1 meters, smaller than the drawing offsets
+COORDINATE_PRECISION = 6
+
+# GeoJSON layer added to a folium FeatureGroup, data is either inlined or fetched from url the first time the group is shown
+# points are drawn as circle markers with the same style
+GEOJSON_LAYER_TEMPLATE = """
+{% macro script(this, kwargs) %}
+    var {{ this.get_name() }} = L.geoJson(null, {
+        style: {{ this.style_json }},
+        pointToLayer: function (feature, latlng) {
+            return L.circleMarker(latlng, {{ this.style_json }});
+        },
+        onEachFeature: function (feature, layer) {
+            layer.bindTooltip(String(feature.properties.label));
+        }
+    }).addTo({{ this._parent.get_name() }});
+    {%- if this.url %}
+    var {{ this.get_name() }}_loaded = false;
+    function {{ this.get_name() }}_load() {
+        if ({{ this.get_name() }}_loaded) { return; }
+        {{ this.get_name() }}_loaded = true;
+        fetch({{ this.url|tojson }})
+            .then(function (response) { return response.json(); })
+            .then(function (data) { {{ this.get_name() }}.addData(data); });
+    }
+    if ({{ this._parent.get_name() }}._map) { {{ this.get_name() }}_load(); }
+    {{ this._parent.get_name() }}.on("add", {{ this.get_name() }}_load);
+    {%- else %}
+    {{ this.get_name() }}.addData({{ this.data_json }});
+    {%- endif %}
+{% endmacro %}
+"""
+
+def make_geojson_layer(style, feature_collection=None, url=None):
+    layer = MacroElement()
+    layer._name = "GeoJsonLayer"
+    layer._template = Template(GEOJSON_LAYER_TEMPLATE)
+    layer.style_json = json.dumps(style)
+    layer.data_json = json.dumps(feature_collection, separators=(",", ":")) if feature_collection is not None else None
+    layer.url = url
+    return layer
+
+
+# lines: list of [(lat, long), ...] like folium, simplify_tolerance in degrees (None keeps every vertex)
+# labels are stored in each feature's label_property
+def make_line_features(lines, labels, simplify_tolerance=None, coordinate_precision=COORDINATE_PRECISION, label_property="label"):
+    if len(lines) == 0:
+        return []
+    counts = np.array([len(line) for line in lines])
+    coords = np.concatenate([np.asarray(line, dtype=float) for line in lines])[:, ::-1]
+    geometries = shapely.linestrings(coords, indices=np.repeat(np.arange(len(lines)), counts))
+    if simplify_tolerance:
+        geometries = shapely.simplify(geometries, simplify_tolerance, preserve_topology=False)
+
+    coords, line_index = shapely.get_coordinates(geometries, return_index=True)
+    coords = np.round(coords, coordinate_precision)
+    line_coords = np.split(coords, np.cumsum(np.bincount(line_index, minlength=len(geometries)))[:-1])
+    return [{"type": "Feature", "properties": {label_property: label}, "geometry": {"type": "LineString", "coordinates": line.tolist()}}
+            for label, line in zip(labels, line_coords)]
+
+def make_point_features(lats, longs, labels, coordinate_precision=COORDINATE_PRECISION):
+    coords = np.round(np.column_stack((longs, lats)), coordinate_precision).tolist()
+    return [{"type": "Feature", "properties": {"label": label}, "geometry": {"type": "Point", "coordinates": coord}}
+            for label, coord in zip(labels, coords)]
+
+
+# layers: list of (name, features, style), adds one toggleable layer each to the map
+# external: write the layers as <html name>_layers/*.geojson next to the html (None decides by size)
+def add_geojson_layers(m, layers, html_path, external=None):
+    if external is None:
+        external = sum(len(features) for _, features, _ in layers) > EXTERNAL_GEOJSON_MIN_FEATURES
+
+    layers_directory = os.path.splitext(html_path)[0] + "_layers"
+    if external:
+        os.makedirs(layers_directory, exist_ok=True)
+
+    for layer_number, (name, features, style) in enumerate(layers):
+        feature_collection = {"type": "FeatureCollection", "features": features}
+        group = folium.FeatureGroup(name=f"{name} ({len(features)})").add_to(m)
+        if external:
+            file_name = f"layer_{layer_number}.geojson"
+            with open(f"{layers_directory}/{file_name}", "w") as file:
+                json.dump(feature_collection, file, separators=(",", ":"))
+            # relative to the html, so the map and its layers can be moved/served together
+            make_geojson_layer(style, url=f"{os.path.basename(layers_directory)}/{file_name}").add_to(group)
+        else:
+            make_geojson_layer(style, feature_collection=feature_collection).add_to(group)
 
-        # get segment link from heading 
-        heading_links = segment_row['heading_links'].iloc[0]
+    folium.LayerControl(collapsed=False).add_to(m)
+    if external:
+        # browsers do not fetch files from file:// pages, so the map has to be served (ex: python -m http.server)
+        print(f"\tGeoJSON layers written to: {layers_directory} (serve the directory over http to view the map)")
+    return external
 
-        segment_links = []
 
-        if segment_heading in heading_links:
-            segment_links = heading_links[segment_heading]
-        
+def visualize_sun_glare_data_geojson(base_directory, date_string, center_point, simplify_tolerance=None, external=None):
+    start_time = time.perf_counter()
+    lines, row_count = build_sun_glare_lines(base_directory, date_string)
 
-        # loop over found segment links to draw them (usually only 1, but some headings can multiple links)
-        for segment_link in segment_links:
-            segment_line_string = LineString(segment_row['line_strings'].iloc[0][segment_link])
-    
-            draw_linestring_on_map(pano_heading_id,segment_line_string, m, circle_color, heading)
-            # draw circles
-            # folium.CircleMarker(
-            #     location=[lat, long],
-            #     radius=2,
-            #     color=circle_color,
-            #     fill=True,
-            #     fill_color=circle_color,
-            #     fill_opacity=0.7,
-            #     popup=  f"Pano_id: {pano_id}\n"+
-            #             f"Segment_id: {segment_id}\n"+
-            #             f"Segment_headings: {segment_headings}\n"+
-            #             f"line_string: {segment_line_string}",
-            # ).add_to(m)
+    layers = []
+    for color in GLARE_COLORS:
+        color_lines = lines[lines['color'] == color]
+        if len(color_lines) == 0:
+            continue
+        features = make_line_features(color_lines['coordinates'].tolist(), color_lines['pano_heading_id'].tolist(), simplify_tolerance)
+        layers.append((GLARE_COLOR_NAMES[color], features, {**GLARE_LINE_STYLE, "color": color}))
 
+    m = folium.Map(location=center_point, zoom_start=16)
     saved_html_map_path = f"{base_directory}/sun_glare_map_{date_string}.html"
+    add_geojson_layers(m, layers, saved_html_map_path, external)
     m.save(saved_html_map_path)
-    print(f"\tMap created with {row_counter} detections and saved to {saved_html_map_path}")
+    print(f"\tMap created with {row_count} detections ({len(lines)} lines) in {time.perf_counter() - start_time:.1f} seconds and saved to {saved_html_map_path}")
 
 
-def create_sun_glare_map(base_directory, date_time):
+# map_mode: "polylines" (one GeoJson element per color, inlined) or "geojson" (one GeoJSON layer per category, for large environments)
+def create_sun_glare_map(base_directory, date_time, map_mode="polylines", simplify_tolerance=None):
     # TODO center point
     center_point = (38.89565719232077, -77.04168192501736)
 
     date_string = date_time.strftime("%Y-%m-%d_%H-%M-%S")
-    visualize_just_data(base_directory, date_string, center_point)
+    if map_mode == "geojson":
+        visualize_sun_glare_data_geojson(base_directory, date_string, center_point, simplify_tolerance)
+    else:
+        visualize_sun_glare_data(base_directory, date_string, center_point)
 
 
 
+
+
+# Animated multi-timestamp map
+# every line is written once (geometry for the first timestamp it appears in, it only depends on the panorama and
+# heading), and the glare state of every line at every timestamp is a 4 bit color code, packed 2 lines per byte and
+# base64 encoded, that a time slider applies to the lines
+
+# state code of a line with no glare row at a timestamp (color codes are positions in GLARE_COLORS)
+NO_GLARE_STATE = 15
+
+TIME_SERIES_TEMPLATE = """
+{% macro header(this, kwargs) %}
+<style>
+    .sun-glare-time-slider { background: white; padding: 6px 10px; border-radius: 4px; font: 13px sans-serif; }
+    .sun-glare-time-slider input[type=range] { width: 300px; vertical-align: middle; }
+</style>
+{% endmacro %}
+
+{% macro script(this, kwargs) %}
+    var {{ this.get_name() }}_palette = {{ this.palette_json }};
+    var {{ this.get_name() }}_labels = {{ this.labels_json }};
+    var {{ this.get_name() }}_states = {{ this.states_json }};
+    var {{ this.get_name() }}_frame = 0;
+    var {{ this.get_name() }}_timer = null;
+
+    var {{ this.get_name() }}_lines = L.geoJson(null, {
+        style: {{ this.style_json }},
+        onEachFeature: function (feature, layer) {
+            layer.bindTooltip(String(feature.properties.label));
+        }
+    }).addTo({{ this._parent.get_name() }});
+
+    function {{ this.get_name() }}_decode(encoded) {
+        var binary = atob(encoded);
+        var packed = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) { packed[i] = binary.charCodeAt(i); }
+        return packed;
+    }
+
+    function {{ this.get_name() }}_show(frame) {
+        {{ this.get_name() }}_frame = frame;
+        var packed = {{ this.get_name() }}_decode({{ this.get_name() }}_states[frame]);
+        {{ this.get_name() }}_lines.eachLayer(function (layer) {
+            var index = layer.feature.properties.index;
+            var state = (packed[index >> 1] >> ((index & 1) * 4)) & 15;
+            if (state == {{ this.no_glare_state }}) {
+                layer.setStyle({opacity: 0});
+            } else {
+                layer.setStyle({color: {{ this.get_name() }}_palette[state], opacity: {{ this.opacity }}});
+            }
+        });
+        document.getElementById("{{ this.get_name() }}_slider").value = frame;
+        document.getElementById("{{ this.get_name() }}_label").innerHTML = {{ this.get_name() }}_labels[frame];
+    }
+
+    var {{ this.get_name() }}_control = L.control({position: "bottomleft"});
+    {{ this.get_name() }}_control.onAdd = function () {
+        var div = L.DomUtil.create("div", "sun-glare-time-slider");
+        div.innerHTML = '<button id="{{ this.get_name() }}_play">Play</button> ' +
+            '<input id="{{ this.get_name() }}_slider" type="range" min="0" max="' + ({{ this.get_name() }}_labels.length - 1) + '" step="1" value="0"> ' +
+            '<span id="{{ this.get_name() }}_label"></span>';
+        L.DomEvent.disableClickPropagation(div);
+        return div;
+    };
+    {{ this.get_name() }}_control.addTo({{ this._parent.get_name() }});
+
+    document.getElementById("{{ this.get_name() }}_slider").addEventListener("input", function (event) {
+        {{ this.get_name() }}_show(parseInt(event.target.value));
+    });
+    document.getElementById("{{ this.get_name() }}_play").addEventListener("click", function (event) {
+        if ({{ this.get_name() }}_timer) {
+            clearInterval({{ this.get_name() }}_timer);
+            {{ this.get_name() }}_timer = null;
+            event.target.innerHTML = "Play";
+            return;
+        }
+        event.target.innerHTML = "Pause";
+        {{ this.get_name() }}_timer = setInterval(function () {
+            {{ this.get_name() }}_show(({{ this.get_name() }}_frame + 1) % {{ this.get_name() }}_labels.length);
+        }, {{ this.frame_milliseconds }});
+    });
+
+    {%- if this.url %}
+    fetch({{ this.url|tojson }})
+        .then(function (response) { return response.json(); })
+        .then(function (data) {
+            {{ this.get_name() }}_lines.addData(data);
+            {{ this.get_name() }}_show(0);
+        });
+    {%- else %}
+    {{ this.get_name() }}_lines.addData({{ this.data_json }});
+    {{ this.get_name() }}_show(0);
+    {%- endif %}
+{% endmacro %}
+"""
+
+
+# states: (timestamps x lines) uint8 codes below 16, returns one base64 string per timestamp (2 lines per byte)
+def pack_glare_states(states):
+    states = np.asarray(states, dtype=np.uint8)
+    if states.shape[1] % 2:
+        states = np.column_stack((states, np.full(len(states), NO_GLARE_STATE, dtype=np.uint8)))
+    packed = states[:, 0::2] | (states[:, 1::2] << 4)
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in packed]
+
+def unpack_glare_states(encoded_states, line_count):
+    packed = np.array([np.frombuffer(base64.b64decode(encoded), dtype=np.uint8) for encoded in encoded_states])
+    states = np.empty((len(packed), packed.shape[1] * 2), dtype=np.uint8)
+    states[:, 0::2] = packed & 15
+    states[:, 1::2] = packed >> 4
+    return states[:, :line_count]
+
+
+# lines of every timestamp -> (line geometry DataFrame, (timestamps x lines) state codes)
+def build_sun_glare_time_series(base_directory, date_strings):
+    color_codes = {color: code for code, color in enumerate(GLARE_COLORS)}
+    geometry = []
+    timestamp_lines = []
+    for date_string in date_strings:
+        lines, _ = build_sun_glare_lines(base_directory, date_string)
+        # a glare row can draw more than one line (one per link), so the key is the row and its line number
+        lines = lines.set_index([lines['pano_heading_id'], lines.groupby('pano_heading_id').cumcount()])
+        timestamp_lines.append(lines)
+        geometry.append(lines[['pano_heading_id', 'coordinates']])
+
+    geometry = pd.concat(geometry)
+    geometry = geometry[~geometry.index.duplicated(keep="first")]
+
+    states = np.full((len(date_strings), len(geometry)), NO_GLARE_STATE, dtype=np.uint8)
+    for timestamp, lines in enumerate(timestamp_lines):
+        positions = geometry.index.get_indexer(lines.index)
+        states[timestamp, positions] = lines['color'].map(color_codes).to_numpy(dtype=np.uint8)
+    return geometry.reset_index(drop=True), states
+
+
+def visualize_sun_glare_time_series(base_directory, date_strings, center_point, simplify_tolerance=None, external=None, frame_milliseconds=1000):
+    start_time = time.perf_counter()
+    geometry, states = build_sun_glare_time_series(base_directory, date_strings)
+
+    features = make_line_features(geometry['coordinates'].tolist(), geometry['pano_heading_id'].tolist(), simplify_tolerance)
+    for index, feature in enumerate(features):
+        feature["properties"]["index"] = index
+    feature_collection = {"type": "FeatureCollection", "features": features}
+
+    saved_html_map_path = f"{base_directory}/sun_glare_time_series_map_{date_strings[0]}_to_{date_strings[-1]}.html"
+    if external is None:
+        external = len(features) > EXTERNAL_GEOJSON_MIN_FEATURES
+
+    time_series = MacroElement()
+    time_series._name = "SunGlareTimeSeries"
+    time_series._template = Template(TIME_SERIES_TEMPLATE)
+    time_series.palette_json = json.dumps(GLARE_COLORS)
+    time_series.labels_json = json.dumps(list(date_strings))
+    time_series.states_json = json.dumps(pack_glare_states(states))
+    time_series.style_json = json.dumps(GLARE_LINE_STYLE)
+    time_series.opacity = GLARE_LINE_STYLE["opacity"]
+    time_series.no_glare_state = NO_GLARE_STATE
+    time_series.frame_milliseconds = frame_milliseconds
+    time_series.url = None
+    time_series.data_json = None
+    if external:
+        layers_directory = os.path.splitext(saved_html_map_path)[0] + "_layers"
+        os.makedirs(layers_directory, exist_ok=True)
+        with open(f"{layers_directory}/lines.geojson", "w") as file:
+            json.dump(feature_collection, file, separators=(",", ":"))
+        time_series.url = f"{os.path.basename(layers_directory)}/lines.geojson"
+        print(f"\tGeoJSON lines written to: {layers_directory} (serve the directory over http to view the map)")
+    else:
+        time_series.data_json = json.dumps(feature_collection, separators=(",", ":"))
+
+    # canvas, restyling every line each frame is too slow with one svg element per line
+    m = folium.Map(location=center_point, zoom_start=16, prefer_canvas=True)
+    time_series.add_to(m)
+    m.save(saved_html_map_path)
+    print(f"\tTime series map created with {len(features)} lines over {len(date_strings)} timestamps in {time.perf_counter() - start_time:.1f} seconds and saved to {saved_html_map_path}")
+
+
+# date_times: every timestamp to show (each needs its sun glare dataset), in order
+def create_sun_glare_time_series_map(base_directory, date_times, simplify_tolerance=None):
+    # TODO center point
+    center_point = (38.89565719232077, -77.04168192501736)
+
+    date_strings = [date_time.strftime("%Y-%m-%d_%H-%M-%S") for date_time in date_times]
+    visualize_sun_glare_time_series(base_directory, date_strings, center_point, simplify_tolerance)
+
+
+# Static raster rendering (headless, no browser)
+# every line is drawn by one matplotlib LineCollection on an Agg canvas, time sweeps reuse the same collection and
+# only change its colors
+
+# lines with higher priority are drawn on top (index = position in GLARE_COLORS)
+GLARE_DRAW_PRIORITY = {'red': 4, 'orange': 3, 'yellow': 2, 'black': 1, 'green': 0}
+
+# (min_long, min_lat, max_long, max_lat) of every line, with a small margin (None when there are no coordinates)
+def get_lines_bounds(lines, margin=0.02):
+    coords = np.concatenate([np.asarray(line, dtype=float).reshape(-1, 2) for line in lines] or [np.empty((0, 2))])
+    if len(coords) == 0:
+        return None
+    min_lat, min_long = coords.min(axis=0)
+    max_lat, max_long = coords.max(axis=0)
+    lat_margin = (max_lat - min_lat) * margin or 0.001
+    long_margin = (max_long - min_long) * margin or 0.001
+    return min_long - long_margin, min_lat - lat_margin, max_long + long_margin, max_lat + lat_margin
+
+# bounds of every segment of the environment, for maps with no glare lines to draw (ex: night time)
+def get_environment_bounds(base_directory):
+    segment_graph = load_segment_graph(get_segment_graph_directory(base_directory))
+    # (long, lat) in the segment graph
+    bounds = get_lines_bounds([np.asarray(segment_graph["line_string_coords"])[:, ::-1]])
+    if bounds is None:
+        panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv")
+        bounds = get_lines_bounds([panoramic_data[["lat", "long"]].to_numpy()])
+    return bounds
+
+# figure of width pixels showing the bounds (height keeps the map's aspect ratio at its latitude)
+def make_raster_figure(bounds, width, dpi=100, background="white"):
+    min_long, min_lat, max_long, max_lat = bounds
+    aspect = (max_lat - min_lat) / ((max_long - min_long) * math.cos(math.radians((min_lat + max_lat) / 2)))
+    height = max(1, int(round(width * aspect)))
+
+    figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi, facecolor=background)
+    FigureCanvasAgg(figure)
+    axes = figure.add_axes((0, 0, 1, 1))
+    axes.set_axis_off()
+    axes.set_xlim(min_long, max_long)
+    axes.set_ylim(min_lat, max_lat)
+    return figure, axes
+
+def get_figure_image(figure):
+    figure.canvas.draw()
+    # copy, the buffer is reused on the next draw
+    return np.array(figure.canvas.buffer_rgba())
+
+
+# lines: [(lat, long), ...] per line, colors: GLARE_COLORS value per line
+# returns an (height x width x 4) RGBA image
+def render_sun_glare_lines(lines, colors, width=1600, bounds=None, line_width=1.0, background="white"):
+    if bounds is None:
+        bounds = get_lines_bounds(lines)
+    if bounds is None:
+        raise ValueError("bounds are needed to render a map with no lines")
+    figure, axes = make_raster_figure(bounds, width, background=background)
+
+    order = np.argsort([GLARE_DRAW_PRIORITY.get(color, 0) for color in colors], kind="stable")
+    segments = [np.asarray(lines[index], dtype=float)[:, ::-1] for index in order]
+    axes.add_collection(LineCollection(segments, colors=[colors[index] for index in order], linewidths=line_width, capstyle="round"))
+    return get_figure_image(figure)
+
+def save_image(image, output_path):
+    Image.fromarray(image).save(output_path)
+
+
+def render_sun_glare_png(base_directory, date_string, width=1600, output_path=None, line_width=1.0):
+    start_time = time.perf_counter()
+    lines, row_count = build_sun_glare_lines(base_directory, date_string)
+    lines_bounds = get_lines_bounds(lines['coordinates'].tolist()) or get_environment_bounds(base_directory)
+    image = render_sun_glare_lines(lines['coordinates'].tolist(), lines['color'].tolist(), width, lines_bounds, line_width)
+
+    if output_path is None:
+        output_path = f"{base_directory}/sun_glare_map_{date_string}.png"
+    save_image(image, output_path)
+    print(f"\tRendered {len(lines)} lines ({image.shape[1]}x{image.shape[0]}) in {time.perf_counter() - start_time:.1f} seconds and saved to {output_path}")
+    return output_path
+
+
+# renders one png per timestamp with the same extent (so frames can be compared/animated)
+# the geometry and the collection are built once, each frame only recolors it
+def render_sun_glare_time_sweep(base_directory, date_strings, width=1600, output_directory=None, line_width=1.0):
+    start_time = time.perf_counter()
+    geometry, states = build_sun_glare_time_series(base_directory, date_strings)
+    if output_directory is None:
+        output_directory = f"{base_directory}/sun_glare_frames"
+    os.makedirs(output_directory, exist_ok=True)
+
+    lines = geometry['coordinates'].tolist()
+    segments = [np.asarray(line, dtype=float)[:, ::-1] for line in lines]
+    # with no lines every frame is an empty map of the environment
+    figure, axes = make_raster_figure(get_lines_bounds(lines) or get_environment_bounds(base_directory), width)
+    collection = LineCollection(segments, linewidths=line_width, capstyle="round")
+    axes.add_collection(collection)
+
+    # rgba per state code (lines with no glare row at a timestamp are transparent)
+    state_colors = np.zeros((16, 4))
+    state_colors[:len(GLARE_COLORS)] = to_rgba_array(GLARE_COLORS)
+    state_priority = np.zeros(16)
+    state_priority[:len(GLARE_COLORS)] = [GLARE_DRAW_PRIORITY[color] for color in GLARE_COLORS]
+
+    output_paths = []
+    for date_string, frame_states in zip(date_strings, states):
+        order = np.argsort(state_priority[frame_states], kind="stable")
+        collection.set_segments([segments[index] for index in order])
+        collection.set_color(state_colors[frame_states[order]])
+
+        output_path = f"{output_directory}/sun_glare_map_{date_string}.png"
+        save_image(get_figure_image(figure), output_path)
+        output_paths.append(output_path)
+
+    print(f"\tRendered {len(date_strings)} frames of {len(segments)} lines in {time.perf_counter() - start_time:.1f} seconds to {output_directory}")
+    return output_paths
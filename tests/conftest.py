@@ -0,0 +1,138 @@
+import os
+import sys
+
+import networkx as nx
+import pandas as pd
+import pytest
+from pyproj import Geod
+from shapely.geometry import LineString
+
+# the modules live flat in src/ and import each other by name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+ROAD_NODES = {
+    1: (-77.1000, 38.8800),
+    2: (-77.0900, 38.8810),
+    3: (-77.0800, 38.8900),
+    4: (-77.0950, 38.8700),
+    5: (-77.0895, 38.8812),
+    6: (-77.0700, 38.8750),
+    7: (-77.0880, 38.8812),
+}
+GRID_STEP_DEGREES = 0.003
+
+geod = Geod(ellps="WGS84")
+
+
+def add_road(graph, u, v, oneway, osmid, vertices=None, key=0):
+    line = LineString([(graph.nodes[u]["x"], graph.nodes[u]["y"]), *(vertices or []), (graph.nodes[v]["x"], graph.nodes[v]["y"])])
+    data = {"oneway": oneway, "osmid": osmid, "highway": "residential", "length": geod.geometry_length(line)}
+    if vertices is not None:
+        data["geometry"] = line
+    graph.add_edge(u, v, key, **data)
+
+
+# small osmnx style graph (EPSG:4326, x/y nodes, oneway/osmid/geometry edges) covering the cases the segment builders
+# treat differently: two way and one way edges, edges without geometry, edges too short for intermediate segments,
+# an edge with a lone intermediate segment and parallel edges (one an exact copy)
+@pytest.fixture
+def road_graph():
+    graph = nx.MultiDiGraph(crs="EPSG:4326")
+    for node, (x, y) in ROAD_NODES.items():
+        graph.add_node(node, x=x, y=y)
+
+    # two way with a bend, both directions
+    bend = [(-77.0950, 38.8835)]
+    add_road(graph, 1, 2, False, 10, bend)
+    add_road(graph, 2, 1, False, 10, bend[::-1])
+    # one way
+    add_road(graph, 2, 3, True, 11, [])
+    # two way without geometry
+    add_road(graph, 1, 4, False, 12)
+    add_road(graph, 4, 1, False, 12)
+    # too short for any segment in between
+    add_road(graph, 2, 5, True, 13, [])
+    # a lone segment in between (~430 feet)
+    add_road(graph, 5, 7, False, 14, [])
+    add_road(graph, 7, 5, False, 14, [])
+    # parallel edges: an exact copy and one with different data
+    add_road(graph, 3, 6, True, 15, [], key=0)
+    add_road(graph, 3, 6, True, 15, [], key=1)
+    add_road(graph, 3, 6, True, 16, [(-77.0750, 38.8850)], key=2)
+    add_road(graph, 6, 4, True, 17, [(-77.0800, 38.8720)])
+    return graph
+
+
+# size x size grid of blocks (~330 m by ~260 m at the default step) with a bend in every street, every fifth street is one way
+def make_grid_graph(size, step=GRID_STEP_DEGREES):
+    graph = nx.MultiDiGraph(crs="EPSG:4326")
+    for row in range(size):
+        for col in range(size):
+            graph.add_node(row * size + col, x=-77.1 + col * step, y=38.85 + row * step)
+
+    osmid = 0
+    for row in range(size):
+        for col in range(size):
+            for row_step, col_step in ((0, 1), (1, 0)):
+                if row + row_step == size or col + col_step == size:
+                    continue
+                u = row * size + col
+                v = (row + row_step) * size + col + col_step
+                bend = [((graph.nodes[u]["x"] + graph.nodes[v]["x"]) / 2 + 0.0002, (graph.nodes[u]["y"] + graph.nodes[v]["y"]) / 2 + 0.0002)]
+                osmid += 1
+                oneway = (row + col) % 5 == 0
+                add_road(graph, u, v, oneway, osmid, bend)
+                if not oneway:
+                    add_road(graph, v, u, oneway, osmid, bend)
+    return graph
+
+@pytest.fixture
+def grid_graph():
+    return make_grid_graph(12)
+
+
+# the per row glare functions use pysolar and the batch ones the numpy solar position (within 0.05 degrees of each
+# other, tested in test_sun_glare_detection), this gives the per row path the numpy one too so the glare logic of
+# both can be compared exactly
+@pytest.fixture
+def numpy_sun_position(monkeypatch):
+    import SunGlareDetectionFunctions
+
+    def get_sun_position_east(latitude, longitude, date):
+        altitudes, azimuths = SunGlareDetectionFunctions.get_sun_positions_east_batch([latitude], [longitude], [date.timestamp()])
+        return altitudes[0], azimuths[0]
+    monkeypatch.setattr(SunGlareDetectionFunctions, "get_sun_position_east", get_sun_position_east)
+
+
+GLARE_MAP_DATE_STRING = "2024-06-12_23-00-00"
+# (angle_risk, has_sun_glare, blockage_type) of every glare color
+GLARE_CATEGORIES = [(True, True, "none"), (True, False, "building"), (True, False, "tree"), (False, False, "none")]
+
+# environment with segments.csv (from road_graph), one panorama per segment with headings and a glare dataset with a row
+# per (panorama, segment heading), cycling through the glare colors
+@pytest.fixture
+def glare_map_environment(road_graph, tmp_path):
+    from SegmentBuilding import build_segments_from_graph
+
+    base_directory = str(tmp_path)
+    segments = build_segments_from_graph(road_graph)
+    segments.to_csv(f"{base_directory}/segments.csv")
+    segments = segments[segments["headings"].map(len) > 0]
+
+    pano_rows = []
+    glare_rows = {}
+    for number, (segment_id, segment) in enumerate(segments.iterrows()):
+        pano_id = f"pano_{number}"
+        pano_rows.append({"pano_id": pano_id, "segment_id": segment_id, "lat": segment["lat"], "long": segment["long"]})
+        for heading in segment["headings"]:
+            # glare headings are anticlockwise from east
+            anticlockwise_heading = (90 - heading) % 360
+            angle_risk, has_sun_glare, blockage_type = GLARE_CATEGORIES[len(glare_rows) % len(GLARE_CATEGORIES)]
+            glare_rows[f"{pano_id}_{anticlockwise_heading}"] = {"lat": segment["lat"], "long": segment["long"], "has_sun_glare": has_sun_glare,
+                                                               "pano_id": pano_id, "heading": anticlockwise_heading, "angle_risk": angle_risk, "blockage_type": blockage_type}
+
+    pd.DataFrame(pano_rows).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+    glare_data = pd.DataFrame.from_dict(glare_rows, orient="index")
+    glare_data.index.name = "pano_heading_id"
+    glare_data.to_csv(f"{base_directory}/sun_glare_data_{GLARE_MAP_DATE_STRING}.csv")
+    return base_directory, GLARE_MAP_DATE_STRING
@@ -0,0 +1,243 @@
+import math
+import os
+import warnings
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+from pyproj import Geod
+
+import CarAccidents
+from CarAccidents import (calculate_sun_glare_for_crashes_batch, convert_military_integer_to_time, calculate_glare_baseline_for_crashes,
+                          sample_baseline_timestamps, summarize_glare_baseline, get_panorama_tree, match_crashes_to_panoramas, SECONDS_PER_DAY,
+                          EARTH_RADIUS_METERS)
+from SegmentGraph import write_segment_graph, load_segment_graph
+from SunGlareDetectionFunctions import check_if_any_sun_glare_at_panoramic_with_datetime
+
+SKY_CLASS = 10
+MAP_CLASSES = np.array([SKY_CLASS, 2, 8, 0], dtype=np.uint8)
+
+
+# panoramas around DC with segmentation maps (both folders) that are mostly sky on top, half of the panoramas have their
+# resolution in panoramic_data, the other half only have a panoramic image (twice the map resolution)
+def make_glare_environment(base_directory, pano_count, seed=0):
+    rng = np.random.default_rng(seed)
+    for folder in ("segmentation_maps", "segmentation_maps_without_trees", "panoramic_imgs"):
+        os.makedirs(f"{base_directory}/{folder}", exist_ok=True)
+
+    rows = []
+    for number in range(pano_count):
+        pano_id = f"pano_{number}"
+        for folder in ("segmentation_maps", "segmentation_maps_without_trees"):
+            segmentation_map = rng.choice(MAP_CLASSES, size=(64, 128), p=[0.4, 0.2, 0.2, 0.2])
+            segmentation_map[:24][rng.random((24, 128)) < 0.8] = SKY_CLASS
+            Image.fromarray(segmentation_map).save(f"{base_directory}/{folder}/{pano_id}.png")
+        has_size = number % 2 == 0
+        if not has_size:
+            Image.new("RGB", (256, 128)).save(f"{base_directory}/panoramic_imgs/{pano_id}.jpg")
+        rows.append({
+            "pano_id": pano_id,
+            "lat": 38.88 + rng.uniform(-0.02, 0.02),
+            "long": -77.05 + rng.uniform(-0.02, 0.02),
+            "heading": rng.uniform(0, 360),
+            "tilt": rng.uniform(-5, 15),
+            # anticlockwise from east, like the glare code uses them
+            "segment_headings": rng.uniform(0, 360, rng.integers(1, 5)).tolist(),
+            "image_width": 128 if has_size else np.nan,
+            "image_height": 64 if has_size else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+# crashes around sunrise and sunset (UTC in DC), in winter and summer, some on panoramas that are not in panoramic_data
+def make_crashes(panoramic_data, crash_count, seed=0):
+    rng = np.random.default_rng(seed)
+    months = rng.choice([1, 6, 11], crash_count)
+    hours = rng.choice([11, 12, 13, 21, 22, 23], crash_count)
+    pano_ids = rng.choice(panoramic_data["pano_id"].tolist() + ["unknown_pano"], crash_count)
+    return pd.DataFrame({
+        "Crash Date": [f"{month}/{day}/2023" for month, day in zip(months, rng.integers(1, 29, crash_count))],
+        "Crash Military Time": hours * 100 + rng.integers(0, 60, crash_count),
+        "matched_pano_id": pano_ids,
+    })
+
+# the per crash path calculate_sun_glare_for_crashes used: one check_if_any_sun_glare_at_panoramic_with_datetime per row
+def reference_sun_glare_for_crashes(base_directory, crash_data, panoramic_data):
+    has_sun_glare = []
+    for _, row in crash_data.iterrows():
+        if row["matched_pano_id"] not in set(panoramic_data["pano_id"]):
+            has_sun_glare.append(False)
+            continue
+        month, day, year = row["Crash Date"].split("/")
+        hour, minutes = convert_military_integer_to_time(row["Crash Military Time"])
+        date_time = datetime(int(year), int(month), int(day), int(hour), int(minutes), 0, tzinfo=timezone.utc)
+        panoramic_row = panoramic_data[row["matched_pano_id"] == panoramic_data["pano_id"]].iloc[0]
+        has_sun_glare.append(check_if_any_sun_glare_at_panoramic_with_datetime(base_directory, panoramic_row, date_time))
+    return np.array(has_sun_glare)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 100000])
+def test_batch_crash_glare_matches_per_row_path(tmp_path, numpy_sun_position, chunk_size):
+    base_directory = str(tmp_path)
+    panoramic_data = make_glare_environment(base_directory, 12)
+    crash_data = make_crashes(panoramic_data, 400)
+
+    expected = reference_sun_glare_for_crashes(base_directory, crash_data, panoramic_data)
+    has_sun_glare = calculate_sun_glare_for_crashes_batch(base_directory, crash_data, panoramic_data, chunk_size)
+
+    # the data has to exercise both outcomes
+    assert 0 < expected.sum() < len(expected)
+    np.testing.assert_array_equal(has_sun_glare, expected)
+
+
+# the timestamps come from one generator, so the per crash csv and the summary do not depend on the process pool
+def test_glare_baseline_does_not_depend_on_workers(tmp_path, monkeypatch):
+    base_directory = str(tmp_path)
+    panoramic_data = make_glare_environment(base_directory, 12)
+    panoramic_data.to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+    crash_data = make_crashes(panoramic_data, 150)
+    crash_data["LAT"] = 38.88
+    crash_data["LON"] = -77.05
+    crash_data.to_csv(f"{base_directory}/car_crashes_with_panoramics_Testville.csv", index=False)
+    # several tasks per run
+    monkeypatch.setattr(CarAccidents, "BASELINE_TASK_SIZE", 20)
+
+    results = []
+    for workers in (1, 3):
+        summary = calculate_glare_baseline_for_crashes("Testville, VA", base_directory, samples_per_crash=5, seed=3, workers=workers)
+        results.append((summary, pd.read_csv(f"{base_directory}/car_crash_glare_baseline.csv")))
+
+    assert results[0][0] == results[1][0]
+    pd.testing.assert_frame_equal(results[0][1], results[1][1])
+    assert 0 < results[0][1]["baseline_glare_rate"].mean() < 1
+
+
+def test_time_of_day_baseline_keeps_the_crash_time_on_random_days():
+    crash_timestamps = np.array([datetime(2023, 1, 3, 7, 15, tzinfo=timezone.utc).timestamp(), datetime(2023, 3, 9, 18, 40, tzinfo=timezone.utc).timestamp(),
+                                 datetime(2023, 2, 1, 12, 5, tzinfo=timezone.utc).timestamp()])
+    timestamps = sample_baseline_timestamps(np.random.default_rng(0), crash_timestamps, 2000, "time_of_day")
+
+    np.testing.assert_array_equal(timestamps % SECONDS_PER_DAY, np.repeat((crash_timestamps % SECONDS_PER_DAY)[:, None], 2000, axis=1))
+    # every day from the first to the last crash, about equally often
+    days = (timestamps // SECONDS_PER_DAY).astype(int).ravel()
+    first_day, last_day = int(crash_timestamps.min() // SECONDS_PER_DAY), int(crash_timestamps.max() // SECONDS_PER_DAY)
+    counts = np.bincount(days - first_day, minlength=last_day - first_day + 1)
+    assert len(counts) == last_day - first_day + 1
+    assert counts.min() > 0
+    assert counts.max() < 3 * counts.mean()
+
+def test_shuffle_baseline_draws_crash_times_equally_often():
+    crash_timestamps = np.array([1.0e9, 1.0e9 + 3600, 1.0e9 + 7 * 86400, 1.0e9 + 30 * 86400])
+    timestamps = sample_baseline_timestamps(np.random.default_rng(0), crash_timestamps, 5000, "shuffle")
+
+    values, counts = np.unique(timestamps, return_counts=True)
+    np.testing.assert_array_equal(values, np.floor(crash_timestamps / 60) * 60)
+    # 20000 draws of 4 times, 5000 expected each
+    assert np.all(np.abs(counts - 5000) < 300)
+
+def test_baseline_samples_repeat_with_the_seed_and_unknown_distributions_raise():
+    crash_timestamps = np.array([1.0e9, 1.0e9 + 86400 * 40])
+    for distribution in ("uniform", "time_of_day", "shuffle"):
+        first = sample_baseline_timestamps(np.random.default_rng(5), crash_timestamps, 10, distribution)
+        np.testing.assert_array_equal(first, sample_baseline_timestamps(np.random.default_rng(5), crash_timestamps, 10, distribution))
+        assert np.all((first >= crash_timestamps.min() - 60) & (first < crash_timestamps.max() + SECONDS_PER_DAY))
+    with pytest.raises(ValueError):
+        sample_baseline_timestamps(np.random.default_rng(5), crash_timestamps, 10, "weekly")
+
+
+# observed [1, 1, 0, 0] against a constant 0.5 baseline: sample std of the crashes is sqrt(1/3), the baseline has none
+def test_glare_baseline_summary_intervals():
+    summary = summarize_glare_baseline(np.array([1.0, 1.0, 0.0, 0.0]), np.full(4, 0.5))
+
+    assert summary["observed_rate"] == 0.5
+    # 0.5 +- 1.96 * sqrt(1/3) / 2 = 0.5 +- 0.566 is cut to [0, 1]
+    assert summary["observed_rate_ci"] == (0.0, 1.0)
+    assert summary["expected_rate_ci"] == pytest.approx((0.5, 0.5))
+    assert summary["rate_ratio"] == 1.0
+    log_ratio_error = math.sqrt((1 / 3) / 0.5 ** 2) / 2
+    assert summary["rate_ratio_ci"] == pytest.approx((math.exp(-1.96 * log_ratio_error), math.exp(1.96 * log_ratio_error)))
+    assert summary["z_score"] == 0.0
+    assert summary["p_value"] == 1.0
+
+def test_glare_baseline_summary_without_observed_glare():
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        summary = summarize_glare_baseline(np.zeros(4), np.array([0.25, 0.5, 0.25, 0.0]))
+
+    assert summary["observed_rate"] == 0.0
+    assert summary["observed_rate_ci"] == (0.0, 0.0)
+    assert summary["expected_rate"] == 0.25
+    expected_error = 1.96 * math.sqrt(0.125 / 3) / 2
+    assert summary["expected_rate_ci"] == pytest.approx((0.25 - expected_error, 0.25 + expected_error))
+    assert summary["rate_ratio"] == 0.0
+    assert all(math.isnan(bound) for bound in summary["rate_ratio_ci"])
+    # differences -0.25, -0.5, -0.25, 0
+    z_score = -0.25 / (math.sqrt(0.125 / 3) / 2)
+    assert summary["z_score"] == pytest.approx(z_score)
+    assert summary["p_value"] == pytest.approx(math.erfc(abs(z_score) / math.sqrt(2)))
+
+
+def haversine_meters(lat, long, lats, longs):
+    lat, long, lats, longs = np.radians(lat), np.radians(long), np.radians(lats), np.radians(longs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((longs - long) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
+
+# the KD tree (unit sphere chords) picks the same panorama as a brute force haversine nearest neighbour, at the same
+# distance, and nothing when the nearest one is farther than max_distance
+@pytest.mark.parametrize("max_distance", [10, 30])
+def test_crash_matches_are_the_nearest_panorama_within_max_distance(tmp_path, max_distance):
+    rng = np.random.default_rng(0)
+    pano_lats = 38.88 + rng.uniform(-0.003, 0.003, 300)
+    pano_longs = -77.05 + rng.uniform(-0.003, 0.003, 300)
+    pd.DataFrame({"pano_id": [f"pano_{number}" for number in range(300)], "lat": pano_lats, "long": pano_longs}).to_csv(tmp_path / "panoramic_data.csv", index=False)
+    crash_lats = 38.88 + rng.uniform(-0.0035, 0.0035, 400)
+    crash_longs = -77.05 + rng.uniform(-0.0035, 0.0035, 400)
+
+    positions, distances = match_crashes_to_panoramas(get_panorama_tree(str(tmp_path)), crash_lats, crash_longs, max_distance=max_distance)
+
+    expected_positions = []
+    expected_distances = []
+    for lat, long in zip(crash_lats, crash_longs):
+        pano_distances = haversine_meters(lat, long, pano_lats, pano_longs)
+        nearest = int(np.argmin(pano_distances))
+        expected_positions.append(nearest if pano_distances[nearest] <= max_distance else -1)
+        expected_distances.append(pano_distances[nearest] if pano_distances[nearest] <= max_distance else np.nan)
+    np.testing.assert_array_equal(positions, expected_positions)
+    np.testing.assert_allclose(distances, expected_distances, atol=1e-6)
+    assert 0 < (positions >= 0).sum() < len(positions)
+
+
+# a crash with a north south panorama 5 m east of it and an east west one 20 m west of it
+def make_heading_match_environment(base_directory):
+    geod = Geod(ellps="WGS84")
+    crash_lat, crash_long = 38.88, -77.05
+    near_long, near_lat, _ = geod.fwd(crash_long, crash_lat, 90, 5)
+    far_long, far_lat, _ = geod.fwd(crash_long, crash_lat, 270, 20)
+    pd.DataFrame({"pano_id": ["near", "far"], "segment_id": ["near_segment", "far_segment"], "lat": [near_lat, far_lat], "long": [near_long, far_long]}).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+    segments = pd.DataFrame({"lat": [near_lat, far_lat], "long": [near_long, far_long], "headings": [[0.0, 180.0], [90.0, 270.0]],
+                             "segment_links": [[], []], "line_strings": [{}, {}], "heading_links": [{}, {}]}, index=["near_segment", "far_segment"])
+    write_segment_graph(segments, f"{base_directory}/segment_graph")
+    return crash_lat, crash_long, load_segment_graph(f"{base_directory}/segment_graph")
+
+# the heading picks the farther panorama when only its segment runs along the crash's road, NaN headings fall back to
+# the nearest panorama, and headings matching no segment within MAX_HEADING_DIFFERENCE give no match
+def test_crash_heading_match_prefers_a_matching_segment(tmp_path):
+    crash_lat, crash_long, segment_graph = make_heading_match_environment(str(tmp_path))
+    panorama_tree = get_panorama_tree(str(tmp_path))
+    road_headings = [85.0, 275.0, 10.0, 185.0, np.nan, 45.0]
+    lats = np.full(len(road_headings), crash_lat)
+    longs = np.full(len(road_headings), crash_long)
+
+    positions, distances = match_crashes_to_panoramas(panorama_tree, lats, longs, road_headings, segment_graph)
+
+    assert panorama_tree["pano_ids"][positions[:5]].tolist() == ["far", "far", "near", "near", "near"]
+    assert positions[5] == -1 and np.isnan(distances[5])
+    # sphere vs the WGS84 offsets: within 1%
+    np.testing.assert_allclose(distances[:5], [20, 20, 5, 5, 5], rtol=0.01)
+    # without headings every crash takes the nearest panorama
+    positions, _ = match_crashes_to_panoramas(panorama_tree, lats, longs)
+    assert panorama_tree["pano_ids"][positions].tolist() == ["near"] * len(road_headings)
+    # the matching segment has to be within max_distance too
+    positions, _ = match_crashes_to_panoramas(panorama_tree, lats[:1], longs[:1], road_headings[:1], segment_graph, max_distance=10)
+    assert positions.tolist() == [-1]
@@ -0,0 +1,221 @@
+import os
+import time
+from datetime import datetime, timedelta, timezone
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import pandas as pd
+import pytest
+
+import GlareRouting
+from GlareRouting import add_glare_weights, build_glare_time_table, build_time_dependent_graph, get_edge_step, time_dependent_shortest_path, GLARE_PENALTY, GLARE_WEIGHT, GLARE_COUNT, GLARE_DATE_FORMAT
+from GlareRouting import batch_route_pairs, build_routing_arrays, build_landmarks, alt_shortest_path
+from conftest import make_grid_graph, add_road
+
+
+def make_glare_rows(graph, count, seed=0):
+    rng = np.random.default_rng(seed)
+    xs = np.array([x for _, x in graph.nodes(data="x")])
+    ys = np.array([y for _, y in graph.nodes(data="y")])
+    return pd.DataFrame({
+        "lat": rng.uniform(ys.min(), ys.max(), count),
+        "long": rng.uniform(xs.min(), xs.max(), count),
+        "has_sun_glare": rng.random(count) < 0.4,
+    })
+
+# the per row path (Routing.py's old add_glare_penalty): one nearest_nodes call per glare row, every edge leaving the
+# node is penalized, but only once
+def reference_glare_weights(graph, glare_df, penalty=GLARE_PENALTY):
+    counts = {edge: 0 for edge in graph.edges(keys=True)}
+    for _, row in glare_df.iterrows():
+        if not row["has_sun_glare"]:
+            continue
+        node = ox.distance.nearest_nodes(graph, row["long"], row["lat"])
+        for edge in graph.edges(node, keys=True):
+            counts[edge] += 1
+    weights = {edge: graph.edges[edge]["length"] * penalty if count > 0 else graph.edges[edge]["length"] for edge, count in counts.items()}
+    return counts, weights
+
+
+@pytest.mark.parametrize("glare_count", [0, 1, 300])
+def test_bulk_glare_weights_match_per_row_path(grid_graph, glare_count):
+    glare_df = make_glare_rows(grid_graph, glare_count)
+    lengths = {(u, v, key): length for u, v, key, length in grid_graph.edges(keys=True, data="length")}
+
+    expected_counts, expected_weights = reference_glare_weights(grid_graph, glare_df)
+    graph, _ = add_glare_weights(grid_graph, glare_df)
+
+    assert {(u, v, key): count for u, v, key, count in graph.edges(keys=True, data=GLARE_COUNT)} == expected_counts
+    assert {(u, v, key): weight for u, v, key, weight in graph.edges(keys=True, data=GLARE_WEIGHT)} == pytest.approx(expected_weights, rel=1e-12)
+    # lengths are never modified
+    assert {(u, v, key): length for u, v, key, length in graph.edges(keys=True, data="length")} == lengths
+
+
+# glare rows snapping to the same node penalize its edges once, no compounding
+def test_repeated_glare_rows_do_not_compound(grid_graph):
+    node = 0
+    glare_df = pd.DataFrame({"lat": [grid_graph.nodes[node]["y"]] * 5, "long": [grid_graph.nodes[node]["x"]] * 5, "has_sun_glare": True})
+    graph, _ = add_glare_weights(grid_graph, glare_df)
+    for _, _, data in graph.edges(node, data=True):
+        assert data[GLARE_COUNT] == 5
+        assert data[GLARE_WEIGHT] == pytest.approx(data["length"] * GLARE_PENALTY)
+
+
+GLARE_TIMES = [datetime(2024, 6, 12, 21), datetime(2024, 6, 12, 22), datetime(2024, 6, 12, 23)]
+
+@pytest.fixture
+def machine_time_zone():
+    # restores the machine's time zone after the test changes it
+    original = os.environ.get("TZ")
+    yield lambda name: (os.environ.__setitem__("TZ", name), time.tzset())
+    if original is None:
+        os.environ.pop("TZ", None)
+    else:
+        os.environ["TZ"] = original
+    time.tzset()
+
+def write_glare_time_files(graph, base_directory):
+    for seed, date_time in enumerate(GLARE_TIMES):
+        make_glare_rows(graph, 60, seed).to_csv(f"{base_directory}/sun_glare_data_{date_time.strftime(GLARE_DATE_FORMAT)}.csv", index=False)
+
+def route_at(td_graph, graph, departure_time):
+    route, arrival, node_times = time_dependent_shortest_path(td_graph, 0, len(graph) - 1, departure_time)
+    return route, arrival.timestamp(), [node_time.timestamp() for node_time in node_times]
+
+
+@pytest.mark.parametrize("time_zone", ["America/New_York", "Asia/Tokyo"])
+def test_naive_date_times_are_utc_in_any_machine_time_zone(grid_graph, tmp_path, machine_time_zone, time_zone):
+    write_glare_time_files(grid_graph, tmp_path)
+    machine_time_zone(time_zone)
+
+    timestamps, glare_counts = build_glare_time_table(grid_graph, tmp_path, GLARE_TIMES)
+    assert timestamps.tolist() == [date_time.replace(tzinfo=timezone.utc).timestamp() for date_time in GLARE_TIMES]
+
+    # the same UTC times given as naive, UTC and another time zone build the same table and find the same route
+    eastern = timezone(timedelta(hours=-4))
+    aware_timestamps, aware_glare_counts = build_glare_time_table(grid_graph, tmp_path, [date_time.replace(tzinfo=timezone.utc).astimezone(eastern) for date_time in GLARE_TIMES])
+    assert np.array_equal(timestamps, aware_timestamps)
+    assert np.array_equal(glare_counts, aware_glare_counts)
+
+    td_graph = build_time_dependent_graph(grid_graph, timestamps, glare_counts)
+    departure_time = datetime(2024, 6, 12, 21, 59)
+    naive_route = route_at(td_graph, grid_graph, departure_time)
+    assert naive_route[1] > departure_time.replace(tzinfo=timezone.utc).timestamp()
+    assert naive_route == route_at(td_graph, grid_graph, departure_time.replace(tzinfo=timezone.utc))
+    assert naive_route == route_at(td_graph, grid_graph, departure_time.replace(tzinfo=timezone.utc).astimezone(eastern))
+    assert time_dependent_shortest_path(td_graph, 0, len(grid_graph) - 1, departure_time)[1].tzinfo == timezone.utc
+
+
+# 0 -> 1 -> 2, ten minutes per edge
+def make_two_edge_graph():
+    graph = nx.MultiDiGraph(crs="EPSG:4326")
+    for node in range(3):
+        graph.add_node(node, x=-77.0 + node * 0.01, y=38.9)
+    for u, v in ((0, 1), (1, 2)):
+        graph.add_edge(u, v, 0, length=1000.0, travel_time=600.0, oneway=True)
+    return graph
+
+def timed_route(td_graph, departure):
+    route, arrival, node_times = time_dependent_shortest_path(td_graph, 0, 2, datetime.fromtimestamp(departure, timezone.utc))
+    return route, [node_time.timestamp() - departure for node_time in node_times]
+
+
+# the clock uses real travel times, only the cost is penalized: glare on the first edge does not delay the car into
+# the second edge's glare (which starts 15 minutes into the trip)
+def test_glare_penalty_does_not_slow_the_clock():
+    start = datetime(2024, 6, 12, 21, tzinfo=timezone.utc).timestamp()
+    timestamps = np.array([start, start + 900, start + 7200])
+    glare_counts = np.array([[1, 0], [1, 1], [1, 0]])
+    td_graph = build_time_dependent_graph(make_two_edge_graph(), timestamps, glare_counts)
+
+    assert timed_route(td_graph, start) == ([0, 1, 2], [0.0, 600.0, 1200.0])
+    # leaving later, the second edge is entered in the glare, and waiting until it passes costs more than the penalty
+    assert timed_route(td_graph, start + 400) == ([0, 1, 2], [0.0, 600.0, 1200.0])
+    assert get_edge_step(td_graph, 1, start + 1000) == (600.0 * GLARE_PENALTY, start + 1600)
+
+# waiting for the glare to pass is taken when it costs less than driving through it
+def test_waiting_for_glare_to_pass():
+    start = datetime(2024, 6, 12, 21, tzinfo=timezone.utc).timestamp()
+    timestamps = np.array([start, start + 300])
+    glare_counts = np.array([[1, 0], [0, 0]])
+    td_graph = build_time_dependent_graph(make_two_edge_graph(), timestamps, glare_counts)
+
+    assert get_edge_step(td_graph, 0, start) == (900.0, start + 900)
+    assert timed_route(td_graph, start) == ([0, 1, 2], [0.0, 900.0, 1500.0])
+
+
+# 12 x 12 grid with glare weights, an isolated node and a node that only has an edge out of it (nothing reaches it)
+def make_routing_graph():
+    graph = make_grid_graph(12)
+    graph.add_node("isolated", x=-77.2, y=38.8)
+    graph.add_node("source", x=-77.11, y=38.85)
+    add_road(graph, "source", 0, True, 9999)
+    graph, _ = add_glare_weights(graph, make_glare_rows(graph, 300))
+    return graph
+
+def make_route_pairs(graph, count=80, seed=0):
+    rng = np.random.default_rng(seed)
+    grid_nodes = [node for node in graph.nodes if isinstance(node, int)]
+    # few origins, so they are shared
+    pairs = [(int(rng.choice(grid_nodes[:10])), int(rng.choice(grid_nodes))) for _ in range(count)]
+    return pairs + [(5, 5), (5, "isolated"), ("isolated", 5), (5, "source"), ("source", 17), ("isolated", "isolated")]
+
+def networkx_distance(graph, origin, destination, weight):
+    try:
+        return nx.shortest_path_length(graph, origin, destination, weight=weight)
+    except nx.NetworkXNoPath:
+        return np.nan
+
+
+# both methods find routes as short as networkx's (by length, and by glare weight: length, with the glare part
+# penalized), and NaN for unreachable pairs. One origin chunk per few origins to cover the chunking
+@pytest.mark.parametrize("method", ["alt", "one_to_many"])
+def test_batch_routes_match_networkx(monkeypatch, method):
+    monkeypatch.setattr(GlareRouting, "ORIGIN_CHUNK_SIZE", 3)
+    graph = make_routing_graph()
+    pairs = make_route_pairs(graph)
+
+    results, _ = batch_route_pairs(graph, pairs, method=method, landmark_count=4)
+
+    assert results[["origin", "destination"]].apply(tuple, axis=1).tolist() == pairs
+    expected_lengths = [networkx_distance(graph, origin, destination, "length") for origin, destination in pairs]
+    expected_glare_weights = [networkx_distance(graph, origin, destination, GLARE_WEIGHT) for origin, destination in pairs]
+    np.testing.assert_allclose(results["fastest_length"], expected_lengths, rtol=1e-9)
+    glare_weights = results["glare_avoiding_length"] + (GLARE_PENALTY - 1) * results["glare_avoiding_glare_length"]
+    np.testing.assert_allclose(glare_weights, expected_glare_weights, rtol=1e-9)
+
+    unreachable = np.isnan(expected_lengths)
+    # to and from the isolated node and into the source, and some pairs the one way streets leave unreachable
+    assert unreachable[-5:-2].all() and not unreachable[-2:].any() and unreachable.sum() > 3
+    assert results.loc[unreachable].drop(columns=["origin", "destination"]).isna().all().all()
+    # the glare avoiding route never has more glare, and is never shorter
+    reachable = results.loc[~unreachable]
+    assert (reachable["glare_length_avoided"] >= -1e-9).all()
+    assert (reachable["extra_length"] >= -1e-9).all()
+    assert (reachable["glare_length_avoided"] > 0).any()
+
+
+# landmark distances are networkx's single source distances (from every landmark and, on the reversed graph, to it),
+# and A* with them finds networkx's shortest distance between every pair
+def test_landmarks_and_alt_match_networkx():
+    graph = make_routing_graph()
+    arrays = build_routing_arrays(graph)
+    landmark_data = build_landmarks(arrays, "length", landmark_count=5, seed=1)
+    nodes = arrays["nodes"]
+
+    assert len(set(landmark_data["landmarks"])) == 5
+    for column, landmark in enumerate(landmark_data["landmarks"]):
+        from_distances = nx.single_source_dijkstra_path_length(graph, nodes[landmark], weight="length")
+        to_distances = nx.single_source_dijkstra_path_length(graph.reverse(), nodes[landmark], weight="length")
+        np.testing.assert_allclose(landmark_data["from_landmarks"][:, column], [from_distances.get(node, np.inf) for node in nodes], rtol=1e-9)
+        np.testing.assert_allclose(landmark_data["to_landmarks"][:, column], [to_distances.get(node, np.inf) for node in nodes], rtol=1e-9)
+
+    matrix = arrays["matrices"]["length"]
+    for origin, destination in make_route_pairs(graph, seed=1):
+        route = alt_shortest_path(arrays, "length", landmark_data, arrays["node_positions"][origin], arrays["node_positions"][destination])
+        expected = networkx_distance(graph, origin, destination, "length")
+        if np.isnan(expected):
+            assert route is None
+            continue
+        assert route[0] == arrays["node_positions"][origin] and route[-1] == arrays["node_positions"][destination]
+        assert sum(matrix[u, v] for u, v in zip(route[:-1], route[1:])) == pytest.approx(expected, rel=1e-9)
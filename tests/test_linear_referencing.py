@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+from geopy.distance import geodesic
+from shapely.geometry import LineString
+
+from LinearReferencing import build_linear_reference, sample_equally_spaced_points, get_geodesic_length_feet
+from NodeGrabbing import calculate_heading
+
+
+# the scalar implementations the vectorized sampler replaced (line.interpolate, python min over vertices,
+# calculate_heading and geopy geodesic per vertex pair)
+def reference_equally_spaced_points(line, num_points):
+    total_length = line.length
+    distances = [i * total_length / (num_points - 1) for i in range(num_points)]
+    spaced_points = [(line.interpolate(dist).y, line.interpolate(dist).x) for dist in distances]
+    vertices_latlon = [(pt[1], pt[0]) for pt in line.coords]
+
+    points_with_headings = []
+    for lat1, lon1 in spaced_points:
+        closest_vertex_index = min(range(len(vertices_latlon)), key=lambda i: (vertices_latlon[i][0] - lat1)**2 + (vertices_latlon[i][1] - lon1)**2)
+        next_point = vertices_latlon[min(closest_vertex_index + 1, len(vertices_latlon) - 1)]
+        points_with_headings.append((lat1, lon1, calculate_heading(lat1, lon1, *next_point)))
+    return points_with_headings
+
+def reference_total_feet(line):
+    coords = [(lat, lon) for lon, lat in line.coords]
+    return sum(geodesic(start, end).feet for start, end in zip(coords[:-1], coords[1:]))
+
+
+def random_edges(count, seed=0):
+    rng = np.random.default_rng(seed)
+    edges = []
+    for _ in range(count):
+        start = np.array([-77.1, 38.88]) + rng.uniform(-0.05, 0.05, 2)
+        steps = rng.normal(0, 0.002, (rng.integers(1, 12), 2))
+        edges.append(LineString(np.vstack((start, start + np.cumsum(steps, axis=0)))))
+    return edges
+
+
+@pytest.mark.parametrize("line", random_edges(200))
+def test_vectorized_sampling_matches_scalar_path(line):
+    linear_reference = build_linear_reference(line)
+
+    total_feet = get_geodesic_length_feet(linear_reference)
+    assert total_feet == pytest.approx(reference_total_feet(line), rel=1e-9)
+
+    num_points = int(total_feet // 300) + 2
+    expected = np.array(reference_equally_spaced_points(line, num_points))
+    samples = np.array(sample_equally_spaced_points(linear_reference, num_points))
+    assert samples.shape == expected.shape
+    np.testing.assert_allclose(samples[:, :2], expected[:, :2], rtol=0, atol=1e-12)
+    # headings wrap around at 360
+    heading_differences = (samples[:, 2] - expected[:, 2] + 180) % 360 - 180
+    np.testing.assert_allclose(heading_differences, 0, atol=1e-9)
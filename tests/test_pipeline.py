@@ -0,0 +1,56 @@
+import os
+
+from Pipeline import run_pipeline, make_environment_stages, get_stage_fingerprint
+
+
+def make_file_stages(base_directory, runs):
+    def make_run(name, output_path):
+        def run(emit):
+            runs.append(name)
+            with open(output_path, "w") as file:
+                file.write(f"{name} {len(runs)}")
+        return run
+
+    segments_path = f"{base_directory}/segments.csv"
+    glare_directory = f"{base_directory}/glare"
+    os.makedirs(glare_directory, exist_ok=True)
+    return [
+        {"name": "segments", "dependencies": [], "parameters": {}, "run": make_run("segments", segments_path), "outputs": [segments_path]},
+        {"name": "glare", "dependencies": ["segments"], "parameters": {}, "run": make_run("glare", f"{glare_directory}/glare.csv"), "outputs": [glare_directory]},
+    ]
+
+
+def test_stages_rerun_when_their_outputs_are_missing_or_changed(tmp_path):
+    base_directory = str(tmp_path)
+    runs = []
+    run_pipeline(base_directory, make_file_stages(base_directory, runs))
+    assert runs == ["segments", "glare"]
+
+    run_pipeline(base_directory, make_file_stages(base_directory, runs))
+    assert runs == ["segments", "glare"]
+
+    # a deleted output reruns its stage only
+    os.remove(f"{base_directory}/glare/glare.csv")
+    run_pipeline(base_directory, make_file_stages(base_directory, runs))
+    assert runs == ["segments", "glare", "glare"]
+
+    # an edited output reruns its stage and everything downstream
+    with open(f"{base_directory}/segments.csv", "a") as file:
+        file.write("edited")
+    run_pipeline(base_directory, make_file_stages(base_directory, runs))
+    assert runs == ["segments", "glare", "glare", "segments", "glare"]
+
+    # a file added to a directory output changes it too
+    with open(f"{base_directory}/glare/extra.csv", "w") as file:
+        file.write("extra")
+    run_pipeline(base_directory, make_file_stages(base_directory, runs))
+    assert runs[-1] == "glare" and len(runs) == 6
+
+
+def test_workers_are_part_of_the_segments_fingerprint(tmp_path):
+    def get_segments_fingerprint(workers):
+        stages = make_environment_stages("somewhere", str(tmp_path), "key", workers=workers)
+        return get_stage_fingerprint(stages[0], {})
+
+    assert get_segments_fingerprint(2) == get_segments_fingerprint(2)
+    assert get_segments_fingerprint(2) != get_segments_fingerprint(8)
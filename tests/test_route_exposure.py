@@ -0,0 +1,61 @@
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from RouteExposure import evaluate_route_exposures
+from SegmentBuilding import build_segments_from_graph
+from SunGlareDetectionFunctions import calculate_sun_glare_given_heading_panoramic_row
+from VisualizationFunctions import convert_anti_clockwise_east_headings_to_clockwise_north
+
+SKY_CLASS = 10
+MAP_CLASSES = np.array([SKY_CLASS, 2, 8, 0], dtype=np.uint8)
+ROUTES = [[1, 2, 3, 6, 4, 1], [2, 1, 4], [1, 2, 5, 7], [7, 5], [4, 1, 2]]
+
+
+# one panorama per segment of road_graph (mostly sky segmentation maps, random heading and tilt)
+def make_route_environment(base_directory, road_graph, seed=0):
+    rng = np.random.default_rng(seed)
+    segments = build_segments_from_graph(road_graph)
+    segments.to_csv(f"{base_directory}/segments.csv")
+    segments = segments[segments["headings"].map(len) > 0]
+    for folder in ("segmentation_maps", "segmentation_maps_without_trees"):
+        os.makedirs(f"{base_directory}/{folder}", exist_ok=True)
+
+    rows = []
+    for number, (segment_id, segment) in enumerate(segments.iterrows()):
+        pano_id = f"pano_{number}"
+        for folder in ("segmentation_maps", "segmentation_maps_without_trees"):
+            segmentation_map = rng.choice(MAP_CLASSES, size=(64, 128), p=[0.4, 0.2, 0.2, 0.2])
+            segmentation_map[:24][rng.random((24, 128)) < 0.8] = SKY_CLASS
+            Image.fromarray(segmentation_map).save(f"{base_directory}/{folder}/{pano_id}.png")
+        rows.append({"pano_id": pano_id, "segment_id": segment_id, "lat": segment["lat"], "long": segment["long"],
+                     "heading": rng.uniform(0, 360), "tilt": rng.uniform(-5, 15), "image_width": 128, "image_height": 64})
+    pd.DataFrame(rows).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+
+
+# a batch of routes departing around sunrise and sunset (UTC in DC), every evaluated second matches the per row glare
+# check of its panorama and segment heading, the other seconds have no glare
+def test_route_profiles_match_per_row_glare(tmp_path, road_graph, numpy_sun_position):
+    base_directory = str(tmp_path)
+    make_route_environment(base_directory, road_graph)
+    departure_times = [datetime(2023, month, 12, hour, tzinfo=timezone.utc) + timedelta(minutes=minutes)
+                       for month in (3, 6, 12) for hour in (11, 12, 21, 22, 23) for minutes in (0, 20, 40)]
+    routes = [ROUTES[number % len(ROUTES)] for number in range(len(departure_times))]
+
+    profiles, summary = evaluate_route_exposures(base_directory, routes, departure_times, graph=road_graph)
+
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv").set_index("pano_id", drop=False)
+    evaluated = profiles[profiles["evaluated"]]
+    expected = [calculate_sun_glare_given_heading_panoramic_row(base_directory, convert_anti_clockwise_east_headings_to_clockwise_north(row.segment_heading).item(),
+                                                                panoramic_data.loc[row.pano_id], row.time.to_pydatetime())
+                for row in evaluated.itertuples()]
+
+    # the routes have to exercise both outcomes
+    assert 0 < sum(expected) < len(expected)
+    np.testing.assert_array_equal(evaluated["has_sun_glare"].to_numpy(), expected)
+    assert not profiles.loc[~profiles["evaluated"], "has_sun_glare"].any()
+    assert summary["glare_seconds"].sum() == sum(expected)
+    assert (summary["duration_seconds"] == profiles.groupby("route").size()).all()
@@ -0,0 +1,29 @@
+import NodeGrabbing
+from SegmentBuilding import build_segments_from_graph
+
+
+def read_lines(path):
+    with open(path, "r") as file:
+        return file.read().splitlines()
+
+
+# the bulk builder writes the same segments.csv as the per edge builder, row for row
+def test_bulk_builder_matches_per_edge_builder(road_graph, tmp_path):
+    per_edge_path = tmp_path / "per_edge.csv"
+    bulk_path = tmp_path / "bulk.csv"
+    NodeGrabbing.write_as_csv(per_edge_path, NodeGrabbing.build_segments_per_edge(road_graph))
+    build_segments_from_graph(road_graph).to_csv(bulk_path)
+
+    per_edge_lines = read_lines(per_edge_path)
+    bulk_lines = read_lines(bulk_path)
+    assert len(per_edge_lines) > len(road_graph.nodes) + 1
+    assert len(bulk_lines) == len(per_edge_lines)
+    for per_edge_line, bulk_line in zip(per_edge_lines, bulk_lines):
+        assert bulk_line == per_edge_line
+
+
+def test_bulk_builder_skips_exact_parallel_copies(road_graph):
+    segments = build_segments_from_graph(road_graph)
+    node_3 = f"{NodeGrabbing.segment_key(38.89, -77.08)}"
+    for links in segments.loc[node_3, "heading_links"].values():
+        assert len(links) == len(set(links))
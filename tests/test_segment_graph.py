@@ -0,0 +1,54 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from SegmentBuilding import build_segments_from_graph, SEGMENT_COLUMNS
+from SegmentGraph import (write_segment_graph, write_segment_graph_from_csv, read_segments_csv, load_segment_graph, get_segment_index,
+                          get_segment_record, SEGMENT_GRAPH_ARRAYS, SEGMENT_GRAPH_METADATA_FILE)
+from conftest import make_grid_graph
+
+
+def assert_same_segment_graphs(directory, expected_directory):
+    graph = load_segment_graph(directory, mmap=False)
+    expected = load_segment_graph(expected_directory, mmap=False)
+    for name in SEGMENT_GRAPH_ARRAYS:
+        assert graph[name].dtype == expected[name].dtype, name
+        np.testing.assert_array_equal(graph[name], expected[name], err_msg=name)
+    with open(f"{directory}/{SEGMENT_GRAPH_METADATA_FILE}") as file, open(f"{expected_directory}/{SEGMENT_GRAPH_METADATA_FILE}") as expected_file:
+        assert json.load(file) == json.load(expected_file)
+
+
+# the csv is written unsorted (rows reversed), so every chunk's pieces have to be moved to their sorted position
+@pytest.mark.parametrize("chunk_size", [1, 7, 100000])
+@pytest.mark.parametrize("graph_name", ["road_graph", "grid_graph"])
+def test_chunked_segment_graph_matches_the_whole_csv(tmp_path, request, chunk_size, graph_name):
+    segments = build_segments_from_graph(request.getfixturevalue(graph_name))
+    segments.index.name = "segment_id"
+    segments.iloc[::-1].to_csv(tmp_path / "segments.csv")
+
+    write_segment_graph(read_segments_csv(tmp_path / "segments.csv"), str(tmp_path / "expected"))
+    write_segment_graph_from_csv(tmp_path / "segments.csv", str(tmp_path / "chunked"), chunk_size)
+
+    assert_same_segment_graphs(str(tmp_path / "chunked"), str(tmp_path / "expected"))
+    assert not (tmp_path / "chunked.tmp").exists()
+
+# links to segments that are not in the csv point at -1, and an empty csv gives an empty graph
+def test_chunked_segment_graph_unknown_links_and_empty_csv(tmp_path):
+    pd.DataFrame([("38.9_-77.0", 38.9, -77.0, "[0.0, 180.0]", "['38.8_-77.0', '1_1']", "{'38.8_-77.0': [(-77.0, 38.9), (-77.0, 38.8)], '1_1': [(-77.0, 38.9)]}", "{0.0: ['1_1']}"),
+                  ("38.8_-77.0", 38.8, -77.0, "[90.0]", "[]", "{}", "{}")],
+                 columns=["segment_id"] + SEGMENT_COLUMNS).to_csv(tmp_path / "segments.csv", index=False)
+    write_segment_graph(read_segments_csv(tmp_path / "segments.csv"), str(tmp_path / "expected"))
+    write_segment_graph_from_csv(tmp_path / "segments.csv", str(tmp_path / "chunked"), 1)
+    assert_same_segment_graphs(str(tmp_path / "chunked"), str(tmp_path / "expected"))
+
+    graph = load_segment_graph(str(tmp_path / "chunked"))
+    record = get_segment_record(graph, get_segment_index(graph, "38.9_-77.0"))
+    assert record["segment_links"] == ["38.8_-77.0"]
+    assert record["line_strings"] == {"38.8_-77.0": [(-77.0, 38.9), (-77.0, 38.8)]}
+
+    pd.DataFrame(columns=["segment_id"] + SEGMENT_COLUMNS).to_csv(tmp_path / "empty.csv", index=False)
+    write_segment_graph_from_csv(tmp_path / "empty.csv", str(tmp_path / "empty"), 5)
+    graph = load_segment_graph(str(tmp_path / "empty"))
+    assert all(len(graph[name]) == (1 if name.endswith("_offsets") else 0) for name in SEGMENT_GRAPH_ARRAYS)
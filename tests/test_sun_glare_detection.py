@@ -0,0 +1,72 @@
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+from pysolar.solar import get_position
+
+import SunGlareDetectionFunctions
+from SegmentGraph import convert_segments_csv_to_segment_graph
+
+
+def write_environment(base_directory):
+    pd.DataFrame({
+        "segment_id": ["1_2", "2_3"],
+        "lat": [38.9, 38.91],
+        "long": [-77.0, -77.01],
+        "headings": ["[0.0, 180.0]", "[90.0]"],
+        "segment_links": ["[]", "[]"],
+        "heading_links": ["{}", "{}"],
+        "line_strings": ["[]", "[]"],
+    }).to_csv(f"{base_directory}/segments.csv", index=False)
+    # pano_missing points at a segment that is in neither segments.csv nor the segment graph
+    pd.DataFrame({
+        "pano_id": ["pano_a", "pano_missing", "pano_b"],
+        "segment_id": ["1_2", "9_9", "2_3"],
+        "lat": [38.9, 38.95, 38.91],
+        "long": [-77.0, -77.05, -77.01],
+        "heading": [0.0, 0.0, 0.0],
+        "tilt": [0.0, 0.0, 0.0],
+        "year": [2020, 2020, 2020],
+        "month": [5, 5, 5],
+        "image_width": [1024, 1024, 1024],
+        "image_height": [512, 512, 512],
+    }).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+
+
+@pytest.mark.parametrize("use_segment_graph", [True, False])
+def test_panoramas_of_unknown_segments_are_skipped(tmp_path, monkeypatch, capsys, use_segment_graph):
+    base_directory = str(tmp_path)
+    write_environment(base_directory)
+    if use_segment_graph:
+        convert_segments_csv_to_segment_graph(base_directory)
+
+    evaluated = {}
+    def record_panoramic(base_directory, sun_glare_dict, pano_id, lat, long, heading, tilt, date_time, segment_headings, image_size):
+        evaluated[pano_id] = list(segment_headings)
+        sun_glare_dict[pano_id] = {"lat": lat, "long": long}
+    monkeypatch.setattr(SunGlareDetectionFunctions, "calculate_sun_glare_for_a_single_panoramic_image", record_panoramic)
+
+    SunGlareDetectionFunctions.calculate_sun_glare_for_panoramic_data_at_date_time(base_directory, datetime(2024, 6, 12, 23, tzinfo=timezone.utc))
+
+    # headings are converted to anticlockwise from east
+    assert evaluated == {"pano_a": [90.0, 270.0], "pano_b": [0.0]}
+    assert "segment_id 9_9 of pano_missing" in capsys.readouterr().out
+    assert pd.read_csv(f"{base_directory}/sun_glare_data_2024-06-12_23-00-00.csv", index_col=0).index.tolist() == ["pano_a", "pano_b"]
+
+
+# the numpy solar position agrees with pysolar's SPA within 0.05 degrees (azimuth measured along the sky,
+# since it is unstable right under the zenith), 2000-2023 so pysolar has the leap seconds
+def test_batch_sun_positions_match_pysolar():
+    rng = np.random.default_rng(0)
+    lats = rng.uniform(-70, 70, 300)
+    longs = rng.uniform(-180, 180, 300)
+    timestamps = rng.uniform(datetime(2000, 1, 1, tzinfo=timezone.utc).timestamp(), datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp(), 300)
+
+    altitudes, azimuths = SunGlareDetectionFunctions.get_sun_positions_east_batch(lats, longs, timestamps)
+
+    for lat, long, timestamp, altitude, azimuth in zip(lats, longs, timestamps, altitudes, azimuths):
+        pysolar_azimuth, pysolar_altitude = get_position(lat, long, datetime.fromtimestamp(timestamp, timezone.utc))
+        assert altitude == pytest.approx(pysolar_altitude, abs=0.05)
+        azimuth_difference = abs((azimuth - (90 - pysolar_azimuth) + 180) % 360 - 180)
+        assert azimuth_difference * np.cos(np.radians(pysolar_altitude)) < 0.05
@@ -0,0 +1,51 @@
+import io
+
+import pandas as pd
+from PIL import Image
+
+import PanoramaStore
+import TileGrabbing
+
+
+def make_jpeg(width, height):
+    image = Image.new("RGB", (width, height), (120, 160, 200))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+def write_segments(base_directory, segment_count):
+    pd.DataFrame({
+        "segment_id": range(segment_count),
+        "lat": 38.9,
+        "long": -77.0,
+        "headings": "[0]",
+        "segment_links": "[]",
+        "heading_links": "[]",
+        "line_strings": "[]",
+    }).to_csv(f"{base_directory}/segments.csv", index=False)
+
+
+def test_reused_panoramics_keep_their_own_zoom(tmp_path, monkeypatch):
+    base_directory = str(tmp_path / "environment")
+    monkeypatch.setattr(PanoramaStore, "PANORAMA_STORE_DIRECTORY", str(tmp_path / "store"))
+    monkeypatch.setattr(TileGrabbing, "ZOOM", 1)
+    pano_ids = ["new_pano", "old_pano", "stored_pano"]
+    monkeypatch.setattr(TileGrabbing, "get_data_from_cords", lambda lat, long, radius=25: {"panoId": pano_ids.pop(0), "heading": 90, "tilt": 90, "date": "2020-05"})
+    monkeypatch.setattr(TileGrabbing, "get_image_for_panoId", lambda *args, **kwargs: make_jpeg(TileGrabbing.TILE_SIZE, TileGrabbing.TILE_SIZE))
+
+    (tmp_path / "environment").mkdir()
+    write_segments(base_directory, 3)
+    (tmp_path / "environment" / "panoramic_imgs").mkdir()
+    (tmp_path / "environment" / "tile_imgs").mkdir()
+    # grabbed by an earlier run at zoom 2, before panoramic_data.csv was written
+    Image.new("RGB", (1664, 832)).save(f"{base_directory}/panoramic_imgs/old_pano.jpg")
+    # grabbed at zoom 3 and shared through the store, but small enough to look like zoom 1
+    Image.new("RGB", (900, 450)).save(f"{base_directory}/panoramic_imgs/stored_pano.jpg")
+    PanoramaStore.add_panoramic_to_store("stored_pano", base_directory, [], zoom=3)
+
+    saved = []
+    TileGrabbing.get_store_all_panoramics_from_segments(base_directory, on_panoramic_saved=lambda pano_id, zoom: saved.append((pano_id, zoom)))
+
+    panoramic_data = pd.read_csv(f"{base_directory}/panoramic_data.csv").set_index("pano_id")
+    assert panoramic_data["zoom"].to_dict() == {"new_pano": 1, "old_pano": 2, "stored_pano": 3}
+    assert saved == [("new_pano", 1), ("old_pano", 2), ("stored_pano", 3)]
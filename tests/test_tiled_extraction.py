@@ -0,0 +1,130 @@
+import os
+
+import geopandas as gpd
+import networkx as nx
+import osmnx as ox
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import box
+
+import TiledExtraction
+from SegmentBuilding import build_segments_from_graph, SEGMENT_COLUMNS
+from conftest import make_grid_graph, GRID_STEP_DEGREES
+
+
+# what load_drive_graph(polygon=..., retain_all=True, truncate_by_edge=True) returns for a part of the graph
+# shuffled: nodes in another order than the whole graph's (ex: a tile's response split into several Overpass queries)
+def load_graph_part(graph, polygon, shuffled=False):
+    inside = {node for node, data in graph.nodes(data=True) if shapely.contains_xy(polygon, data["x"], data["y"])}
+    if not inside:
+        raise ValueError("No nodes in the polygon")
+    edges = [(u, v, key, data) for u, v, key, data in graph.edges(keys=True, data=True) if u in inside or v in inside]
+    touching = {node for u, v, _, _ in edges for node in (u, v)}
+    # in the whole graph's node order, like osmnx (ascending OSM ids)
+    part = nx.MultiDiGraph(**graph.graph)
+    nodes = [(node, data) for node, data in graph.nodes(data=True) if node in touching]
+    part.add_nodes_from(nodes[::-1] if shuffled else nodes)
+    part.add_edges_from(edges)
+    return part
+
+
+def read_segments_rows(path):
+    segments = pd.read_csv(path, index_col="segment_id", dtype=str)
+    return segments.sort_index()
+
+
+# step 0.0012: every street has a single segment in between, which both directions of a two way street create
+@pytest.mark.parametrize("step, tile_size_km", [(GRID_STEP_DEGREES, 0.4), (GRID_STEP_DEGREES, 1.1), (0.0012, 0.25), (0.0012, 0.4)])
+@pytest.mark.parametrize("shuffled", [False, True])
+def test_tiled_segments_match_the_whole_place(tmp_path, monkeypatch, step, tile_size_km, shuffled):
+    graph = make_grid_graph(14, step)
+    monkeypatch.setattr(TiledExtraction, "load_drive_graph", lambda polygon, **kwargs: load_graph_part(graph, polygon, shuffled))
+
+    xs = [x for _, x in graph.nodes(data="x")]
+    ys = [y for _, y in graph.nodes(data="y")]
+    place_polygon = box(min(xs) - 0.001, min(ys) - 0.001, max(xs) + 0.001, max(ys) + 0.001)
+    tiles = TiledExtraction.make_tile_grid(place_polygon, tile_size_km)
+    assert len(tiles) > 1
+    for row, col, bounds in tiles:
+        TiledExtraction.build_tile_segments((row, col, bounds, place_polygon, str(tmp_path), None))
+    TiledExtraction.merge_tile_segments(tiles, str(tmp_path), str(tmp_path / "tiled.csv"))
+    build_segments_from_graph(graph).to_csv(tmp_path / "whole.csv")
+
+    tiled = read_segments_rows(tmp_path / "tiled.csv")
+    whole = read_segments_rows(tmp_path / "whole.csv")
+    assert tiled.index.is_unique
+    assert tiled.index.tolist() == whole.index.tolist()
+    pd.testing.assert_frame_equal(tiled, whole)
+
+
+# a boundary segment built by two tiles keeps the row of the edge with the lowest u id, not of the first tile
+def test_merge_keeps_boundary_duplicates_in_edge_order(tmp_path):
+    tiles = [(0, 0, None), (0, 1, None)]
+    rows = {
+        (0, 0): [("38.9_-77.0", 38.9, -77.0, "[180.0]", 20)],
+        (0, 1): [("38.9_-77.0", 38.9, -77.0, "[0.0]", 10), ("38.8_-77.0", 38.8, -77.0, "[90.0]", 11)],
+    }
+    for (row, col), tile_rows in rows.items():
+        tile_path, boundary_path = TiledExtraction.get_tile_paths(str(tmp_path), row, col)
+        TiledExtraction.write_tile_csv(pd.DataFrame(columns=SEGMENT_COLUMNS), tile_path)
+        boundary = pd.DataFrame([(lat, long, headings, "[]", "{}", "{}", u_id) for _, lat, long, headings, u_id in tile_rows],
+                                columns=SEGMENT_COLUMNS + ["u_id"], index=[segment_id for segment_id, *_ in tile_rows])
+        TiledExtraction.write_tile_csv(boundary, boundary_path)
+
+    TiledExtraction.merge_tile_segments(tiles, str(tmp_path), str(tmp_path / "segments.csv"))
+    segments = pd.read_csv(tmp_path / "segments.csv", index_col="segment_id")
+    assert segments.columns.tolist() == SEGMENT_COLUMNS
+    assert segments["headings"].to_dict() == {"38.9_-77.0": "[0.0]", "38.8_-77.0": "[90.0]"}
+
+
+# size x size grid of two way streets as an .osm extract (one way per row and per column), and its boundary
+def write_grid_extract(directory, size=10, step=0.002):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="test">']
+    for row in range(size):
+        for col in range(size):
+            lines.append(f'  <node id="{row * size + col + 1}" version="1" lat="{38.85 + row * step:.7f}" lon="{-77.1 + col * step:.7f}"/>')
+    way_id = 1
+    for line_nodes in [[row * size + col + 1 for col in range(size)] for row in range(size)] + [[row * size + col + 1 for row in range(size)] for col in range(size)]:
+        lines.append(f'  <way id="{way_id}" version="1">')
+        lines.extend(f'    <nd ref="{node}"/>' for node in line_nodes)
+        lines.append('    <tag k="highway" v="residential"/>')
+        lines.append('  </way>')
+        way_id += 1
+    lines.append('</osm>')
+    osm_file = f"{directory}/grid.osm"
+    with open(osm_file, "w") as file:
+        file.write("\n".join(lines))
+
+    boundary_file = f"{directory}/boundary.geojson"
+    boundary = box(-77.1 - step / 2, 38.85 - step / 2, -77.1 + (size - 0.5) * step, 38.85 + (size - 0.5) * step)
+    gpd.GeoDataFrame(geometry=[boundary], crs="EPSG:4326").to_file(boundary_file, driver="GeoJSON")
+    return osm_file, boundary_file
+
+def no_network(*args, **kwargs):
+    raise AssertionError("live OSM services were queried")
+
+
+# tiled builds from a local extract never touch the network, and build the same segments as the untiled build
+def test_tiled_build_from_an_extract_is_offline(tmp_path, monkeypatch):
+    import GraphLoading
+    import NodeGrabbing
+
+    monkeypatch.setattr(GraphLoading, "GRAPH_CACHE_DIRECTORY", str(tmp_path / "graph_cache"))
+    for name in ("geocode_to_gdf", "graph_from_polygon", "graph_from_place"):
+        monkeypatch.setattr(ox, name, no_network)
+    osm_file, boundary_file = write_grid_extract(tmp_path)
+
+    NodeGrabbing.store_all_nodes_at_location("nowhere", str(tmp_path / "tiled"), tile_size_km=0.6, workers=2, osm_file=osm_file, boundary_file=boundary_file)
+    NodeGrabbing.store_all_nodes_at_location("nowhere", str(tmp_path / "whole"), osm_file=osm_file, boundary_file=boundary_file)
+
+    tiled = read_segments_rows(tmp_path / "tiled" / "segments.csv")
+    whole = read_segments_rows(tmp_path / "whole" / "segments.csv")
+    assert len(os.listdir(tmp_path / "tiled" / "segment_tiles")) > 2
+    assert tiled.index.tolist() == whole.index.tolist()
+    pd.testing.assert_frame_equal(tiled, whole)
+
+def test_tiled_build_from_an_extract_needs_a_boundary(tmp_path):
+    osm_file, _ = write_grid_extract(tmp_path)
+    with pytest.raises(ValueError, match="boundary_file"):
+        TiledExtraction.store_all_nodes_at_location_tiled("nowhere", str(tmp_path / "tiled"), 0.6, osm_file=osm_file)
@@ -0,0 +1,135 @@
+import json
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+from pyproj import Geod
+from shapely.geometry import LineString
+
+from TrafficOverlay import overlay_sun_glare_on_traffic, preprocess_sun_glare_data, iter_geojson_features, GLARE_BUFFER_METERS
+
+geod = Geod(ellps="WGS84")
+ROAD_START = (-77.0500, 38.9000)
+ROAD_END = (-77.0400, 38.9000)
+
+
+def make_traffic_gdf():
+    return gpd.GeoDataFrame({"segmentProbeCounts": ['[{"probeCount": 7}]']}, geometry=[LineString([ROAD_START, ROAD_END])], crs="EPSG:4326")
+
+# glare point due north of the middle of the road, distance_meters away on the ground
+def make_glare_gdf(distance_meters):
+    long, lat, _ = geod.fwd(-77.0450, 38.9000, 0, distance_meters)
+    return preprocess_sun_glare_data(pd.DataFrame({"lat": [lat], "long": [long], "has_sun_glare": [True]}))
+
+
+# the buffer radius is in meters on the ground (EPSG:3857 units are ~22% shorter at DC's latitude)
+def test_glare_buffer_is_in_ground_meters():
+    overlay, _ = overlay_sun_glare_on_traffic(make_traffic_gdf(), make_glare_gdf(GLARE_BUFFER_METERS - 1))
+    assert overlay["has_glare"].tolist() == [True]
+
+    overlay, _ = overlay_sun_glare_on_traffic(make_traffic_gdf(), make_glare_gdf(GLARE_BUFFER_METERS + 1))
+    assert overlay["has_glare"].tolist() == [False]
+
+
+def write_traffic_geojson(path, roads):
+    make_traffic_gdf_for_roads(roads).to_file(path, driver="GeoJSON")
+
+def make_traffic_gdf_for_roads(roads):
+    return gpd.GeoDataFrame({"segmentProbeCounts": ['[{"probeCount": 7}]'] * len(roads)}, geometry=[LineString(road) for road in roads], crs="EPSG:4326")
+
+# a panorama 15 meters north of the road (outside the default buffer, inside a 20 meter one)
+def write_panoramic_data(base_directory):
+    long, lat, _ = geod.fwd(-77.0450, 38.9000, 0, 15)
+    pd.DataFrame({"pano_id": ["pano_0"], "lat": [lat], "long": [long]}).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+
+
+def test_traffic_glare_index_cache_follows_its_inputs(tmp_path, monkeypatch):
+    import TrafficOverlay
+
+    builds = []
+    build_traffic_glare_index = TrafficOverlay.build_traffic_glare_index
+    def counting_build(*args, **kwargs):
+        builds.append(args)
+        return build_traffic_glare_index(*args, **kwargs)
+    monkeypatch.setattr(TrafficOverlay, "build_traffic_glare_index", counting_build)
+
+    base_directory = str(tmp_path)
+    geojson_path = f"{base_directory}/traffic.geojson"
+    write_panoramic_data(base_directory)
+    write_traffic_geojson(geojson_path, [[ROAD_START, ROAD_END]])
+
+    index = TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path)
+    assert index["matrix"].nnz == 0
+    TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path)
+    assert len(builds) == 1
+
+    # buffer_meters is forwarded to the build and part of the cache key
+    index = TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path, buffer_meters=20)
+    assert len(builds) == 2
+    assert index["matrix"].nnz == 1
+
+    # an edited traffic file rebuilds it
+    write_traffic_geojson(geojson_path, [[ROAD_START, ROAD_END], [ROAD_START, (-77.0500, 38.9100)]])
+    index = TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path, buffer_meters=20)
+    assert len(builds) == 3
+    assert index["matrix"].shape == (2, 1)
+
+    # so does a changed panoramic_data.csv
+    pd.DataFrame({"pano_id": ["pano_0", "pano_1"], "lat": [38.95, 38.96], "long": [-77.0, -77.0]}).to_csv(f"{base_directory}/panoramic_data.csv", index=False)
+    index = TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path, buffer_meters=20)
+    assert len(builds) == 4
+    assert index["matrix"].shape == (2, 2)
+    TrafficOverlay.get_traffic_glare_index(base_directory, geojson_path, buffer_meters=20)
+    assert len(builds) == 4
+
+
+# probe GeoJSON with a "features" key nested in a top level member before the collection's and in the properties,
+# numbers and strings long enough to be split across reads
+def write_probe_geojson(path, feature_count, nested_features=True):
+    features = [{"type": "Feature", "properties": {"segmentProbeCounts": json.dumps([{"probeCount": number * 1234567}]), "speed": number + 0.123456789,
+                                                   "name": f"road {number} " + "x" * number, "note": '"features": [' if number % 2 else "{[,]}"},
+                 "geometry": {"type": "LineString", "coordinates": [[-77.05 + number * 0.001, 38.9], [-77.04 + number * 0.001, 38.9 + number * 0.0001]]}}
+                for number in range(feature_count)]
+    collection = {"type": "FeatureCollection", "features": features}
+    if nested_features:
+        collection = {"type": "FeatureCollection", "metadata": {"features": [{"type": "Feature", "properties": {}, "geometry": None}], "count": 123456789}, "features": features}
+    with open(path, "w", encoding="utf-8") as file:
+        json.dump(collection, file, indent=1)
+
+def read_features_with_iterator(path, read_size):
+    features = list(iter_geojson_features(path, read_size))
+    if not features:
+        return gpd.GeoDataFrame(geometry=[], crs="EPSG:4326")
+    return gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+
+
+@pytest.mark.parametrize("read_size", [1, 3, 7, 1 << 20])
+@pytest.mark.parametrize("feature_count, nested_features", [(0, False), (0, True), (6, False), (6, True)])
+def test_streamed_geojson_features_match_read_file(tmp_path, read_size, feature_count, nested_features):
+    path = tmp_path / "traffic.geojson"
+    write_probe_geojson(path, feature_count, nested_features)
+
+    streamed = read_features_with_iterator(path, read_size)
+    expected = gpd.read_file(path)
+
+    assert len(streamed) == len(expected) == feature_count
+    assert streamed.geometry.geom_equals_exact(expected.geometry, tolerance=0).all()
+    for column in ("segmentProbeCounts", "speed", "name", "note"):
+        if feature_count:
+            assert streamed[column].tolist() == expected[column].tolist()
+
+# cut inside of a feature, between two features and before the features array: never a silently shorter collection
+@pytest.mark.parametrize("read_size", [3, 1 << 20])
+def test_truncated_geojson_raises(tmp_path, read_size):
+    path = tmp_path / "traffic.geojson"
+    write_probe_geojson(path, 4)
+    text = path.read_text(encoding="utf-8")
+    features_start = text.index('"features": [', text.index('"count"'))
+    second_feature = text.rindex("{", 0, text.index('"type": "Feature"', text.index('"type": "Feature"', features_start) + 1))
+    first_feature_end = text.rindex("}", 0, second_feature) + 1
+    cuts = [second_feature + 40, first_feature_end, second_feature, features_start - 10]
+
+    for cut in cuts:
+        path.write_text(text[:cut], encoding="utf-8")
+        with pytest.raises(ValueError):
+            list(iter_geojson_features(path, read_size))
@@ -0,0 +1,53 @@
+import re
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from VisualizationFunctions import build_sun_glare_lines, visualize_sun_glare_data, render_sun_glare_png, render_sun_glare_time_sweep
+
+EMPTY_DATE_STRING = "2024-06-12_03-00-00"
+
+
+# every drawn line keeps its own sun_glare_id (popup and tooltip), colors are grouped into one element each
+def test_polyline_map_keeps_sun_glare_id_per_line(glare_map_environment):
+    base_directory, date_string = glare_map_environment
+    lines, row_count = build_sun_glare_lines(base_directory, date_string)
+    assert len(lines) > 0
+
+    visualize_sun_glare_data(base_directory, date_string, (38.88, -77.09))
+    with open(f"{base_directory}/sun_glare_map_{date_string}.html", "r") as file:
+        html = file.read()
+
+    drawn_ids = re.findall(r'"sun_glare_id":\s*"([^"]+)"', html)
+    assert sorted(drawn_ids) == sorted(lines["pano_heading_id"].tolist())
+    assert "GeoJsonPopup" in html or "bindPopup" in html
+    assert html.count("L.geoJson(") == lines["color"].nunique()
+
+
+def is_blank(image):
+    pixels = np.asarray(image)
+    return len(np.unique(pixels.reshape(-1, pixels.shape[-1]), axis=0)) == 1
+
+# a time with no glare line to draw (ex: night) still renders, over the environment's extent
+def test_maps_without_glare_lines_render_empty_frames(glare_map_environment):
+    base_directory, date_string = glare_map_environment
+    glare_data = pd.read_csv(f"{base_directory}/sun_glare_data_{date_string}.csv")
+    glare_data.head(0).to_csv(f"{base_directory}/sun_glare_data_{EMPTY_DATE_STRING}.csv", index=False)
+
+    assert len(build_sun_glare_lines(base_directory, EMPTY_DATE_STRING)[0]) == 0
+    with Image.open(render_sun_glare_png(base_directory, EMPTY_DATE_STRING, width=200)) as image:
+        assert image.width == 200
+        assert is_blank(image)
+
+    frame_paths = render_sun_glare_time_sweep(base_directory, [date_string, EMPTY_DATE_STRING], width=200)
+    with Image.open(render_sun_glare_png(base_directory, date_string, width=200)) as image, Image.open(frame_paths[0]) as frame:
+        assert frame.size == image.size
+    with Image.open(frame_paths[1]) as frame:
+        assert is_blank(frame)
+
+    # only the empty map, every frame is empty
+    frame_paths = render_sun_glare_time_sweep(base_directory, [EMPTY_DATE_STRING], width=200, output_directory=f"{base_directory}/empty_frames")
+    with Image.open(frame_paths[0]) as frame:
+        assert frame.width == 200
+        assert is_blank(frame)